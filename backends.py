@@ -0,0 +1,387 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+
+import numpy as np
+import chromadb
+
+from metadata_index import SCAN_BLOCK
+
+BACKENDS = ["chroma", "numpy", "ivf"]
+
+
+def directory_size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+class ChromaBackend:
+    """
+    The persistent Chroma collection, vectors and records both live in Chroma. Vectors
+    are always computed by VectorDB, so the collection is opened without an embedding function.
+    """
+
+    name = "chroma"
+    stores_vectors = True
+
+    def __init__(self, path, collection_name):
+        self.path = path
+        self.collection_name = collection_name
+        self.collection = None
+
+    def open(self, embedding_function=None):
+        if self.collection is None:
+            chroma_client = chromadb.PersistentClient(path=self.path)
+            self.collection = chroma_client.get_or_create_collection(name=self.collection_name, embedding_function=embedding_function)
+        return self
+
+    def upsert(self, ids, embeddings, documents, metadatas):
+        self.collection.upsert(ids=ids, embeddings=embeddings, documents=documents, metadatas=metadatas)
+
+    def delete(self, ids):
+        self.collection.delete(ids=ids)
+
+    def ids(self):
+        return self.collection.get(include=[])["ids"]
+
+    def count(self):
+        return self.collection.count()
+
+    def query(self, query_embeddings, n_results, where=None, include=("documents", "metadatas"), ids=None):
+        return self.collection.query(query_embeddings=query_embeddings, n_results=n_results, where=where, ids=ids,
+                                     include=list(include) + ["distances"])
+
+    def get(self, ids=None, where=None, include=("documents", "metadatas"), limit=None, offset=None):
+        return self.collection.get(ids=ids, where=where, include=list(include), limit=limit, offset=offset)
+
+    def save(self, generation):
+        pass
+
+    def footprint(self):
+        peek = self.collection.peek(1)
+        dim = len(peek["embeddings"][0]) if len(peek["ids"]) else 0
+
+        return {"backend": self.name,
+                "vector_bytes": self.count() * dim * 4,
+                "disk_bytes": directory_size(self.path)}
+
+
+class RecordStore:
+    """
+    Documents and metadata by id (sqlite) for the backends that keep vectors in the columnar index.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn = None
+
+    def connect(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS records (doc_id TEXT PRIMARY KEY, document TEXT, metadata TEXT) WITHOUT ROWID")
+        return self._conn
+
+    def upsert(self, ids, documents, metadatas):
+        with self._lock:
+            conn = self.connect()
+            conn.executemany("INSERT OR REPLACE INTO records (doc_id, document, metadata) VALUES (?, ?, ?)",
+                             [(doc_id, document, json.dumps(metadata)) for doc_id, document, metadata in zip(ids, documents, metadatas)])
+            conn.commit()
+
+    def delete(self, ids):
+        with self._lock:
+            conn = self.connect()
+            conn.executemany("DELETE FROM records WHERE doc_id = ?", [(doc_id,) for doc_id in ids])
+            conn.commit()
+
+    def ids(self):
+        with self._lock:
+            return [doc_id for doc_id, in self.connect().execute("SELECT doc_id FROM records")]
+
+    def count(self):
+        with self._lock:
+            return self.connect().execute("SELECT COUNT(*) FROM records").fetchone()[0]
+
+    def get(self, ids, documents=True, metadatas=True):
+        """
+        (documents, metadatas) in the order of ids, only reading the columns asked for
+        (None for the others).
+        """
+
+        columns = ["document" if documents else "NULL", "metadata" if metadatas else "NULL"]
+        found = {}
+        with self._lock:
+            conn = self.connect()
+            for start in range(0, len(ids), 500):
+                batch = ids[start:start + 500]
+                rows = conn.execute("SELECT doc_id, %s FROM records WHERE doc_id IN (%s)" % (", ".join(columns), ",".join("?" * len(batch))), batch)
+                for doc_id, document, metadata in rows:
+                    found[doc_id] = (document, json.loads(metadata) if metadatas else None)
+
+        return ([found[doc_id][0] for doc_id in ids] if documents else None,
+                [found[doc_id][1] for doc_id in ids] if metadatas else None)
+
+
+class NumpyBackend:
+    """
+    Exact brute force search over the (optionally quantized, memory-mapped) vectors of
+    the columnar index, with filters evaluated on its columns.
+    """
+
+    name = "numpy"
+    stores_vectors = False
+
+    def __init__(self, index, records_path):
+        self.index = index
+        self.records = RecordStore(records_path) if records_path else None
+
+    def open(self, embedding_function=None):
+        return self
+
+    def upsert(self, ids, embeddings, documents, metadatas):
+        # Vectors reach the columnar index through ingestion, only records are kept here.
+        self.records.upsert(ids, documents, metadatas)
+
+    def delete(self, ids):
+        self.records.delete(ids)
+
+    def ids(self):
+        return self.records.ids()
+
+    def count(self):
+        return self.records.count()
+
+    def _candidates(self, where, ids=None):
+        mask = self.index.mask(where)
+        if ids is not None:
+            # Like Chroma, ids restrict the rows the where clause selects from.
+            rows = np.zeros(len(self.index), dtype=bool)
+            rows[[self.index.positions[doc_id] for doc_id in ids if doc_id in self.index.positions]] = True
+            mask = rows if mask is None else mask & rows
+        return None if mask is None else np.flatnonzero(mask)
+
+    def search(self, query_embeddings, candidates, n_results):
+        return self.index.search(query_embeddings, candidates, n_results)
+
+    def query(self, query_embeddings, n_results, where=None, include=("documents", "metadatas"), ids=None):
+        matches = self.search(query_embeddings, self._candidates(where, ids), n_results)
+        response = {"ids": [self.index.ids[rows].tolist() for rows, scores in matches],
+                    "distances": [(1 - scores).tolist() for rows, scores in matches]}
+
+        if "documents" in include or "metadatas" in include:
+            looked_up = [self.records.get(ids, "documents" in include, "metadatas" in include) for ids in response["ids"]]
+            if "documents" in include:
+                response["documents"] = [documents for documents, metadatas in looked_up]
+            if "metadatas" in include:
+                response["metadatas"] = [metadatas for documents, metadatas in looked_up]
+
+        return response
+
+    def get(self, ids=None, where=None, include=("documents", "metadatas"), limit=None, offset=None):
+
+        if ids is None:
+            candidates = self._candidates(where)
+            ids = (self.index.ids if candidates is None else self.index.ids[candidates]).tolist()
+            ids = ids[offset or 0:]
+            if limit is not None:
+                ids = ids[:limit]
+        else:
+            # Like Chroma, unknown ids are left out.
+            ids = [doc_id for doc_id in ids if doc_id in self.index.positions]
+
+        response = {"ids": ids}
+        documents, metadatas = self.records.get(ids, "documents" in include, "metadatas" in include)
+        if "documents" in include:
+            response["documents"] = documents
+        if "metadatas" in include:
+            response["metadatas"] = metadatas
+        if "embeddings" in include:
+            response["embeddings"] = self.index.vectors(np.array([self.index.positions[doc_id] for doc_id in ids], dtype=np.int64))
+
+        return response
+
+    def save(self, generation):
+        pass
+
+    def footprint(self):
+        return {"backend": self.name,
+                "vector_dtype": self.index.dtype,
+                "vector_bytes": self.index.nbytes(),
+                "disk_bytes": directory_size(self.index.path) + (os.path.getsize(self.records.path) if self.records else 0)}
+
+
+class IVFBackend(NumpyBackend):
+    """
+    Inverted file ANN index over the columnar index vectors: rows are bucketed by their
+    nearest of nlist spherical k-means centroids and only the nprobe closest buckets
+    are scored. Buckets are rebuilt for every saved generation.
+    """
+
+    name = "ivf"
+
+    def __init__(self, index, records_path, nlist=None, nprobe=8, train_sample=20000, iterations=8, seed=0):
+        super().__init__(index, records_path)
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.train_sample = train_sample
+        self.iterations = iterations
+        self.seed = seed
+
+        self.path = os.path.join(index.path, "ivf.npz")
+        self.generation = None
+        self.centroids = None
+        self.order = None
+        self.offsets = None
+        self.trained_count = 0
+
+    def open(self, embedding_function=None):
+        if os.path.exists(self.path):
+            state = np.load(self.path)
+            self.generation = int(state["generation"])
+            self.centroids = state["centroids"]
+            self.order = state["order"]
+            self.offsets = state["offsets"]
+            self.trained_count = int(state["trained_count"])
+        return self
+
+    def _kmeans(self, vectors, nlist):
+        rng = np.random.default_rng(self.seed)
+        centroids = vectors[rng.choice(len(vectors), nlist, replace=False)]
+
+        for _ in range(self.iterations):
+            assign = np.argmax(vectors @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, vectors)
+            counts = np.bincount(assign, minlength=nlist)
+
+            empty = counts == 0
+            sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()))]
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            centroids = sums / np.where(norms == 0, 1, norms)
+
+        return centroids.astype(np.float32)
+
+    def train(self):
+        total = len(self.index)
+        if total == 0:
+            self.centroids = None
+            return
+
+        nlist = self.nlist or int(min(4096, max(1, 4 * np.sqrt(total))))
+        nlist = min(nlist, total)
+
+        # Centroids are reused while the corpus size stays within 20% of the trained size.
+        reuse = (self.centroids is not None and len(self.centroids) == nlist
+                 and abs(total - self.trained_count) <= 0.2 * self.trained_count)
+
+        if not reuse:
+            rng = np.random.default_rng(self.seed)
+            sample = rng.choice(total, min(total, self.train_sample), replace=False)
+            self.centroids = self._kmeans(self.index.vectors(np.sort(sample)), nlist)
+            self.trained_count = total
+
+        assign = np.concatenate([
+            np.argmax(self.index.vectors(np.arange(start, min(start + SCAN_BLOCK, total))) @ self.centroids.T, axis=1)
+            for start in range(0, total, SCAN_BLOCK)])
+
+        self.order = np.argsort(assign, kind="stable")
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=len(self.centroids)))])
+
+    def save(self, generation):
+        self.train()
+        if self.centroids is None:
+            return
+
+        self.generation = generation
+        tmp_path = self.path + ".tmp.npz"
+        np.savez(tmp_path, generation=generation, centroids=self.centroids, order=self.order,
+                 offsets=self.offsets, trained_count=self.trained_count)
+        os.replace(tmp_path, self.path)
+
+    def search(self, query_embeddings, candidates, n_results):
+
+        if self.centroids is None or self.generation != self.index.generation:
+            return super().search(query_embeddings, candidates, n_results)
+
+        allowed = None
+        if candidates is not None:
+            allowed = np.zeros(len(self.index), dtype=bool)
+            allowed[candidates] = True
+
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        results = []
+
+        for query in queries:
+            closest = np.argsort(-(self.centroids @ query))
+            nprobe = self.nprobe
+
+            # Probe more buckets until enough rows pass the filter.
+            while True:
+                buckets = closest[:nprobe]
+                rows = np.concatenate([self.order[self.offsets[b]:self.offsets[b + 1]] for b in buckets])
+                if allowed is not None:
+                    rows = rows[allowed[rows]]
+                if len(rows) >= n_results or nprobe >= len(self.centroids):
+                    break
+                nprobe *= 2
+
+            results.extend(self.index.search([query], np.sort(rows), n_results))
+
+        return results
+
+    def footprint(self):
+        report = super().footprint()
+        if self.centroids is not None:
+            report["vector_bytes"] += self.centroids.nbytes + self.order.nbytes + self.offsets.nbytes
+        return report
+
+
+def make_backend(name, path, collection_name, index):
+    if name == "chroma":
+        return ChromaBackend(path, collection_name)
+    if name == "numpy":
+        return NumpyBackend(index, os.path.join(path, "records.sqlite"))
+    if name == "ivf":
+        return IVFBackend(index, os.path.join(path, "records.sqlite"))
+    raise ValueError("backend must be one of %s" % BACKENDS)
+
+
+def recall_at_k(backend, reference, query_embeddings, k=10, where=None):
+    """
+    Mean overlap of the top k ids of backend with those of an exact reference backend.
+    """
+
+    found = backend.query(query_embeddings, k, where, include=())["ids"]
+    expected = reference.query(query_embeddings, k, where, include=())["ids"]
+
+    overlaps = [len(set(a) & set(b)) / len(b) for a, b in zip(found, expected) if len(b)]
+    return float(np.mean(overlaps)) if overlaps else None
+
+
+def backend_report(backends, reference, query_embeddings, k=10, where=None):
+    """
+    recall@k against the reference, mean query latency and memory footprint per backend.
+    """
+
+    report = []
+
+    for backend in backends:
+        started = time.perf_counter()
+        for query in query_embeddings:
+            backend.query([query], k, where, include=())
+        latency = (time.perf_counter() - started) / max(len(query_embeddings), 1)
+
+        report.append(dict(backend.footprint(),
+                           recall_at_k=recall_at_k(backend, reference, query_embeddings, k, where),
+                           k=k,
+                           mean_query_ms=round(latency * 1000, 3)))
+
+    return report
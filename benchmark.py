@@ -0,0 +1,222 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import datetime
+import resource
+import subprocess
+
+import numpy as np
+
+from generate_data import generate, TITLES
+
+# Named constraint mixes, each a set of search_for_similar_records style arguments.
+CONSTRAINT_MIXES = {
+    "none": {},
+    "source": {"file_source": "web"},
+    "source_type": {"file_source": "google_drive", "file_extension": "pdf"},
+    "month": {"start_date": "2024-03-01", "end_date": "2024-03-31"},
+    "size": {"file_size": "10"},
+    "all": {"file_source": "avoma", "file_extension": "docx", "file_size": "25",
+            "start_date": "2024-02-01", "end_date": "2024-06-30"},
+}
+
+QUERY_PREFIXES = ["", "notes on ", "latest ", "find the ", "documents about "]
+
+# Metrics where a larger value is better, everything else is a cost.
+HIGHER_IS_BETTER = ("rows_per_second", "recall_at_k")
+
+STARTUP_PROBE = """
+import json, sys, time
+started = time.perf_counter()
+from engine import get_engine, startup_report
+vb = get_engine()
+opened = time.perf_counter()
+vb.send_query(sys.argv[1], n_results=10)
+done = time.perf_counter()
+print(json.dumps(dict(startup_report(), open_seconds=opened - started, first_query_seconds=done - opened, total_seconds=done - started)))
+"""
+
+
+def make_queries(count, seed=0):
+    rng = np.random.default_rng(seed)
+    titles = [title for title, folder, about in TITLES]
+    return [QUERY_PREFIXES[rng.integers(len(QUERY_PREFIXES))] + titles[rng.integers(len(titles))].lower()
+            for _ in range(count)]
+
+
+def mix_constraint(mix):
+    from tools import build_constraint
+
+    start_date = mix.get("start_date")
+    end_date = mix.get("end_date")
+
+    return build_constraint(mix.get("file_source", "any"), mix.get("file_extension", "any"), mix.get("file_size", "any"),
+                            datetime.datetime.strptime(start_date, "%Y-%m-%d").date() if start_date else None,
+                            datetime.datetime.strptime(end_date, "%Y-%m-%d").date() if end_date else None)
+
+
+def percentiles(seconds):
+    ms = np.asarray(seconds) * 1000
+    return {"n": len(ms),
+            "mean_ms": round(float(ms.mean()), 3),
+            "p50_ms": round(float(np.percentile(ms, 50)), 3),
+            "p95_ms": round(float(np.percentile(ms, 95)), 3),
+            "p99_ms": round(float(np.percentile(ms, 99)), 3)}
+
+
+def peak_rss_mb(who):
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS.
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return round(resource.getrusage(who).ru_maxrss / scale, 1)
+
+
+def startup(path, backend, vector_dtype, query):
+    """
+    Time to import, open the index and answer a first query in a fresh process.
+    """
+
+    # The probe runs from the script directory, so a relative workdir is resolved here.
+    env = dict(os.environ, SEARCH_DB_PATH=os.path.abspath(path), SEARCH_BACKEND=backend, SEARCH_VECTOR_DTYPE=vector_dtype)
+    output = subprocess.run([sys.executable, "-c", STARTUP_PROBE, query], env=env, check=True,
+                            capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def run(args):
+
+    from db import VectorDB
+
+    results = {"config": vars(args).copy(), "started_at": datetime.datetime.now().isoformat(timespec="seconds")}
+
+    csv_path = args.csv
+    if csv_path is None:
+        csv_path = os.path.join(args.workdir, "corpus_%d_%d.csv" % (args.rows, args.seed))
+        if not os.path.exists(csv_path):
+            started = time.perf_counter()
+            generate(csv_path, args.rows, args.seed)
+            results["generate_seconds"] = round(time.perf_counter() - started, 3)
+
+    path = os.path.join(args.workdir, "db_%s_%s" % (args.backend, args.vector_dtype))
+    if os.path.exists(path):
+        shutil.rmtree(path)
+
+    vb = VectorDB(None, path=path, backend=args.backend, vector_dtype=args.vector_dtype,
+                  exact_threshold=args.exact_threshold)
+    results["ingest"] = vb.create_db_from_csv(csv_path, chunksize=args.chunksize, batch_size=args.batch_size,
+                                              dedup=args.dedup)
+    # A second run over unchanged data measures the incremental (hash only) path.
+    results["reingest"] = vb.create_db_from_csv(csv_path, chunksize=args.chunksize, batch_size=args.batch_size)
+
+    queries = make_queries(args.queries, args.seed)
+
+    # Cold: first process after ingestion. Warm: the same again, with the OS page cache
+    # warmed by the first and the query's embedding in the on-disk cache. Query processes
+    # open that cache read-only, so it is written here.
+    results["startup"] = {"cold": startup(path, args.backend, args.vector_dtype, queries[0])}
+    vb.embedding_function(queries[:1])
+    vb.embedding_cache.flush()
+    results["startup"]["warm"] = startup(path, args.backend, args.vector_dtype, queries[0])
+
+    # Query embeddings are computed once up front, latencies below measure retrieval.
+    started = time.perf_counter()
+    vb.embedding_function(queries)
+    results["embed_seconds_per_query"] = round((time.perf_counter() - started) / len(queries), 6)
+    # Ingest and query embedding together: texts/sec, batch p50/p99 and padding fill.
+    results["embedder"] = vb.model.info()
+
+    results["queries"] = {}
+    results["recall"] = {}
+
+    for name, mix in CONSTRAINT_MIXES.items():
+        constraint = mix_constraint(mix)
+
+        seconds = []
+        for query in queries:
+            started = time.perf_counter()
+            vb.send_query(query, constraint, n_results=args.k)
+            seconds.append(time.perf_counter() - started)
+
+        results["queries"][name] = percentiles(seconds)
+        results["recall"][name] = vb.backend_report(queries[:args.recall_queries], k=args.k, constraint=constraint)[0]
+
+    results["peak_rss_mb"] = {"benchmark": peak_rss_mb(resource.RUSAGE_SELF),
+                              "startup_probes": peak_rss_mb(resource.RUSAGE_CHILDREN)}
+
+    return results
+
+
+def flatten(results, prefix=""):
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    Metrics that got worse than the baseline by more than tolerance (a fraction).
+    """
+
+    current = flatten(results)
+    regressions = []
+
+    for key, before in flatten(baseline).items():
+        if key.startswith("config.") or key not in current or not before:
+            continue
+        if not (key.endswith(("_ms", "_seconds", "_mb")) or key.endswith(HIGHER_IS_BETTER)):
+            continue
+
+        after = current[key]
+        change = (after - before) / abs(before)
+        if key.endswith(HIGHER_IS_BETTER):
+            change = -change
+
+        if change > tolerance:
+            regressions.append({"metric": key, "baseline": before, "current": after, "change": round(change, 3)})
+
+    return regressions
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="End to end ingest and query benchmark on a synthetic corpus.")
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--csv", default=None, help="benchmark this CSV instead of a generated corpus")
+    parser.add_argument("--workdir", default="benchmark_runs")
+    parser.add_argument("--backend", default="chroma")
+    parser.add_argument("--vector-dtype", default="float32")
+    # 0 sends every query to the selected backend instead of exact search over small filters.
+    parser.add_argument("--exact-threshold", type=int, default=0)
+    parser.add_argument("--chunksize", type=int, default=10000)
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--dedup", type=int, default=None, metavar="DISTANCE",
+                        help="group near-duplicates, compare with a run without it for the effect on latency")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--recall-queries", type=int, default=50)
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--baseline", default=None, help="results JSON of an earlier run to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = run(args)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            results["regressions"] = compare(results, json.load(f), args.tolerance)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    print(json.dumps(results, indent=2))
+
+    if results.get("regressions"):
+        sys.exit(1)
@@ -1,95 +1,550 @@
 import os
-
-import csv
-import chromadb
+import time
+import threading
 
 import pandas as pd
 import numpy as np
 
-from chromadb.utils import embedding_functions
+from chromadb.api.types import EmbeddingFunction
 import google.generativeai as genai
 
+from manifest import IngestManifest, document_ids, CHUNK_SEPARATOR
+from embedding_cache import EmbeddingCache, CachedEmbeddingFunction
+from embedder import Embedder, MODEL_NAME, model_id
+from metadata_index import ColumnarIndex, UnsupportedFilter, aggregate_records, merge_aggregates, summarize
+from lexical_index import LexicalIndex
+from dedup import DedupIndex
+from backends import make_backend, backend_report, NumpyBackend
+from query import decompose_query, fuse_responses
+from ingest import ingest, read_chunks, WRITE_BATCH_SIZE
+from tracing import span
+
 genai.configure(api_key=os.getenv('GEMINI_API_KEY'))
 
+METADATA_COLUMNS = [
+    "author",
+    "source",
+    "file_title",
+    "file_size",
+    "file_type",
+    "file_location_at_source",
+    "file_created_at",
+    "file_last_updated_at",
+    "file_url"
+]
+
+# Numeric copies of the date columns (epoch seconds) so date ranges can be filtered in the store.
+TIMESTAMP_COLUMNS = {
+    "file_created_ts": "file_created_at",
+    "file_updated_ts": "file_last_updated_at"
+}
+
+
+def to_timestamps(values):
+    parsed = pd.to_datetime(values, errors="coerce").fillna(pd.Timestamp(0))
+    return (parsed - pd.Timestamp(0)) // pd.Timedelta(seconds=1)
+
+
+class LazyEmbeddingFunction(EmbeddingFunction):
+    """
+    Loads the embedding engine (see embedder.Embedder) on first use, so opening an
+    index never pays for it.
+    """
+
+    def __init__(self, model_name):
+        self.model_name = model_name
+        self.model = None
+        self.load_seconds = None
+        # The search service routes calls through an EmbeddingBatcher to coalesce sessions.
+        self.batcher = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        if self.model is None:
+            with self._lock:
+                if self.model is None:
+                    started = time.perf_counter()
+                    self.model = Embedder(self.model_name)
+                    self.load_seconds = time.perf_counter() - started
+        return self.model
+
+    def info(self):
+        """
+        Throughput and batch latency of the embedding engine, None until it is loaded.
+        """
+
+        return self.model.info() if self.model is not None and hasattr(self.model, "info") else None
+
+    def __call__(self, input):
+        if self.batcher is not None:
+            return self.batcher.embed(input)
+        return self.load()(input)
+
 
 class VectorDB:
+    """
+    backend selects where vectors and records live: "chroma" (the Chroma collection),
+    "numpy" (exact search) or "ivf" (ANN buckets), the latter two over the columnar index
+    vectors stored as vector_dtype ("float32", "float16" or "int8"). One path holds one backend.
+    Shards of a ShardedVectorDB pass in the model and embedding cache they share.
+    Processes that only answer queries open the embedding cache read_only_cache, so
+    that ingestion stays its only writer.
+    """
     
-    def __init__(self, data):
+    def __init__(self, data, path="my_vectordb", collection_name="my_collection3", model_name=MODEL_NAME, exact_threshold=20000,
+                 backend="chroma", vector_dtype="float32", embedding_cache=None, model=None, read_only_cache=False):
         self.data = data
-        self.collection = None
+        self.path = path
+        self.collection_name = collection_name
+        self.model_name = model_name
+        self.model = model
+        self.embedding_function = None
+        self.embedding_cache = embedding_cache or EmbeddingCache(os.path.join(path, "embedding_cache"), model_id(model_name),
+                                                                 read_only=read_only_cache)
+        # Filters matching at most exact_threshold rows are scored exactly on the columnar index.
+        self.index = ColumnarIndex(os.path.join(path, "columnar_index"), dtype=vector_dtype)
+        self.exact_threshold = exact_threshold
+        self.lexical = LexicalIndex(os.path.join(path, "lexical.sqlite"))
+        self.backend = make_backend(backend, path, collection_name, self.index)
+        self.manifest = IngestManifest(os.path.join(path, "manifest.json"), backend)
+        self.dedup = DedupIndex(os.path.join(path, "dedup.sqlite"))
 
-    def generate_data(self):
+    @property
+    def collection(self):
+        return getattr(self.backend, "collection", None)
 
-        lines = csv.reader(self.data)
-    
-        documents = []
-        metadatas = []
-        ids = []
-        
-        id = 1
-    
-        for i, row in self.data.iterrows():
-            line = row.values
-            metadatas.append(
-                {
-                    "author": line[0], 
-                    "source": line[1],
-                    "file_title": line[2], 
-                    "file_size": line[3], 
-                    "file_type": line[4], 
-                    "file_location_at_source": line[5], 
-                    "file_created_at": line[6], 
-                    "file_last_updated_at": line[7], 
-                    "file_url": line[8]
-                })
-            
-            ids.append(str(id))
-            id+=1
-    
-        documents = self.data["generated_insights"].values.tolist()
+    def generate_data(self, data=None, id_counts=None):
+        """
+        Column-wise view of a DataFrame: ids, documents and a dict of metadata columns.
+        Metadata records are only materialized for the rows that get written.
+        """
+
+        data = self.data if data is None else data
+
+        # Body chunks from extract.py carry their ids, file rows get theirs from the identity columns.
+        ids = data["doc_id"].tolist() if "doc_id" in data.columns else document_ids(data, id_counts)
+        documents = data["generated_insights"].values.tolist()
+        columns = {name: data[name].tolist() for name in METADATA_COLUMNS}
+        columns["file_size"] = pd.to_numeric(data["file_size"], errors="coerce").fillna(0).astype("int64").tolist()
+
+        for name, source_column in TIMESTAMP_COLUMNS.items():
+            columns[name] = to_timestamps(data[source_column]).tolist()
                 
-        return ids, documents, metadatas
-        
-    def create_db(self):
-        
-        ids, documents, metadatas = self.generate_data()
-        chroma_client = chromadb.PersistentClient(path="my_vectordb")
-        
-        sentence_transformer_ef = embedding_functions.SentenceTransformerEmbeddingFunction(model_name="all-mpnet-base-v2")
-        collection = chroma_client.get_or_create_collection(name="my_collection3", embedding_function=sentence_transformer_ef)
-        
-        collection.add(
-            documents=documents,
-            metadatas=metadatas,
-            ids=ids
-        )
-        
-        self.collection = collection
-
-    def send_query(self, query_text, constraint=None):
-
-        query_texts = [query_text]
-
-        if 'and' in query_text.lower():
-            query_texts = query_text.lower().split("and")
-
-        if 'or' in query_text.lower():
-            query_texts = query_text.lower().split("or")
-
-        if constraint != None:
-
-            query_response = self.collection.query(query_texts=query_texts, 
-            n_results=10, include=['documents', 'embeddings', 'metadatas'])
-
-        else:
-
-            query_response = self.collection.query(query_texts=query_texts,
-            n_results=10,
-            where=constraint
-            , include=['documents', 'embeddings', 'metadatas'])
-            
+        return ids, documents, columns
+
+    def metadata_records(self, columns, positions):
+        names = list(columns)
+        values = [columns[name] for name in names]
+        return [dict(zip(names, [column[i] for column in values])) for i in positions]
+
+    def open_db(self):
+        """
+        Opens the persisted backend and indexes without reading any data or loading the model.
+        """
+
+        if self.embedding_function is None:
+            started = time.perf_counter()
+
+            # Ingestion and queries embed through the cache and hand vectors to the backend.
+            if self.model is None:
+                self.model = LazyEmbeddingFunction(self.model_name)
+            self.embedding_function = CachedEmbeddingFunction(self.model, self.embedding_cache)
+            self.backend.open()
+            self.index.load()
+            self.manifest.generation = self.manifest.peek_generation()
+
+            self.open_seconds = time.perf_counter() - started
+
+        return self.backend
+
+    def refresh(self):
+        """
+        Picks up a generation saved by a separate ingest run, reloading the columnar index
+        and backend state, and returns the current generation.
+        """
+
+        generation = self.manifest.peek_generation()
+
+        if generation != self.manifest.generation:
+            self.index.load()
+            self.backend.open()
+            self.manifest.generation = generation
+
+        return generation
+
+    def rebuild_indexes(self, columnar=True, lexical=True, page_size=WRITE_BATCH_SIZE):
+        """
+        Rebuilds the columnar and/or lexical index from what is already in the backend,
+        without re-embedding anything. The columnar index can only be rebuilt from a
+        backend that stores its own vectors.
+        """
+
+        if columnar:
+            self.index.clear()
+        if lexical:
+            self.lexical.clear()
+
+        include = ["metadatas"] + (["embeddings"] if columnar else []) + (["documents"] if lexical else [])
+        offset = 0
+
+        while True:
+            page = self.backend.get(include=include, limit=page_size, offset=offset)
+            if len(page["ids"]) == 0:
+                break
+            if columnar:
+                self.index.upsert(page["ids"], page["embeddings"], page["metadatas"])
+            if lexical:
+                self.lexical.upsert(page["ids"], page["documents"], page["metadatas"])
+            offset += len(page["ids"])
+
+        self.index.compact()
+
+    def create_db(self, batch_size=256):
+        """
+        Incrementally syncs the store with self.data. Only new or changed rows
+        are embedded and upserted, rows missing from the data are deleted.
+        """
+
+        self.open_db()
+        return ingest(self, [self.data], batch_size=batch_size)
+
+    def create_db_from_csv(self, csv_path, chunksize=10000, batch_size=256, rebuild=False, content_dir=None, workers=None, dedup=None):
+        """
+        Streaming variant of create_db that reads the CSV in chunks of chunksize rows,
+        so memory stays flat regardless of the corpus size. With content_dir, the bodies
+        of the files mirrored there are chunked and indexed too (see extract.with_content).
+        """
+
+        self.open_db()
+        chunks = read_chunks(csv_path, chunksize)
+        if content_dir:
+            from extract import with_content
+            chunks = with_content(chunks, content_dir, os.path.join(self.path, "extracted"), workers)
+        return ingest(self, chunks, batch_size=batch_size, rebuild=rebuild, dedup=dedup)
+
+    def send_query(self, query_text, constraint=None, n_results=10, include=("metadatas", "documents")):
+        """
+        Embeds every sub-query of query_text in one batch, searches them all, adds a BM25
+        ranking of the full query and returns a single fused, deduplicated ranking in
+        Chroma's response format. An exact title match is answered without embedding.
+        Only the fields in include are fetched, ids and scores are always returned.
+        """
+
+        with span("send_query", n_results=n_results):
+            query_response = self.rankings(query_text, constraint, n_results, include=include)
+
+            with span("fuse"):
+                return fuse_responses(query_response, limit=n_results)
+
+    def rankings(self, query_text, constraint=None, n_results=10, embed=None, include=("metadatas", "documents")):
+        """
+        The unfused ranked lists behind send_query, in Chroma's query format: one vector
+        list per sub-query, then a BM25 list, or a lone list of exact title matches,
+        newest first, with their "timestamps".
+        "kinds" names each list ("title", "vector" or "lexical") and "scores" holds the
+        BM25 scores of the lexical list. embed(query_texts) replaces the embedding function.
+        """
+
+        query_texts = decompose_query(query_text)
+        allowed = self.allowed_ids(constraint)
+        lexical = allowed is not False and self.lexical.generation == self.manifest.generation
+
+        if lexical and len(query_texts) == 1:
+            query_response = self.title_hits(query_text, allowed, n_results, include)
+            if query_response is not None:
+                return query_response
+
+        with span("embed", texts=len(query_texts)):
+            query_embeddings = (embed or self.embedding_function)(query_texts)
+
+        with span("plan") as plan_span:
+            candidates = self.plan(constraint)
+            plan_span.set(exact=candidates is not False)
+
+        with span("vector_search"):
+            if candidates is not False:
+                query_response = self.exact_query(query_embeddings, candidates, n_results, include)
+            else:
+                query_response = self.ann_query(query_embeddings, n_results, constraint, include)
+
+        query_response["kinds"] = ["vector"] * len(query_texts)
+        query_response["scores"] = [None] * len(query_texts)
+
+        if lexical:
+            with span("lexical_search"):
+                hits = self.lexical.search(query_text, n_results, allowed)
+                if hits:
+                    lexical_response = self.fetch_response([[doc_id for doc_id, score in hits]], include)
+                    for key in ["ids"] + list(include):
+                        query_response[key] = list(query_response[key]) + lexical_response[key]
+                    query_response["distances"] = list(query_response["distances"]) + [None]
+                    query_response["kinds"].append("lexical")
+                    query_response["scores"].append([score for doc_id, score in hits])
+
+        return query_response
+
+    def title_hits(self, query_text, allowed, n_results, include, field="file_created_ts"):
+        """
+        The documents whose title is exactly query_text and allowed(doc_id), newest first
+        on field, in Chroma's query format with their "timestamps". None without such hits.
+        """
+
+        with span("title_match"):
+            title_hits = [doc_id for doc_id in self.lexical.title_matches(query_text) if allowed(doc_id)]
+            if not title_hits:
+                return None
+
+            # Every hit matches the title equally, the newest are kept when there are more than n_results.
+            created, _ = self.timestamps(title_hits, field)
+            order = np.argsort(-created, kind="stable")[:n_results]
+            query_response = self.fetch_response([[title_hits[i] for i in order]], include)
+            query_response["kinds"] = ["title"]
+            query_response["timestamps"] = [created[order].tolist()]
+            return query_response
+
+    def mask(self, constraint):
+        """
+        ColumnarIndex.mask of the constraint, plus the representatives of the groups with
+        a member satisfying it. Raises UnsupportedFilter like the index.
+        """
+
+        mask = self.index.mask(constraint)
+        if mask is None or not self.dedup.enabled:
+            return mask
+
+        rows = [self.index.positions[group_id] for group_id in self.dedup.matching(constraint) if group_id in self.index.positions]
+        if rows:
+            mask = mask.copy()
+            mask[rows] = True
+        return mask
+
+    def ann_query(self, query_embeddings, n_results, constraint, include):
+        """
+        backend.query with the constraint. Representatives failing it whose group has a
+        member satisfying it are searched apart and merged in by distance.
+        """
+
+        response = self.backend.query(query_embeddings, n_results, self.index.rewrite(constraint), include=include)
+        extra = list(self.dedup.matching(constraint)) if constraint and self.dedup.enabled else []
+        if not extra:
+            return response
+
+        grouped = self.backend.query(query_embeddings, n_results, include=include, ids=extra)
+        merged = {key: [] for key in ["ids", "distances"] + list(include)}
+        for q in range(len(response["ids"])):
+            hits = {}
+            for part in (response, grouped):
+                for i, doc_id in enumerate(part["ids"][q]):
+                    hits.setdefault(doc_id, (part["distances"][q][i], part, i))
+            best = sorted(hits.items(), key=lambda item: item[1][0])[:n_results]
+            merged["ids"].append([doc_id for doc_id, hit in best])
+            for key in ["distances"] + list(include):
+                merged[key].append([part[key][q][i] for doc_id, (distance, part, i) in best])
+        return merged
+
+    def allowed_ids(self, constraint):
+        """
+        Predicate telling whether a document id satisfies the constraint, evaluated on the
+        columnar index. False when the index cannot evaluate it.
+        """
+
+        if self.index.generation != self.manifest.generation:
+            return False
+
+        try:
+            mask = self.mask(constraint)
+        except UnsupportedFilter:
+            return False
+
+        positions = self.index.positions
+        if mask is None:
+            return lambda doc_id: doc_id in positions
+
+        return lambda doc_id: doc_id in positions and bool(mask[positions[doc_id]])
+
+    def records(self, ids, include=("metadatas",)):
+        """
+        The fields in include of the given ids, as {field: {doc_id: value}}. Unknown ids are left out.
+        """
+
+        fetched = self.backend.get(ids=list(ids), include=list(include)) if len(ids) and include else {"ids": []}
+        return {field: dict(zip(fetched["ids"], fetched[field])) for field in include}
+
+    def members(self, ids):
+        """
+        {doc_id: [(member id, metadata), ...]} of the ids that represent a group of near-duplicates.
+        """
+
+        return self.dedup.members(ids) if self.dedup.enabled and len(ids) else {}
+
+    def fetch_response(self, ids, include=("metadatas", "documents")):
+        """
+        Looks up the fields in include for nested id lists, in Chroma's query format.
+        """
+
+        records = self.records(sorted(set(doc_id for query_ids in ids for doc_id in query_ids)), include)
+
+        response = {"ids": ids, "distances": [None for query_ids in ids]}
+        for field in include:
+            response[field] = [[records[field][doc_id] for doc_id in query_ids] for query_ids in ids]
+
+        return response
+
+    def plan(self, constraint):
+        """
+        Picks exact scoring over the columnar index when the constraint is selective
+        enough. Returns the candidate rows (None for all rows), or False to use ANN search.
+        """
+
+        if len(self.index) == 0 or self.index.generation != self.manifest.generation:
+            return False
+
+        try:
+            if self.index.estimate(constraint) > 2 * self.exact_threshold:
+                return False
+            mask = self.mask(constraint)
+        except UnsupportedFilter:
+            return False
+
+        if mask is None:
+            return None if len(self.index) <= self.exact_threshold else False
+
+        candidates = np.flatnonzero(mask)
+        return candidates if len(candidates) <= self.exact_threshold else False
+
+    def exact_query(self, query_embeddings, candidates, n_results, include=("metadatas", "documents")):
+        """
+        Brute force cosine scoring of the candidate rows, answered in Chroma's query format.
+        """
+
+        matches = self.index.search(query_embeddings, candidates, n_results)
+
+        query_response = self.fetch_response([self.index.ids[rows].tolist() for rows, scores in matches], include)
+        query_response["distances"] = [(1 - scores).tolist() for rows, scores in matches]
+
         return query_response
 
+    def best_score(self, query_text, constraint=None, embed=None):
+        """
+        Best similarity of query_text among its top hits, rescored on the columnar index
+        whatever the backend's distance space. None without hits.
+        embed(query_texts) replaces the embedding function.
+        """
+
+        if len(self.index) == 0 or self.index.generation != self.manifest.generation:
+            return None
+
+        query_embeddings = (embed or self.embedding_function)(decompose_query(query_text))
+
+        candidates = self.plan(constraint)
+        if candidates is False:
+            top = self.ann_query(query_embeddings, 1, constraint, include=())["ids"]
+            candidates = np.array(sorted(set(self.index.positions[doc_id] for ids in top for doc_id in ids)), dtype=np.int64)
+        best = [scores[0] for rows, scores in self.index.search(query_embeddings, candidates, 1) if len(scores)]
+
+        return max(best) if best else None
+
+    def latest(self, query_text, constraint=None, n_results=1, field="file_created_ts", margin=0.1, include=("metadatas",),
+               embed=None, threshold=None):
+        """
+        The n_results newest documents matching query_text, found by walking the columnar
+        index newest first. A row matches when its similarity is within margin of the best
+        hit of the query, or reaches threshold when given. Exact title matches come first:
+        when there are any, they are the answer, as in rankings. Returns a send_query style
+        response plus the "timestamps" of the hits, or None when the index cannot evaluate
+        the constraint.
+        embed(query_texts) replaces the embedding function.
+        """
+
+        if len(self.index) == 0 or self.index.generation != self.manifest.generation:
+            return None
+
+        try:
+            mask = self.mask(constraint)
+        except UnsupportedFilter:
+            return None
+
+        with span("latest", n_results=n_results):
+            if self.lexical.generation == self.manifest.generation and len(decompose_query(query_text)) == 1:
+                response = self.title_hits(query_text, self.allowed_ids(constraint), n_results, include, field)
+                if response is not None:
+                    response["scores"] = [[1.0] * len(response["ids"][0])]
+                    return response
+
+            embed = embed or self.embedding_function
+            if threshold is None:
+                best = self.best_score(query_text, constraint, embed)
+                threshold = None if best is None else best - margin
+
+            if threshold is None:
+                rows, scores = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+            else:
+                rows, scores = self.index.latest(embed(decompose_query(query_text)), mask, n_results, threshold, field)
+
+            response = self.fetch_response([self.index.ids[rows].tolist()], include)
+            response["scores"] = [scores.tolist()]
+            response["timestamps"] = [self.index.numeric[field][rows].tolist()]
+
+            return response
+
+    def timestamps(self, ids, field="file_created_ts"):
+        """
+        Timestamps of the given ids from the columnar index (0 for unknown ids) and the
+        newest timestamp in the index.
+        """
+
+        column = self.index.numeric[field]
+        rows = np.array([self.index.positions.get(doc_id, -1) for doc_id in ids], dtype=np.int64)
+        values = np.where(rows >= 0, column[np.maximum(rows, 0)] if len(column) else 0, 0)
+
+        return values, int(column.max()) if len(column) else 0
+
+    def aggregate_groups(self, constraint=None, group_by=None, depth=1):
+        """
+        ColumnarIndex.aggregate over the files of this store, plus the near-duplicates
+        grouped away by dedup that satisfy the constraint themselves. Falls back to reading
+        the matching metadata from the backend when the columnar index is stale or cannot
+        evaluate the constraint.
+        """
+
+        try:
+            if self.index.generation != self.manifest.generation:
+                raise UnsupportedFilter("stale columnar index")
+            groups = self.index.aggregate(constraint, group_by, depth)
+        except UnsupportedFilter:
+            found = self.backend.get(include=["metadatas"], where=self.index.rewrite(constraint))
+            groups = aggregate_records([metadata for doc_id, metadata in zip(found["ids"], found["metadatas"])
+                                        if CHUNK_SEPARATOR not in doc_id], group_by, depth)
+
+        if self.dedup.enabled:
+            members = [metadata for group in self.dedup.matching(constraint).values()
+                       for doc_id, metadata in group if CHUNK_SEPARATOR not in doc_id]
+            groups = merge_aggregates([groups, aggregate_records(members, group_by, depth)])
+
+        return groups
+
+    def aggregate(self, constraint=None, group_by=None, depth=1, limit=20):
+        """
+        Number of files matching the constraint and the sum, min and max of their
+        file_size, in total and for the limit largest group_by groups ("source",
+        "file_type", "month" or "location", folders cut to depth levels).
+        """
+
+        with span("aggregate", group_by=group_by):
+            return summarize(self.aggregate_groups(constraint, group_by, depth), limit)
+
+    def count(self):
+        return self.backend.count()
+
+    def backend_report(self, query_texts, k=10, constraint=None):
+        """
+        recall@k of the configured backend against exact search over the columnar index,
+        with its latency and memory footprint.
+        """
+
+        reference = NumpyBackend(self.index, None)
+        return backend_report([self.backend], reference, self.embedding_function(query_texts), k, constraint)
+
     def send_query_with_constraint(self, query_text, contraint, n_results=1):
         results = self.collection.query(
         query_texts=[query_text],
@@ -98,9 +553,12 @@ class VectorDB:
 
         return results
 
+    def cache_info(self):
+        return self.embedding_cache.info()
+
     def get_all(self, contraint):
 
-        results = self.collection.get(
+        results = self.backend.get(
             include=["metadatas"],
             where=contraint)
 
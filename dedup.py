@@ -0,0 +1,361 @@
+import os
+import re
+import json
+import sqlite3
+import hashlib
+import operator
+import threading
+
+import numpy as np
+
+from lexical_index import tokenize
+from metadata_index import CATEGORICAL_FIELDS
+
+# Default Hamming distance between 64 bit SimHashes of near-duplicate insights. Distinct
+# files of one folder in file_info_1.csv are at least 10 bits apart.
+MAX_DISTANCE = 9
+
+# Where clauses whose matching members are kept between calls.
+MATCHING_CACHE_SIZE = 256
+
+# Bumped whenever group_key changes, groups made with an older key are rebuilt by ingestion.
+KEY_VERSION = 3
+
+DIGITS = re.compile(r"\d+")
+
+OPERATORS = {
+    "$eq": operator.eq,
+    "$ne": operator.ne,
+    "$gt": operator.gt,
+    "$gte": operator.ge,
+    "$lt": operator.lt,
+    "$lte": operator.le,
+    "$in": lambda value, operand: value in operand,
+    "$nin": lambda value, operand: value not in operand,
+    "$prefix": lambda value, operand: str(value).startswith(operand),
+}
+
+
+def simhash(text):
+    """
+    64 bit SimHash over the word pairs of text. Numbers are masked, so texts that only
+    differ in a size or a date hash alike.
+    """
+
+    tokens = tokenize(DIGITS.sub("0", str(text)))
+    shingles = [" ".join(pair) for pair in zip(tokens, tokens[1:])] or tokens
+    if not shingles:
+        return 0
+
+    hashes = np.array([int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "little")
+                       for shingle in shingles], dtype=np.uint64)
+    bits = (hashes[:, None] >> np.arange(64, dtype=np.uint64)) & np.uint64(1)
+    votes = bits.sum(axis=0).astype(np.int64) * 2 - len(shingles)
+
+    return sum(1 << i for i in np.flatnonzero(votes > 0).tolist())
+
+
+def distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+def signed(value):
+    # SQLite integers are signed 64 bit.
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def group_key(metadata):
+    """
+    Rows are only grouped with rows of the same source, file type and folder. Sizes and
+    dates may differ within a group, so constraints are checked on every member (see
+    matches) rather than on the representative alone.
+    """
+
+    return "\x1f".join(str(metadata.get(field, "")) for field in CATEGORICAL_FIELDS)
+
+
+def matches(metadata, where):
+    """
+    Whether a metadata record satisfies a Chroma where clause.
+    """
+
+    if not where:
+        return True
+    if "$and" in where:
+        return all(matches(metadata, clause) for clause in where["$and"])
+    if "$or" in where:
+        return any(matches(metadata, clause) for clause in where["$or"])
+
+    for field, condition in where.items():
+        value = metadata.get(field)
+        if not isinstance(condition, dict):
+            condition = {"$eq": condition}
+        for op, operand in condition.items():
+            if value is None or not OPERATORS[op](value, operand):
+                return False
+
+    return True
+
+
+class DedupIndex:
+    """
+    Near-duplicate groups of a store (sqlite). The first row of a group is its
+    representative and the only one embedded and written to the store, the others are
+    kept here with their metadata and returned with it at result time. Representatives
+    are found by SimHash, split into max_distance + 1 bands so that any row within
+    max_distance bits shares at least one band with its representative.
+
+    Members may differ from their representative in size and dates, so constraints are
+    evaluated on each member's own metadata (see matching).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn = None
+        self._max_distance = None
+        # Metadata of every member and the data_version it was read at.
+        self._records = None
+        self._records_version = None
+        self._matching = {}
+
+    @property
+    def enabled(self):
+        return os.path.exists(self.path)
+
+    def connect(self):
+
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS groups (group_id TEXT PRIMARY KEY, key TEXT, simhash INTEGER);
+                CREATE TABLE IF NOT EXISTS bands (key TEXT, band INTEGER, value INTEGER, group_id TEXT);
+                CREATE INDEX IF NOT EXISTS bands_value ON bands (key, band, value);
+                CREATE INDEX IF NOT EXISTS bands_group ON bands (group_id);
+                CREATE TABLE IF NOT EXISTS members (doc_id TEXT PRIMARY KEY, group_id TEXT, simhash INTEGER, document TEXT, metadata TEXT);
+                CREATE INDEX IF NOT EXISTS members_group ON members (group_id);
+                CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value INTEGER);
+            """)
+
+        return self._conn
+
+    @property
+    def max_distance(self):
+        if self._max_distance is None and self.enabled:
+            with self._lock:
+                row = self.connect().execute("SELECT value FROM settings WHERE key = 'max_distance'").fetchone()
+                self._max_distance = MAX_DISTANCE if row is None else row[0]
+        return self._max_distance
+
+    @property
+    def outdated(self):
+        """
+        Whether the groups were made with an older group_key.
+        """
+
+        with self._lock:
+            row = self.connect().execute("SELECT value FROM settings WHERE key = 'key_version'").fetchone()
+        return (1 if row is None else row[0]) != KEY_VERSION
+
+    def configure(self, max_distance):
+        """
+        Enables grouping for this store and drops any groups made with other settings.
+        """
+
+        with self._lock:
+            conn = self.connect()
+            conn.executescript("DELETE FROM groups; DELETE FROM bands; DELETE FROM members;")
+            conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('max_distance', ?)", (max_distance,))
+            conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('key_version', ?)", (KEY_VERSION,))
+            conn.commit()
+            self._max_distance = max_distance
+            self._records = None
+
+    def clear(self):
+        with self._lock:
+            conn = self.connect()
+            conn.executescript("DELETE FROM groups; DELETE FROM bands; DELETE FROM members;")
+            conn.commit()
+            self._records = None
+
+    def drop(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(self.path + suffix):
+                    os.remove(self.path + suffix)
+            self._max_distance = None
+            self._records = None
+
+    def bands(self, fingerprint):
+        count = self.max_distance + 1
+        width = 64 // count
+        return [(band, (fingerprint >> (band * width)) & ((1 << width) - 1)) for band in range(count)]
+
+    def _find(self, key, fingerprint):
+        conn = self.connect()
+        best, best_distance = None, self.max_distance + 1
+
+        for band, value in self.bands(fingerprint):
+            for group_id, group_hash in conn.execute(
+                    "SELECT b.group_id, g.simhash FROM bands b JOIN groups g ON g.group_id = b.group_id "
+                    "WHERE b.key = ? AND b.band = ? AND b.value = ?", (key, band, value)):
+                d = distance(fingerprint, group_hash % (1 << 64))
+                if d < best_distance:
+                    best, best_distance = group_id, d
+
+        return best
+
+    def _add_group(self, group_id, key, fingerprint):
+        conn = self.connect()
+        conn.execute("INSERT OR REPLACE INTO groups (group_id, key, simhash) VALUES (?, ?, ?)", (group_id, key, signed(fingerprint)))
+        conn.executemany("INSERT INTO bands (key, band, value, group_id) VALUES (?, ?, ?, ?)",
+                         [(key, band, value, group_id) for band, value in self.bands(fingerprint)])
+
+    def assign(self, ids, documents, metadatas):
+        """
+        Puts each row into the group of its nearest representative, or makes it the
+        representative of a new group. Returns the group id of every row, which is the
+        row's own id for representatives.
+        """
+
+        group_ids = []
+
+        with self._lock:
+            conn = self.connect()
+
+            for doc_id, document, metadata in zip(ids, documents, metadatas):
+                key = group_key(metadata)
+                fingerprint = simhash(document)
+                group_id = self._find(key, fingerprint)
+
+                if group_id is None:
+                    self._add_group(doc_id, key, fingerprint)
+                    group_ids.append(doc_id)
+                else:
+                    conn.execute("INSERT OR REPLACE INTO members (doc_id, group_id, simhash, document, metadata) VALUES (?, ?, ?, ?, ?)",
+                                 (doc_id, group_id, signed(fingerprint), document, json.dumps(metadata)))
+                    group_ids.append(group_id)
+
+            conn.commit()
+            self._records = None
+
+        return group_ids
+
+    def remove(self, ids):
+        """
+        Takes rows out of their groups. A group losing its representative is taken over
+        by its first member, returned as (doc_id, document, metadata) so that it can be
+        embedded and written to the store in its place.
+        """
+
+        promoted = {}
+
+        with self._lock:
+            conn = self.connect()
+
+            for doc_id in ids:
+                promoted.pop(doc_id, None)
+                conn.execute("DELETE FROM members WHERE doc_id = ?", (doc_id,))
+
+                group = conn.execute("SELECT key FROM groups WHERE group_id = ?", (doc_id,)).fetchone()
+                if group is None:
+                    continue
+
+                conn.execute("DELETE FROM groups WHERE group_id = ?", (doc_id,))
+                conn.execute("DELETE FROM bands WHERE group_id = ?", (doc_id,))
+
+                member = conn.execute("SELECT doc_id, simhash, document, metadata FROM members WHERE group_id = ? "
+                                      "ORDER BY doc_id LIMIT 1", (doc_id,)).fetchone()
+                if member is None:
+                    continue
+
+                member_id, fingerprint, document, metadata = member
+                conn.execute("DELETE FROM members WHERE doc_id = ?", (member_id,))
+                conn.execute("UPDATE members SET group_id = ? WHERE group_id = ?", (member_id, doc_id))
+                self._add_group(member_id, group[0], fingerprint % (1 << 64))
+                promoted[member_id] = (document, json.loads(metadata))
+
+            conn.commit()
+            self._records = None
+
+        return [(doc_id, document, metadata) for doc_id, (document, metadata) in promoted.items()]
+
+    def is_group(self, doc_id):
+        with self._lock:
+            return self.connect().execute("SELECT 1 FROM groups WHERE group_id = ?", (doc_id,)).fetchone() is not None
+
+    def members(self, group_ids):
+        """
+        {group id: [(doc_id, metadata), ...]} for the groups with members among group_ids.
+        """
+
+        found = {}
+        group_ids = list(group_ids)
+
+        with self._lock:
+            conn = self.connect()
+            for start in range(0, len(group_ids), 500):
+                page = group_ids[start:start + 500]
+                rows = conn.execute("SELECT group_id, doc_id, metadata FROM members WHERE group_id IN (%s) ORDER BY doc_id"
+                                    % ",".join("?" * len(page)), page)
+                for group_id, doc_id, metadata in rows:
+                    found.setdefault(group_id, []).append((doc_id, json.loads(metadata)))
+
+        return found
+
+    def member_records(self):
+        """
+        [(group id, doc_id, metadata), ...] of every member, read again only after
+        this or another process changed the groups.
+        """
+
+        with self._lock:
+            conn = self.connect()
+            # data_version moves with commits of other connections, ours reset _records.
+            version = conn.execute("PRAGMA data_version").fetchone()[0]
+            if self._records is None or version != self._records_version:
+                self._records = [(group_id, doc_id, json.loads(metadata)) for group_id, doc_id, metadata in
+                                 conn.execute("SELECT group_id, doc_id, metadata FROM members ORDER BY doc_id")]
+                self._records_version = version
+                self._matching = {}
+            return self._records
+
+    def matching(self, where):
+        """
+        {group id: [(doc_id, metadata), ...]} of the members satisfying where.
+        """
+
+        key = json.dumps(where, sort_keys=True, default=str)
+
+        with self._lock:
+            records = self.member_records()
+            if key not in self._matching:
+                if len(self._matching) >= MATCHING_CACHE_SIZE:
+                    self._matching = {}
+                found = {}
+                for group_id, doc_id, metadata in records:
+                    if matches(metadata, where):
+                        found.setdefault(group_id, []).append((doc_id, metadata))
+                self._matching[key] = found
+            return self._matching[key]
+
+    def info(self):
+        """
+        Files, vector entries (group representatives) and their ratio.
+        """
+
+        with self._lock:
+            conn = self.connect()
+            groups = conn.execute("SELECT COUNT(*) FROM groups").fetchone()[0]
+            members = conn.execute("SELECT COUNT(*) FROM members").fetchone()[0]
+
+        return {"max_distance": self.max_distance,
+                "files": groups + members,
+                "entries": groups,
+                "grouped_files": members,
+                "compression_ratio": round((groups + members) / groups, 3) if groups else None}
@@ -0,0 +1,191 @@
+import os
+import sys
+import time
+import atexit
+import threading
+import collections
+import multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+MODEL_NAME = os.getenv("SEARCH_EMBED_MODEL", "all-mpnet-base-v2")
+# Inference runtime of sentence-transformers: torch, onnx or openvino.
+BACKEND = os.getenv("SEARCH_EMBED_BACKEND", "torch")
+# Exported model file for the onnx/openvino runtimes, e.g. onnx/model_qint8_avx512.onnx.
+MODEL_FILE = os.getenv("SEARCH_EMBED_MODEL_FILE") or None
+# "int8" applies dynamic int8 quantization to the linear layers of a torch model.
+QUANTIZE = os.getenv("SEARCH_EMBED_QUANTIZE", "none")
+BATCH_SIZE = int(os.getenv("SEARCH_EMBED_BATCH_SIZE", "32"))
+# Worker processes, 0 embeds in the calling process.
+WORKERS = int(os.getenv("SEARCH_EMBED_WORKERS", "0"))
+# Intra-op threads per process, 0 splits the CPUs between the workers (all of them in-process).
+THREADS = int(os.getenv("SEARCH_EMBED_THREADS", "0"))
+# Tokens kept per text, 0 keeps the model's own limit.
+MAX_SEQ_LENGTH = int(os.getenv("SEARCH_EMBED_MAX_SEQ_LENGTH", "0"))
+
+# Batches kept for the latency percentiles.
+STATS_WINDOW = 10000
+
+_worker_model = None
+
+
+def model_id(model_name=MODEL_NAME, backend=BACKEND, model_file=MODEL_FILE, quantize=QUANTIZE):
+    """
+    Name of the model variant, so that cached vectors of different variants never mix.
+    """
+
+    name = model_name
+    if backend != "torch":
+        name += "@" + backend + (":" + model_file if model_file else "")
+    if quantize != "none":
+        name += "+" + quantize
+    return name
+
+
+def pin_threads(threads):
+    # Set before torch or onnxruntime create their thread pools.
+    for variable in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+        os.environ[variable] = str(threads)
+    if "torch" in sys.modules:
+        sys.modules["torch"].set_num_threads(threads)
+
+
+def load_model(model_name, backend="torch", model_file=None, quantize="none", max_seq_length=0):
+    from sentence_transformers import SentenceTransformer
+
+    options = {"device": "cpu"}
+    if backend != "torch":
+        options["backend"] = backend
+        if model_file:
+            options["model_kwargs"] = {"file_name": model_file}
+
+    model = SentenceTransformer(model_name, **options)
+
+    if quantize == "int8":
+        if backend != "torch":
+            raise ValueError("int8 quantization applies to the torch backend, use a quantized model file for %s" % backend)
+        import torch
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    elif quantize != "none":
+        raise ValueError("quantize must be none or int8")
+
+    if max_seq_length:
+        model.max_seq_length = max_seq_length
+
+    return model
+
+
+def encode(model, texts):
+    return model.encode(texts, batch_size=len(texts), convert_to_numpy=True, show_progress_bar=False).astype(np.float32)
+
+
+def init_worker(threads, options):
+    global _worker_model
+    pin_threads(threads)
+    _worker_model = load_model(**options)
+
+
+def encode_in_worker(texts):
+    started = time.perf_counter()
+    vectors = encode(_worker_model, texts)
+    return vectors, time.perf_counter() - started
+
+
+def length_batches(texts, batch_size):
+    """
+    Positions of texts grouped into batches of similar length, so that each batch is
+    padded to a length close to that of its texts. Length in characters stands in
+    for length in tokens.
+    """
+
+    order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+    return [order[start:start + batch_size] for start in range(0, len(order), batch_size)]
+
+
+class Embedder:
+    """
+    Sentence transformer on the CPU. Inputs are split into length-bucketed batches of
+    batch_size, encoded in the calling process or spread over workers processes, each
+    with threads intra-op threads. Keeps texts/sec, per batch latency percentiles and
+    padding statistics, see info().
+    """
+
+    def __init__(self, model_name=MODEL_NAME, backend=BACKEND, model_file=MODEL_FILE, quantize=QUANTIZE,
+                 batch_size=BATCH_SIZE, workers=WORKERS, threads=THREADS, max_seq_length=MAX_SEQ_LENGTH):
+        self.name = model_id(model_name, backend, model_file, quantize)
+        self.batch_size = batch_size
+        self.workers = workers
+        self.threads = threads or max((os.cpu_count() or 1) // max(workers, 1), 1)
+
+        self.stats = {"calls": 0, "texts": 0, "batches": 0, "seconds": 0.0, "chars": 0, "padded_chars": 0}
+        self.batch_seconds = collections.deque(maxlen=STATS_WINDOW)
+        self._lock = threading.Lock()
+
+        options = {"model_name": model_name, "backend": backend, "model_file": model_file,
+                   "quantize": quantize, "max_seq_length": max_seq_length}
+
+        if workers:
+            self.model = None
+            self.pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                            initializer=init_worker, initargs=(self.threads, options))
+            atexit.register(self.close)
+            # Loads the model in every worker now, so load errors and time show up here.
+            for future in [self.pool.submit(encode_in_worker, ["warm up"]) for _ in range(workers)]:
+                future.result()
+        else:
+            pin_threads(self.threads)
+            self.model = load_model(**options)
+            self.pool = None
+
+    def __call__(self, input):
+        texts = list(input)
+        vectors = [None] * len(texts)
+        batches = length_batches(texts, self.batch_size)
+        started = time.perf_counter()
+
+        if self.pool is not None:
+            futures = [self.pool.submit(encode_in_worker, [texts[i] for i in batch]) for batch in batches]
+            results = [future.result() for future in futures]
+        else:
+            results = []
+            for batch in batches:
+                batch_started = time.perf_counter()
+                results.append((encode(self.model, [texts[i] for i in batch]), time.perf_counter() - batch_started))
+
+        for batch, (batch_vectors, seconds) in zip(batches, results):
+            for i, vector in zip(batch, batch_vectors):
+                vectors[i] = vector
+
+        with self._lock:
+            self.stats["calls"] += 1
+            self.stats["texts"] += len(texts)
+            self.stats["batches"] += len(batches)
+            self.stats["seconds"] += time.perf_counter() - started
+            for batch, (batch_vectors, seconds) in zip(batches, results):
+                lengths = [len(texts[i]) for i in batch]
+                self.stats["chars"] += sum(lengths)
+                self.stats["padded_chars"] += max(lengths) * len(lengths)
+                self.batch_seconds.append(seconds)
+
+        return vectors
+
+    def info(self):
+        with self._lock:
+            seconds = np.array(self.batch_seconds) if self.batch_seconds else np.zeros(1)
+            return {"model": self.name,
+                    "workers": self.workers,
+                    "threads": self.threads,
+                    "batch_size": self.batch_size,
+                    "texts": self.stats["texts"],
+                    "batches": self.stats["batches"],
+                    "texts_per_second": round(self.stats["texts"] / self.stats["seconds"], 1) if self.stats["seconds"] else None,
+                    "batch_ms_p50": round(float(np.percentile(seconds, 50)) * 1000, 2),
+                    "batch_ms_p99": round(float(np.percentile(seconds, 99)) * 1000, 2),
+                    # Share of the padded batch lengths that is actual text, 1 means no padding.
+                    "fill": round(self.stats["chars"] / self.stats["padded_chars"], 3) if self.stats["padded_chars"] else None}
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
@@ -0,0 +1,366 @@
+import os
+import json
+import atexit
+import hashlib
+import threading
+import contextlib
+import unicodedata
+
+from collections import OrderedDict
+
+import numpy as np
+
+from chromadb.api.types import EmbeddingFunction
+
+try:
+    import fcntl
+except ImportError:
+    # No lock file without fcntl, run a single writer at a time there.
+    fcntl = None
+
+# Bump whenever the file layout changes, older caches are dropped.
+CACHE_VERSION = 3
+
+# Slots of a new cache, the files double from there as needed, up to capacity.
+INITIAL_SLOTS = 1024
+
+
+def normalize_text(text):
+    return " ".join(unicodedata.normalize("NFC", str(text)).split())
+
+
+class EmbeddingCache:
+    """
+    Two level cache of embeddings keyed by (model name, normalized text hash).
+
+    Vectors live in a memory-mapped float32 file that grows on demand up to `capacity`
+    slots, with least recently used eviction beyond that. Hot entries are also kept in
+    an in-process LRU. The whole cache is dropped when it was built for a different model.
+
+    Processes share the files. Writers (ingestion) allocate slots under a lock file,
+    after re-reading which slots are taken, and publish each slot's key in keys.u64.
+    read_only processes (the ones answering queries) never write vectors, they keep
+    what they embed in their in-process LRU. Every process stamps the slots it reads
+    under the lock file, so that eviction follows query-side use too. A slot's key is
+    checked around every read, so a slot reused by another process reads as a miss,
+    never as a wrong vector.
+    """
+
+    def __init__(self, path, model_name, capacity=200000, hot_size=2048, read_only=False):
+        self.path = path
+        self.model_name = model_name
+        self.capacity = capacity
+        self.hot_size = hot_size
+        self.read_only = read_only
+
+        self.stats = {"hot_hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+
+        self._lock = threading.RLock()
+        self._hot = OrderedDict()
+        # Slots read since the last stamp, {slot: code}.
+        self._used = {}
+
+        if read_only:
+            self._load()
+        else:
+            with self._file_lock():
+                self._load()
+        atexit.register(self.flush)
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    @contextlib.contextmanager
+    def _file_lock(self, blocking=True):
+        # Serializes writers across processes, threads of one process also hold self._lock.
+        # Yields whether the lock was taken, always True when blocking.
+        os.makedirs(self.path, exist_ok=True)
+        with open(self._file("lock"), "a") as f:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+                except BlockingIOError:
+                    yield False
+                    return
+            try:
+                yield True
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _load(self):
+        self.slots = {}
+        self.dim = None
+        self.vectors = None
+        self.last_used = None
+        self.keys = None
+        self.header = None
+        self._version = None
+
+        if not os.path.exists(self._file("index.json")):
+            return
+
+        with open(self._file("index.json")) as f:
+            state = json.load(f)
+
+        if state.get("version") == CACHE_VERSION and state["model_name"] == self.model_name:
+            self.dim = state["dim"]
+            self._open()
+            self._sync()
+        elif not self.read_only:
+            print("Embedding cache built for %s, invalidating" % state["model_name"])
+            self._reset()
+
+    def _open(self):
+        # Clock of the last use stamps, a counter bumped by every write and the number of slots.
+        # The header and use stamps are written by every process, under the file lock.
+        self.header = np.memmap(self._file("header.i64"), dtype=np.int64, mode="r+", shape=(3,))
+        slots = int(self.header[2])
+        mode = "r" if self.read_only else "r+"
+        self.vectors = np.memmap(self._file("vectors.f32"), dtype=np.float32, mode=mode, shape=(slots, self.dim))
+        self.last_used = np.memmap(self._file("last_used.i64"), dtype=np.int64, mode="r+", shape=(slots,))
+        self.keys = np.memmap(self._file("keys.u64"), dtype=np.uint64, mode=mode, shape=(slots,))
+
+    def _create(self, dim):
+        self.dim = dim
+        with open(self._file("header.i64"), "wb") as f:
+            f.write(np.zeros(3, dtype=np.int64).tobytes())
+        self._grow(min(INITIAL_SLOTS, self.capacity))
+
+        tmp_path = self._file("index.json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({"version": CACHE_VERSION, "model_name": self.model_name, "dim": dim}, f)
+        os.replace(tmp_path, self._file("index.json"))
+
+    def _grow(self, slots):
+        """
+        Extends the files to slots slots, the new ones free (key 0). Other processes
+        reopen them on their next _sync.
+        """
+
+        for name, width in [("vectors.f32", 4 * self.dim), ("last_used.i64", 8), ("keys.u64", 8)]:
+            with open(self._file(name), "ab") as f:
+                f.truncate(slots * width)
+
+        header = np.memmap(self._file("header.i64"), dtype=np.int64, mode="r+", shape=(3,))
+        header[2] = slots
+        header[1] += 1
+        header.flush()
+        self._open()
+
+    def _reset(self):
+        for name in ["index.json", "vectors.f32", "last_used.i64", "keys.u64", "header.i64"]:
+            if os.path.exists(self._file(name)):
+                os.remove(self._file(name))
+
+    def _sync(self):
+        """
+        Rebuilds the slot table from keys.u64 when another process wrote since the last look.
+        """
+
+        if self.header is None:
+            if os.path.exists(self._file("index.json")):
+                self._load()
+            return
+
+        if int(self.header[2]) != len(self.keys):
+            self._open()
+
+        version = int(self.header[1])
+        if version != self._version:
+            keys = np.array(self.keys)
+            taken = np.flatnonzero(keys)
+            self.slots = dict(zip(keys[taken].tolist(), taken.tolist()))
+            self._version = version
+
+    def key(self, text):
+        return hashlib.sha1((self.model_name + "\x00" + normalize_text(text)).encode("utf-8")).hexdigest()
+
+    def code(self, key):
+        # 64 bit form of a key as stored in keys.u64, 0 marks a free slot.
+        return int(key[:16], 16) or 1
+
+    def _read(self, slot, code):
+        if self.keys[slot] != code:
+            return None
+        vector = np.array(self.vectors[slot])
+        return vector if self.keys[slot] == code else None
+
+    def get_many(self, texts):
+        """
+        Returns one vector per text, None for misses.
+        """
+
+        found = []
+
+        with self._lock:
+            self._sync()
+
+            for text in texts:
+                key = self.key(text)
+                code = self.code(key)
+                slot = self.slots.get(code)
+
+                if key in self._hot:
+                    self._hot.move_to_end(key)
+                    self.stats["hot_hits"] += 1
+                    found.append(self._hot[key])
+                    # Hot entries still count as uses of their slot on disk.
+                    if slot is not None:
+                        self._used[slot] = code
+                    continue
+
+                vector = None if slot is None else self._read(slot, code)
+                if vector is None:
+                    self.stats["misses"] += 1
+                    found.append(None)
+                    continue
+
+                self._used[slot] = code
+                self._remember(key, vector)
+                self.stats["disk_hits"] += 1
+                found.append(vector)
+
+            self._stamp()
+
+        return found
+
+    def _stamp(self):
+        """
+        Marks the slots read since the last stamp as used. Skipped while a writer holds
+        the file lock, they are stamped with the next lookup then.
+        """
+
+        if not self._used or self.last_used is None:
+            return
+
+        with self._file_lock(blocking=False) as locked:
+            if not locked:
+                return
+
+            tick = int(self.header[0]) + 1
+            for slot, code in self._used.items():
+                # Slots reused by a writer meanwhile belong to another text now.
+                if slot < len(self.keys) and self.keys[slot] == code:
+                    self.last_used[slot] = tick
+            self.header[0] = tick
+            self._used = {}
+
+    def put_many(self, texts, vectors):
+
+        with self._lock:
+            vectors = {self.key(text): np.asarray(vector, dtype=np.float32) for text, vector in zip(texts, vectors)}
+            for key, vector in vectors.items():
+                self._remember(key, vector)
+
+            if self.read_only or not vectors:
+                return
+
+            with self._file_lock():
+                if self.vectors is None:
+                    self._load()
+                if self.vectors is None:
+                    self._create(len(next(iter(vectors.values()))))
+                self._sync()
+
+                keys = [key for key in vectors if self.code(key) not in self.slots][-self.capacity:]
+                if not keys:
+                    return
+
+                tick = int(self.header[0])
+                for key, slot in zip(keys, self._allocate(len(keys))):
+                    tick += 1
+                    code = self.code(key)
+                    # The key is cleared while the vector is written, readers see a miss meanwhile.
+                    self.keys[slot] = 0
+                    self.vectors[slot] = vectors[key]
+                    self.last_used[slot] = tick
+                    self.keys[slot] = code
+                    self.slots[code] = slot
+
+                self.header[0] = tick
+                self.header[1] += 1
+                self._version = int(self.header[1])
+
+    def _allocate(self, count):
+        free_slots = int(np.count_nonzero(np.asarray(self.keys) == 0))
+        if free_slots < count and len(self.keys) < self.capacity:
+            self._grow(min(self.capacity, max(2 * len(self.keys), len(self.keys) + count - free_slots)))
+
+        keys = np.array(self.keys)
+        free = keys == 0
+        slots = np.flatnonzero(free)[:count].tolist()
+
+        evict = count - len(slots)
+        if evict > 0:
+            # Every free slot is taken by now, victims are the least recently used of the others.
+            last_used = np.array(self.last_used)
+            last_used[free] = np.iinfo(np.int64).max
+            for slot in np.argpartition(last_used, evict - 1)[:evict].tolist():
+                self.slots.pop(int(keys[slot]), None)
+                slots.append(slot)
+            self.stats["evictions"] += evict
+
+        return slots
+
+    def _remember(self, key, vector):
+        self._hot[key] = vector
+        self._hot.move_to_end(key)
+        if len(self._hot) > self.hot_size:
+            self._hot.popitem(last=False)
+
+    def flush(self):
+
+        with self._lock:
+            if self.vectors is None or self.read_only:
+                return
+
+            self.vectors.flush()
+            self.last_used.flush()
+            self.keys.flush()
+            self.header.flush()
+
+    def info(self):
+        lookups = self.stats["hot_hits"] + self.stats["disk_hits"] + self.stats["misses"]
+        hits = self.stats["hot_hits"] + self.stats["disk_hits"]
+
+        with self._lock:
+            self._sync()
+            entries = len(self.slots)
+
+        return dict(self.stats,
+                    entries=entries,
+                    slots=0 if self.keys is None else len(self.keys),
+                    capacity=self.capacity,
+                    read_only=self.read_only,
+                    hit_rate=round(hits / lookups, 4) if lookups else None)
+
+
+class CachedEmbeddingFunction(EmbeddingFunction):
+    """
+    Embedding function that only sends cache misses to the wrapped function.
+    """
+
+    def __init__(self, embedding_function, cache):
+        self.embedding_function = embedding_function
+        self.cache = cache
+
+    def __call__(self, input):
+        embeddings = self.cache.get_many(input)
+
+        # Identical texts in one call are embedded once.
+        missing = {}
+        for i, embedding in enumerate(embeddings):
+            if embedding is None:
+                missing.setdefault(self.cache.key(input[i]), []).append(i)
+
+        if missing:
+            texts = [input[positions[0]] for positions in missing.values()]
+            computed = self.embedding_function(texts)
+            self.cache.put_many(texts, computed)
+
+            for positions, embedding in zip(missing.values(), computed):
+                for i in positions:
+                    embeddings[i] = np.asarray(embedding, dtype=np.float32)
+
+        return embeddings
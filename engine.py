@@ -0,0 +1,65 @@
+import os
+import time
+import threading
+
+_lock = threading.Lock()
+_engine = None
+
+STARTUP = {
+    "import_seconds": None,
+    "index_open_seconds": None,
+}
+
+
+def get_engine():
+    """
+    Process-wide search engine, opened on first use from the already built index in
+    SEARCH_DB_PATH (default my_vectordb). Ingestion is a separate step: python ingest.py <csv>.
+    With SEARCH_SERVICE_URL set, a client of a shared search service (python service.py) instead.
+    The embedding cache is opened read-only, ingestion is the process that writes it.
+    """
+
+    global _engine
+
+    if _engine is None:
+        with _lock:
+            if _engine is None:
+                path = os.getenv("SEARCH_DB_PATH", "my_vectordb")
+                backend = os.getenv("SEARCH_BACKEND", "chroma")
+                vector_dtype = os.getenv("SEARCH_VECTOR_DTYPE", "float32")
+
+                started = time.perf_counter()
+                if os.getenv("SEARCH_SERVICE_URL"):
+                    from search_client import SearchClient
+                    STARTUP["import_seconds"] = time.perf_counter() - started
+                    vb = SearchClient(os.environ["SEARCH_SERVICE_URL"])
+                elif os.path.exists(os.path.join(path, "shards.json")):
+                    # Built with ingest.py --shard-by, one store per source.
+                    from shards import ShardedVectorDB
+                    STARTUP["import_seconds"] = time.perf_counter() - started
+                    vb = ShardedVectorDB(path, backend=backend, vector_dtype=vector_dtype, read_only_cache=True)
+                else:
+                    from db import VectorDB
+                    STARTUP["import_seconds"] = time.perf_counter() - started
+                    vb = VectorDB(None, path=path, backend=backend, vector_dtype=vector_dtype, read_only_cache=True)
+
+                vb.open_db()
+                STARTUP["index_open_seconds"] = vb.open_seconds
+
+                _engine = vb
+
+    return _engine
+
+
+def startup_report():
+    """
+    Seconds spent importing the search stack, opening the index and loading the
+    embedding model (None until the first query needs it).
+    """
+
+    report = {key: None if value is None else round(value, 3) for key, value in STARTUP.items()}
+    model = getattr(_engine, "model", None)
+    model_load = model.load_seconds if model is not None else None
+    report["model_load_seconds"] = None if model_load is None else round(model_load, 3)
+
+    return report
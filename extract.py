@@ -0,0 +1,280 @@
+import os
+import re
+import gzip
+import json
+import zipfile
+import hashlib
+import collections
+import multiprocessing
+import xml.etree.ElementTree as ET
+
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlparse, unquote
+
+import pandas as pd
+
+from manifest import document_ids, CHUNK_SEPARATOR
+
+try:
+    from pypdf import PdfReader
+except ImportError:
+    # PDFs are skipped without pypdf, the Office formats only need the standard library.
+    PdfReader = None
+
+EXTRACT_VERSION = 1
+
+# Words per indexed chunk and words shared by consecutive chunks.
+CHUNK_WORDS = 200
+CHUNK_OVERLAP = 40
+
+# Text kept per file, bounding what a worker holds and what one file adds to the index.
+MAX_CHARS = 2000000
+MAX_FILE_BYTES = 512 * 1024 * 1024
+# Address space limit of each extraction worker, a file exceeding it fails on its own.
+WORKER_MEMORY_MB = int(os.getenv("SEARCH_EXTRACT_MEMORY_MB", "2048"))
+# Files a worker extracts before it is replaced, returning its memory to the system.
+TASKS_PER_WORKER = 50
+
+# Chunk rows yielded per DataFrame, files in flight per worker.
+FRAME_ROWS = 2000
+WINDOW_PER_WORKER = 4
+
+OOXML_PARTS = {
+    ".docx": r"word/document\.xml",
+    ".pptx": r"ppt/slides/slide\d+\.xml",
+    ".xlsx": r"xl/sharedStrings\.xml|xl/worksheets/sheet\d+\.xml",
+}
+# Elements holding text and elements ending a paragraph, slide shape or spreadsheet string.
+TEXT_TAGS = ("}t",)
+BREAK_TAGS = ("}p", "}si")
+
+
+def natural_key(name):
+    return [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", name)]
+
+
+def ooxml_text(path, pattern, max_chars=MAX_CHARS):
+    """
+    Text of a docx, pptx or xlsx file, streamed out of the XML parts matching pattern
+    with iterparse so that no part is held in memory whole.
+    """
+
+    pieces = []
+    size = 0
+
+    with zipfile.ZipFile(path) as archive:
+        names = sorted((name for name in archive.namelist() if re.fullmatch(pattern, name)), key=natural_key)
+
+        for name in names:
+            with archive.open(name) as part:
+                for event, element in ET.iterparse(part):
+                    if element.tag.endswith(TEXT_TAGS) and element.text:
+                        pieces.append(element.text)
+                        size += len(element.text)
+                    elif element.tag.endswith(BREAK_TAGS):
+                        pieces.append("\n")
+                    element.clear()
+
+                    if size >= max_chars:
+                        return "".join(pieces)[:max_chars]
+
+            pieces.append("\n")
+
+    return "".join(pieces)
+
+
+def pdf_text(path, max_chars=MAX_CHARS):
+    if PdfReader is None:
+        raise RuntimeError("pypdf is not installed")
+
+    pieces = []
+    size = 0
+
+    for page in PdfReader(path).pages:
+        text = page.extract_text() or ""
+        pieces.append(text)
+        size += len(text)
+        if size >= max_chars:
+            break
+
+    return "\n".join(pieces)[:max_chars]
+
+
+def extract_text(path, max_chars=MAX_CHARS):
+    extension = os.path.splitext(path)[1].lower()
+
+    if os.path.getsize(path) > MAX_FILE_BYTES:
+        raise ValueError("larger than %d bytes" % MAX_FILE_BYTES)
+    if extension == ".pdf":
+        return pdf_text(path, max_chars)
+    if extension in OOXML_PARTS:
+        return ooxml_text(path, OOXML_PARTS[extension], max_chars)
+
+    raise ValueError("unsupported file type " + extension)
+
+
+def chunk_text(text, words=CHUNK_WORDS, overlap=CHUNK_OVERLAP):
+    """
+    Splits text into windows of words words, consecutive windows sharing overlap words.
+    """
+
+    tokens = text.split()
+    step = max(words - overlap, 1)
+    return [" ".join(tokens[start:start + words]) for start in range(0, max(len(tokens) - overlap, 1), step)
+            if tokens[start:start + words]]
+
+
+def extract_file(path):
+    """
+    Worker task: the chunks of one file and None, or no chunks and the error.
+    """
+
+    try:
+        return chunk_text(extract_text(path)), None
+    except Exception as e:
+        return [], "%s: %s" % (type(e).__name__, e)
+
+
+def limit_memory(megabytes):
+    try:
+        import resource
+        limit = megabytes * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    except (ImportError, ValueError, OSError):
+        pass
+
+
+def local_path(mirror_dir, file_url):
+    """
+    Mirror copy of a file: mirror_dir/<host>/<url path>, mirror_dir/<url path> or
+    mirror_dir/<file name>, whichever exists first. None when there is none.
+    """
+
+    url = urlparse(str(file_url))
+    url_path = unquote(url.path).lstrip("/")
+    if os.path.splitext(url_path)[1].lower() not in (".pdf",) + tuple(OOXML_PARTS):
+        return None
+
+    for candidate in (os.path.join(mirror_dir, url.netloc, url_path),
+                      os.path.join(mirror_dir, url_path),
+                      os.path.join(mirror_dir, os.path.basename(url_path))):
+        if os.path.isfile(candidate):
+            return candidate
+
+    return None
+
+
+class ExtractionCache:
+    """
+    Chunks of every extracted file, keyed by its path, size and modification time, so an
+    interrupted or repeated ingest only extracts new and changed files. Failures are kept
+    too and retried once the file changes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def key(self, file_path):
+        stat = os.stat(file_path)
+        identity = "%d\x1f%s\x1f%d\x1f%d" % (EXTRACT_VERSION, os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+        return hashlib.sha1(identity.encode("utf-8")).hexdigest()
+
+    def file(self, key):
+        return os.path.join(self.path, key[:2], key + ".json.gz")
+
+    def get(self, key):
+        try:
+            with gzip.open(self.file(key), "rt", encoding="utf-8") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return state["chunks"], state["error"]
+
+    def put(self, key, chunks, error):
+        path = self.file(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+            json.dump({"chunks": chunks, "error": error}, f)
+
+        os.replace(tmp_path, path)
+
+
+def with_content(chunks, mirror_dir, cache_dir, workers=None, frame_rows=FRAME_ROWS):
+    """
+    Passes the metadata DataFrame chunks through and adds DataFrames of body chunks for
+    every row whose file is in mirror_dir. A chunk row copies the metadata of its file,
+    its document is the title and chunk text and its doc_id is <file id>#<n>, so hits
+    can be collapsed back to their file.
+
+    Files are extracted in a pool of spawned workers with at most WINDOW_PER_WORKER files
+    per worker in flight and a memory limit each, results are cached in cache_dir.
+    """
+
+    workers = workers or os.cpu_count() or 1
+    cache = ExtractionCache(cache_dir)
+    report = {"files": 0, "cached": 0, "extracted": 0, "failed": 0, "chunks": 0}
+    seen = {}
+    pending = collections.deque()
+    rows = []
+
+    def collect():
+        parent, row, key, result = pending.popleft()
+
+        if isinstance(result, tuple):
+            report["cached"] += 1
+            texts, error = result
+        else:
+            texts, error = result.result()
+            cache.put(key, texts, error)
+            report["extracted"] += 1
+
+        if error is not None:
+            report["failed"] += 1
+            if report["failed"] <= 10:
+                print("Could not extract", row["file_url"], error)
+
+        for n, text in enumerate(texts):
+            rows.append(dict(row, generated_insights="%s\n%s" % (row["file_title"], text),
+                             doc_id="%s%s%d" % (parent, CHUNK_SEPARATOR, n)))
+        report["chunks"] += len(texts)
+
+    def frame():
+        chunk_rows = pd.DataFrame(rows)
+        del rows[:]
+        return chunk_rows
+
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                               initializer=limit_memory, initargs=(WORKER_MEMORY_MB,),
+                               max_tasks_per_child=TASKS_PER_WORKER)
+
+    try:
+        for chunk in chunks:
+            yield chunk
+
+            for parent, row in zip(document_ids(chunk, seen), chunk.to_dict("records")):
+                path = local_path(mirror_dir, row["file_url"])
+                if path is None:
+                    continue
+
+                report["files"] += 1
+                key = cache.key(path)
+                cached = cache.get(key)
+                pending.append((parent, row, key, cached if cached is not None else pool.submit(extract_file, path)))
+
+                while len(pending) > workers * WINDOW_PER_WORKER:
+                    collect()
+                if len(rows) >= frame_rows:
+                    yield frame()
+
+        while pending:
+            collect()
+            if len(rows) >= frame_rows:
+                yield frame()
+        if rows:
+            yield frame()
+    finally:
+        pool.shutdown(cancel_futures=True)
+
+    print("Extraction report", report)
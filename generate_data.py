@@ -1,61 +1,129 @@
+import os
+import argparse
+
+import numpy as np
 import pandas as pd
-import random
-from faker import Faker
-
-# Initialize Faker
-fake = Faker()
-
-# Define meaningful file titles and locations
-file_titles_and_locations = [
-    ('Team Meeting Notes', 'team/meetings'),
-    ('Product Roadmap', 'product/development'),
-    ('Feature Specs', 'product/features'),
-    ('Competitor Analysis', 'product/competitors'),
-    ('Quarterly Report', 'finance/reports'),
-    ('Sprint Planning', 'engineering/sprints'),
-    ('Client Feedback', 'customer/feedback'),
-    ('Sales Report', 'sales/reports'),
-    ('Marketing Strategy', 'marketing/strategies'),
-    ('Customer Call Notes', 'customer/calls')
-]
-
-# Define available sources
-sources = ['google_drive', 'avoma', 'web']
-
-# Generate 500 rows of data
-data = []
-for _ in range(500):
-    # Randomly select a title and corresponding location
-    file_title, file_location = random.choice(file_titles_and_locations)
-    
-    # Generate random file size and type
-    file_size = random.randint(500000, 5000000)
-    file_type = random.choice(['pdf', 'docx', 'xlsx', 'pptx'])
-    
-    # Create random file creation and update times
-    file_created_at = fake.date_time_this_year()
-    file_last_updated_at = file_created_at if random.random() > 0.5 else fake.date_time_this_year()
-    
-    # Create random file URL
-    file_url = f"http://example.com/files/{file_title.replace(' ', '_').lower()}.{file_type}"
-    
-    # Generate data for each row
-    row = {
-        'author': fake.name(),
-        'source': random.choice(sources),
-        'file_title': file_title,
-        'file_size': file_size,
-        'file_type': file_type,
-        'file_location_at_source': file_location,
-        'file_created_at': file_created_at,
-        'file_last_updated_at': file_last_updated_at,
-        'file_url': file_url
-    }
-    data.append(row)
-
-# Convert to DataFrame
-df = pd.DataFrame(data)
-
-# Display the first few rows of the generated DataFrame
-print(df.head())
-df.to_csv("/Users/arjun-14756/Desktop/Advanced-File-Search/data/file_info.csv", index=False)
\ No newline at end of file
+
+COLUMNS = ["author", "source", "file_title", "file_size", "file_type", "file_location_at_source",
+           "file_created_at", "file_last_updated_at", "file_url", "generated_insights"]
+
+AUTHORS = ["John Doe", "Jane Smith", "Bob Brown", "Alice Johnson", "Maria Garcia", "Wei Chen", "Priya Patel", "Tom Wilson"]
+
+SOURCES = ["google_drive", "avoma", "web"]
+
+FILE_TYPES = ["pdf", "docx", "xlsx", "pptx", "web link"]
+EXTENSIONS = ["pdf", "docx", "xlsx", "pptx", "html"]
+KINDS = ["PDF document", "Word document", "Excel spreadsheet", "PowerPoint presentation", "web link"]
+
+MONTHS = ["January", "February", "March", "April", "May", "June", "July", "August", "September"]
+
+# (title, folder, what the file likely contains)
+TITLES = ([("Team Meeting Minutes - %s" % month, "meetings/minutes", "the minutes of the %s team meeting" % month)
+           for month in MONTHS] +
+          [("Product Meeting - Q1 Review", "meetings/product", "a review of the first quarter product work"),
+           ("Product Meeting - Q2 Planning", "meetings/product", "the plan for the second quarter"),
+           ("Product Meeting - Q3 Update", "meetings/product", "a progress update for the third quarter"),
+           ("Product Meeting - Q4 Strategy", "meetings/product", "the product strategy for the fourth quarter"),
+           ("Annual Review", "management/reviews", "a summary of the year's results"),
+           ("Quarterly Report", "finance/reports", "the quarterly financial figures"),
+           ("Sales Forecast", "sales/forecasts", "projected sales for the coming months"),
+           ("Market Analysis", "marketing/analysis", "an analysis of the market and competitors"),
+           ("Customer Survey Results", "customer/surveys", "the results of a customer survey"),
+           ("User Feedback Report", "customer/feedback", "feedback collected from users"),
+           ("Project Plan", "projects/plans", "milestones and owners of a project"),
+           ("Company Home Page", "company/home_page", "the company's public home page"),
+           ("Company Career Page", "company/home_page", "open positions at the company")] +
+          [("Product %s %s" % (product, doc), "products/product_%s/%s" % (product.lower(), folder),
+            "the %s of product %s" % (doc.lower(), product))
+           for product in ["X", "Y"]
+           for doc, folder in [("Roadmap", "roadmap"), ("Release Notes", "release_notes"),
+                               ("User Manual", "manuals"), ("Testing Plan", "testing"),
+                               ("Beta Feedback", "beta_feedback"), ("Marketing Strategy", "marketing")]] +
+          [("Feature Specification for Product %s" % product, "products/product_%s/specifications" % product.lower(),
+            "the feature specification of product %s" % product)
+           for product in ["X", "Y"]])
+
+START = np.datetime64("2024-01-01T00:00:00", "ns")
+END = np.datetime64("2024-09-30T00:00:00", "ns")
+
+
+def pick(values, codes):
+    return pd.Series(np.asarray(values, dtype=object)[codes])
+
+
+def generate_chunk(start, rows, total_rows, seed=0):
+    """
+    Rows start..start+rows of a corpus of total_rows rows, drawn from a generator seeded
+    with (seed, start): the same seed and chunksize always write the same file.
+    """
+
+    positions = np.arange(start, start + rows)
+    rng = np.random.default_rng([seed, start])
+
+    author = rng.integers(len(AUTHORS), size=rows)
+    source = rng.integers(len(SOURCES), size=rows)
+    title = rng.integers(len(TITLES), size=rows)
+    file_type = rng.integers(len(FILE_TYPES), size=rows)
+    file_size = rng.integers(0, 51, size=rows)
+
+    # Creation times increase with the row position like the original export, with jitter.
+    span = (END - START).astype(np.int64)
+    created = positions * (span // max(total_rows, 1)) + rng.integers(0, max(span // max(total_rows, 1), 1), size=rows)
+    updated = created + np.where(rng.random(rows) < 0.5, 0, rng.integers(0, 30 * 86400 * 10**9, size=rows))
+    created = pd.Series(START + np.minimum(created, span).astype("timedelta64[ns]")).astype(str)
+    updated = pd.Series(START + np.minimum(updated, span).astype("timedelta64[ns]")).astype(str)
+
+    titles = pick([t for t, folder, about in TITLES], title)
+    authors = pick(AUTHORS, author)
+    locations = pick([folder for t, folder, about in TITLES], title)
+    sizes = pd.Series(file_size.astype(str))
+
+    insights = ("This " + pick(KINDS, file_type) + " titled \"" + titles + "\" was written by " + authors +
+                ". It is stored in the \"" + locations + "\" folder and is " + sizes +
+                "KB in size. It likely contains " + pick([about for t, folder, about in TITLES], title) + ". \n")
+
+    return pd.DataFrame({
+        "author": authors,
+        "source": pick(SOURCES, source),
+        "file_title": titles,
+        "file_size": file_size,
+        "file_type": pick(FILE_TYPES, file_type),
+        "file_location_at_source": locations,
+        "file_created_at": created,
+        "file_last_updated_at": updated,
+        "file_url": "http://example.com/files/file_" + pd.Series(positions.astype(str)) + "." + pick(EXTENSIONS, file_type),
+        "generated_insights": insights,
+    }, columns=COLUMNS)
+
+
+def generate_chunks(rows, seed=0, chunksize=100000):
+    for start in range(0, rows, chunksize):
+        yield generate_chunk(start, min(chunksize, rows - start), rows, seed)
+
+
+def generate(path, rows, seed=0, chunksize=100000):
+    """
+    Writes a synthetic corpus in the schema of file_info_1.csv, one chunk at a time.
+    """
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+
+    for i, chunk in enumerate(generate_chunks(rows, seed, chunksize)):
+        chunk.to_csv(tmp_path, mode="w" if i == 0 else "a", header=i == 0, index=False)
+
+    os.replace(tmp_path, path)
+    return path
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Generate a synthetic file metadata CSV.")
+    parser.add_argument("path", nargs="?", default="data/file_info_generated.csv")
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--chunksize", type=int, default=100000)
+    args = parser.parse_args()
+
+    generate(args.path, args.rows, args.seed, args.chunksize)
+    print("Wrote %d rows to %s" % (args.rows, args.path))
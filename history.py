@@ -0,0 +1,144 @@
+import os
+import json
+
+# Tokens of chat history resent with each message, older turns are compacted then dropped to fit.
+TOKEN_BUDGET = int(os.getenv("SEARCH_HISTORY_TOKENS", "4000"))
+# Most recent turns kept verbatim, however large.
+KEEP_TURNS = int(os.getenv("SEARCH_HISTORY_KEEP_TURNS", "2"))
+
+# Limits applied to the function responses and texts of older turns.
+DIGEST_CHARS = 120
+DIGEST_ITEMS = 10
+TEXT_CHARS = 600
+
+# Keys of a function response kept in its digest, anything else is dropped.
+DIGEST_KEYS = ("success", "cached", "exception", "message", "link retrieved", "number_of_matches",
+               "latest_document_created_at", "document_summary", "ids", "doc_ids", "file_url",
+               "files", "file_size_sum", "file_size_min", "file_size_max", "groups", "more_groups")
+
+
+def count_tokens(value):
+    """
+    Approximate Gemini tokens of a text or JSON-like value, about 4 characters each.
+    """
+
+    text = value if isinstance(value, str) else json.dumps(value, default=str, ensure_ascii=False)
+    return (len(text) + 3) // 4
+
+
+def shorten(value, chars=DIGEST_CHARS, items=DIGEST_ITEMS):
+    if isinstance(value, str) and len(value) > chars:
+        return value[:chars] + "... (%d more chars)" % (len(value) - chars)
+    if isinstance(value, list) and len(value) > items:
+        return [shorten(item, chars, items) for item in value[:items]] + ["... (%d more)" % (len(value) - items)]
+    if isinstance(value, list):
+        return [shorten(item, chars, items) for item in value]
+    if isinstance(value, dict):
+        return {key: shorten(item, chars, items) for key, item in value.items()}
+    return value
+
+
+def digest(payload):
+    """
+    Short digest of a tool payload: its status, counts and ids, long strings and lists cut.
+    """
+
+    if not isinstance(payload, dict):
+        return shorten(payload)
+
+    kept = {}
+    for key, value in payload.items():
+        if isinstance(value, dict):
+            value = digest(value)
+            if value:
+                kept[key] = value
+        elif key in DIGEST_KEYS:
+            kept[key] = shorten(value)
+
+    return kept
+
+
+def split_turns(history):
+    """
+    Groups Content dicts into turns, each starting at a user message with text. Function
+    calls and their responses stay in the turn of the message that caused them.
+    """
+
+    turns = []
+    for content in history:
+        starts = content.get("role") == "user" and any("text" in part for part in content.get("parts", []))
+        if starts or not turns:
+            turns.append([])
+        turns[-1].append(content)
+    return turns
+
+
+def compact_content(content):
+    parts = []
+    for part in content.get("parts", []):
+        if "function_response" in part:
+            response = part["function_response"]
+            part = {"function_response": {"name": response.get("name"), "response": digest(response.get("response", {}))}}
+        elif "text" in part and len(part["text"]) > TEXT_CHARS:
+            part = {"text": shorten(part["text"], TEXT_CHARS)}
+        parts.append(part)
+    return dict(content, parts=parts)
+
+
+class HistoryManager:
+    """
+    Keeps the chat history resent with every message within a token budget. Turns older
+    than the last keep_turns have their function responses reduced to digests and long
+    texts cut, then the oldest turns are dropped whole (so no function call loses its
+    response) until the history fits. The tokens sent by each message are recorded.
+    """
+
+    def __init__(self, budget=TOKEN_BUDGET, keep_turns=KEEP_TURNS):
+        self.budget = budget
+        self.keep_turns = keep_turns
+        self.sent = []
+
+    def compact(self, history):
+        """
+        Compacted copy of a list of Content dicts and a report of what changed.
+        """
+
+        turns = split_turns(history)
+        recent = max(len(turns) - self.keep_turns, 0)
+
+        compacted = [[compact_content(content) for content in turn] if i < recent else turn
+                     for i, turn in enumerate(turns)]
+        sizes = [count_tokens(turn) for turn in compacted]
+
+        dropped = 0
+        while dropped < recent and sum(sizes[dropped:]) > self.budget:
+            dropped += 1
+
+        report = {"tokens_before": sum(count_tokens(turn) for turn in turns),
+                  "tokens_after": sum(sizes[dropped:]),
+                  "turns": len(turns) - dropped,
+                  "compacted_turns": recent - dropped,
+                  "dropped_turns": dropped}
+
+        return [content for turn in compacted[dropped:] for content in turn], report
+
+    def record(self, history, message, prompt_tokens=None):
+        """
+        Logs one send_message: estimated tokens of the history and the new message, and
+        the prompt tokens the model reported, if any. Returns the entry.
+        """
+
+        entry = {"history_tokens": count_tokens(history),
+                 "message_tokens": count_tokens(message),
+                 "prompt_tokens": prompt_tokens}
+        self.sent.append(entry)
+        return entry
+
+    def info(self):
+        estimated = [entry["history_tokens"] + entry["message_tokens"] for entry in self.sent]
+        return {"messages_sent": len(self.sent),
+                "budget": self.budget,
+                "keep_turns": self.keep_turns,
+                "last_tokens": estimated[-1] if estimated else 0,
+                "total_tokens": sum(estimated),
+                "last_prompt_tokens": self.sent[-1]["prompt_tokens"] if self.sent else None}
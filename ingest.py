@@ -0,0 +1,251 @@
+import time
+import queue
+import threading
+
+import pandas as pd
+
+from manifest import content_hashes
+
+# Chroma rejects writes above its max batch size, so deletes are chunked.
+WRITE_BATCH_SIZE = 5000
+
+_DONE = object()
+
+
+def read_chunks(csv_path, chunksize=10000):
+    return pd.read_csv(csv_path, chunksize=chunksize)
+
+
+def group_duplicates(vb, ids, documents, columns, changed):
+    """
+    Splits the changed rows into group representatives, to be embedded and written, and
+    members, only kept in vb.dedup. Also returns the members promoted to representative
+    of a group whose representative changed.
+    """
+
+    changed_ids = [ids[i] for i in changed]
+    promoted = vb.dedup.remove(changed_ids)
+    group_ids = vb.dedup.assign(changed_ids, [documents[i] for i in changed], vb.metadata_records(columns, changed))
+
+    representatives = [i for i, group_id in zip(changed, group_ids) if group_id == ids[i]]
+    members = [i for i, group_id in zip(changed, group_ids) if group_id != ids[i]]
+
+    return representatives, members, promoted
+
+
+def ingest(vb, chunks, batch_size=256, queue_size=2, rebuild=False, dedup=None):
+    """
+    Streams DataFrame chunks into vb.backend. Only new or changed rows are embedded,
+    in batches of batch_size. Embedding runs on the calling thread while a writer
+    thread upserts the previous batch, with at most queue_size batches in flight.
+    rebuild ignores the manifest and reconciles the whole store with the data.
+
+    dedup groups near-duplicate rows within that SimHash distance (see dedup.DedupIndex)
+    and False stops grouping, either reconciles the whole store. None keeps the store's
+    current setting.
+
+    Returns a report with added/updated/skipped/deleted counts and throughput.
+    """
+
+    backend = vb.backend
+    manifest = vb.manifest
+    trusted = manifest.load() and not rebuild
+
+    if dedup is False:
+        if vb.dedup.enabled:
+            # Grouped rows are only in the dedup index, so everything is written again.
+            vb.dedup.drop()
+            trusted = False
+    elif dedup is not None and (not vb.dedup.enabled or vb.dedup.max_distance != dedup):
+        vb.dedup.configure(dedup)
+        trusted = False
+    elif vb.dedup.enabled and vb.dedup.outdated:
+        # Groups made with an older grouping key are regrouped from scratch.
+        vb.dedup.configure(vb.dedup.max_distance)
+        trusted = False
+
+    if trusted:
+        stale_columnar = not vb.index.load() or vb.index.generation != manifest.generation
+        stale_lexical = vb.lexical.generation != manifest.generation
+
+        if stale_columnar and not backend.stores_vectors:
+            # The columnar index is this backend's only copy of the vectors.
+            trusted = False
+        elif stale_columnar or stale_lexical:
+            vb.rebuild_indexes(columnar=stale_columnar, lexical=stale_lexical)
+
+    grouping = vb.dedup.enabled
+
+    if not trusted:
+        manifest.entries = {}
+        vb.index.clear()
+        vb.lexical.clear()
+        if grouping:
+            vb.dedup.clear()
+
+    report = {"added": 0, "updated": 0, "skipped": 0, "deleted": 0}
+    if grouping:
+        report["grouped"] = 0
+    promoted = {}
+    seen_ids = set()
+    id_counts = {}
+
+    batches = queue.Queue(maxsize=queue_size)
+    failures = []
+
+    def write():
+        while True:
+            batch = batches.get()
+            if batch is _DONE:
+                return
+            if failures:
+                continue
+
+            ids, embeddings, documents, metadatas, hashes = batch
+            try:
+                if embeddings is None:
+                    # Rows grouped under a representative, out of the stores in case they were written before.
+                    backend.delete(ids)
+                    vb.index.delete(ids)
+                    vb.lexical.delete(ids)
+                else:
+                    backend.upsert(ids, embeddings, documents, metadatas)
+                    vb.index.upsert(ids, embeddings, metadatas)
+                    vb.lexical.upsert(ids, documents, metadatas)
+                manifest.record(ids, hashes)
+            except Exception as e:
+                failures.append(e)
+
+    writer = threading.Thread(target=write, name="ingest-writer", daemon=True)
+    writer.start()
+
+    started = time.perf_counter()
+    rows = 0
+
+    try:
+        for chunk in chunks:
+            ids, documents, columns = vb.generate_data(chunk, id_counts)
+            hashes = content_hashes(chunk)
+            added, updated, skipped = manifest.classify(ids, hashes)
+
+            report["added"] += len(added)
+            report["updated"] += len(updated)
+            report["skipped"] += len(skipped)
+            seen_ids.update(ids)
+            rows += len(ids)
+
+            changed = sorted(added + updated)
+            if grouping and changed:
+                changed, members, group_promoted = group_duplicates(vb, ids, documents, columns, changed)
+                promoted.update((doc_id, (document, metadata)) for doc_id, document, metadata in group_promoted)
+                report["grouped"] += len(members)
+                if members:
+                    batches.put(([ids[i] for i in members], None, None, None, [hashes[i] for i in members]))
+
+            for start in range(0, len(changed), batch_size):
+                if failures:
+                    raise failures[0]
+
+                positions = changed[start:start + batch_size]
+                batch_documents = [documents[i] for i in positions]
+                batches.put((
+                    [ids[i] for i in positions],
+                    vb.embedding_function(batch_documents),
+                    batch_documents,
+                    vb.metadata_records(columns, positions),
+                    [hashes[i] for i in positions]
+                ))
+    finally:
+        batches.put(_DONE)
+        writer.join()
+        vb.embedding_cache.flush()
+
+    if failures:
+        raise failures[0]
+
+    if trusted:
+        deleted = manifest.stale(seen_ids)
+    else:
+        # No usable manifest: anything in the store that is not in the data
+        # (e.g. the old sequential ids) has to go.
+        deleted = [doc_id for doc_id in backend.ids() if doc_id not in seen_ids]
+
+    for start in range(0, len(deleted), WRITE_BATCH_SIZE):
+        backend.delete(deleted[start:start + WRITE_BATCH_SIZE])
+    manifest.forget(deleted)
+    vb.index.delete(deleted)
+    vb.lexical.delete(deleted)
+    report["deleted"] = len(deleted)
+
+    if grouping:
+        promoted.update((doc_id, (document, metadata)) for doc_id, document, metadata in vb.dedup.remove(deleted))
+        promoted = [(doc_id, document, metadata) for doc_id, (document, metadata) in promoted.items() if vb.dedup.is_group(doc_id)]
+
+        # Members that took over a changed or deleted representative are written in its place.
+        for start in range(0, len(promoted), batch_size):
+            page = promoted[start:start + batch_size]
+            ids, documents, metadatas = [row[0] for row in page], [row[1] for row in page], [row[2] for row in page]
+            embeddings = vb.embedding_function(documents)
+            backend.upsert(ids, embeddings, documents, metadatas)
+            vb.index.upsert(ids, embeddings, metadatas)
+            vb.lexical.upsert(ids, documents, metadatas)
+
+        report["promoted"] = len(promoted)
+        report["dedup"] = vb.dedup.info()
+
+    if report["added"] or report["updated"] or deleted or not trusted:
+        manifest.generation += 1
+    manifest.save()
+    vb.index.save(manifest.generation)
+    backend.save(manifest.generation)
+    vb.lexical.set_generation(manifest.generation)
+
+    elapsed = time.perf_counter() - started
+    report["rows"] = rows
+    report["seconds"] = round(elapsed, 3)
+    report["rows_per_second"] = round(rows / elapsed, 1) if elapsed > 0 else None
+    print("Ingestion report", report)
+
+    embedding = vb.model.info() if getattr(vb, "model", None) is not None else None
+    if embedding:
+        print("Embedding report", embedding)
+
+    return report
+
+
+if __name__ == "__main__":
+    import os
+    import argparse
+
+    from db import VectorDB
+
+    parser = argparse.ArgumentParser(description="Sync the search index with a file metadata CSV export.")
+    parser.add_argument("csv_path", nargs="?", default="data/file_info_1.csv")
+    parser.add_argument("--path", default="my_vectordb")
+    parser.add_argument("--backend", default="chroma")
+    parser.add_argument("--vector-dtype", default="float32")
+    parser.add_argument("--chunksize", type=int, default=10000)
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--shard-by", choices=["source", "source,file_type"], default=None,
+                        help="keep one store per source (and file type), new paths only")
+    parser.add_argument("--shard", action="append", default=None, help="only sync this shard, can be repeated")
+    parser.add_argument("--rebuild", action="store_true", help="ignore the manifest and reconcile everything")
+    parser.add_argument("--content-dir", default=None, help="local mirror of the files, their pdf/docx/xlsx/pptx bodies are indexed too")
+    parser.add_argument("--workers", type=int, default=None, help="extraction processes, defaults to the number of CPUs")
+    parser.add_argument("--dedup", type=int, default=None, metavar="DISTANCE",
+                        help="group near-duplicate insights within this SimHash distance (e.g. 9) under one vector")
+    parser.add_argument("--no-dedup", dest="dedup", action="store_false", help="stop grouping near-duplicates")
+    args = parser.parse_args()
+
+    if args.shard_by or args.shard or os.path.exists(os.path.join(args.path, "shards.json")):
+        from shards import ShardedVectorDB
+
+        vb = ShardedVectorDB(args.path, partition=args.shard_by.split(",") if args.shard_by else None,
+                             backend=args.backend, vector_dtype=args.vector_dtype)
+        vb.create_db_from_csv(args.csv_path, chunksize=args.chunksize, batch_size=args.batch_size,
+                              shards=args.shard, rebuild=args.rebuild, content_dir=args.content_dir, workers=args.workers,
+                              dedup=args.dedup)
+    else:
+        vb = VectorDB(None, path=args.path, backend=args.backend, vector_dtype=args.vector_dtype)
+        vb.create_db_from_csv(args.csv_path, chunksize=args.chunksize, batch_size=args.batch_size, rebuild=args.rebuild,
+                              content_dir=args.content_dir, workers=args.workers, dedup=args.dedup)
@@ -0,0 +1,186 @@
+import os
+import re
+import math
+import heapq
+import sqlite3
+import threading
+
+from collections import Counter
+
+TOKEN = re.compile(r"[a-z0-9]+")
+
+STOP_WORDS = {
+    "a", "an", "the", "and", "or", "of", "to", "in", "on", "for", "is", "it", "its", "it's",
+    "this", "that", "with", "as", "by", "at", "be", "are", "was", "from", "s"
+}
+
+# Title tokens are counted this many times so title hits outrank body mentions.
+TITLE_WEIGHT = 2
+
+
+def tokenize(text):
+    return [token for token in TOKEN.findall(str(text).lower()) if token not in STOP_WORDS]
+
+
+def normalize_title(text):
+    return " ".join(TOKEN.findall(str(text).lower()))
+
+
+class LexicalIndex:
+    """
+    On-disk inverted index (sqlite) with BM25 scoring over generated_insights,
+    file_title and file_location_at_source, updated incrementally by ingestion.
+    """
+
+    def __init__(self, path, k1=1.2, b=0.75, max_df_ratio=0.5):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        # Terms in more than this fraction of documents add ~nothing to BM25 and are skipped.
+        self.max_df_ratio = max_df_ratio
+
+        self._lock = threading.RLock()
+        self._conn = None
+
+    def connect(self):
+
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS docs (doc_id TEXT PRIMARY KEY, length INTEGER, title TEXT);
+                CREATE INDEX IF NOT EXISTS docs_title ON docs (title);
+                CREATE TABLE IF NOT EXISTS postings (term TEXT, doc_id TEXT, tf INTEGER, PRIMARY KEY (term, doc_id)) WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS postings_doc ON postings (doc_id);
+                CREATE TABLE IF NOT EXISTS terms (term TEXT PRIMARY KEY, df INTEGER) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS stats (key TEXT PRIMARY KEY, value INTEGER);
+            """)
+
+        return self._conn
+
+    def _stat(self, key, default=0):
+        row = self.connect().execute("SELECT value FROM stats WHERE key = ?", (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def _add_stat(self, key, delta):
+        self.connect().execute(
+            "INSERT INTO stats (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = value + excluded.value",
+            (key, delta))
+
+    @property
+    def generation(self):
+        with self._lock:
+            return self._stat("generation", None)
+
+    def set_generation(self, generation):
+        with self._lock:
+            conn = self.connect()
+            conn.execute("INSERT OR REPLACE INTO stats (key, value) VALUES ('generation', ?)", (generation,))
+            conn.commit()
+
+    def clear(self):
+        with self._lock:
+            conn = self.connect()
+            conn.executescript("DELETE FROM docs; DELETE FROM postings; DELETE FROM terms; DELETE FROM stats;")
+            conn.commit()
+
+    def _remove(self, ids):
+        conn = self.connect()
+
+        for doc_id in ids:
+            row = conn.execute("SELECT length FROM docs WHERE doc_id = ?", (doc_id,)).fetchone()
+            if row is None:
+                continue
+
+            terms = [term for term, in conn.execute("SELECT term FROM postings WHERE doc_id = ?", (doc_id,))]
+            conn.executemany("UPDATE terms SET df = df - 1 WHERE term = ?", [(term,) for term in terms])
+            conn.execute("DELETE FROM postings WHERE doc_id = ?", (doc_id,))
+            conn.execute("DELETE FROM docs WHERE doc_id = ?", (doc_id,))
+            self._add_stat("documents", -1)
+            self._add_stat("total_length", -row[0])
+
+    def upsert(self, ids, documents, metadatas):
+
+        with self._lock:
+            conn = self.connect()
+            self._remove(ids)
+
+            postings = []
+            df = Counter()
+            docs = []
+            total_length = 0
+
+            for doc_id, document, metadata in zip(ids, documents, metadatas):
+                title = metadata.get("file_title", "")
+                tokens = tokenize(document) + tokenize(title) * TITLE_WEIGHT + tokenize(metadata.get("file_location_at_source", ""))
+                counts = Counter(tokens)
+
+                postings.extend((term, doc_id, tf) for term, tf in counts.items())
+                df.update(counts.keys())
+                docs.append((doc_id, len(tokens), normalize_title(title)))
+                total_length += len(tokens)
+
+            conn.executemany("INSERT INTO docs (doc_id, length, title) VALUES (?, ?, ?)", docs)
+            conn.executemany("INSERT INTO postings (term, doc_id, tf) VALUES (?, ?, ?)", postings)
+            conn.executemany(
+                "INSERT INTO terms (term, df) VALUES (?, ?) ON CONFLICT(term) DO UPDATE SET df = df + excluded.df",
+                df.items())
+            self._add_stat("documents", len(docs))
+            self._add_stat("total_length", total_length)
+            conn.commit()
+
+    def delete(self, ids):
+        with self._lock:
+            self._remove(ids)
+            self.connect().commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._stat("documents")
+
+    def title_matches(self, query_text):
+        """
+        Ids of all documents whose normalized title equals the normalized query, unordered;
+        callers rank them before cutting.
+        """
+
+        title = normalize_title(query_text)
+        if not title:
+            return []
+
+        with self._lock:
+            return [doc_id for doc_id, in self.connect().execute("SELECT doc_id FROM docs WHERE title = ?", (title,))]
+
+    def search(self, query_text, limit=10, allowed=None):
+        """
+        BM25 ranking of the query, returns [(doc_id, score)] best first. allowed is an
+        optional callable filtering doc ids.
+        """
+
+        with self._lock:
+            conn = self.connect()
+            documents = self._stat("documents")
+            if documents == 0:
+                return []
+            average_length = self._stat("total_length") / documents
+
+            scores = {}
+            for term in set(tokenize(query_text)):
+                row = conn.execute("SELECT df FROM terms WHERE term = ?", (term,)).fetchone()
+                if row is None or row[0] <= 0 or row[0] > self.max_df_ratio * documents:
+                    continue
+
+                df = row[0]
+                idf = math.log(1 + (documents - df + 0.5) / (df + 0.5))
+
+                for doc_id, tf, length in conn.execute(
+                        "SELECT p.doc_id, p.tf, d.length FROM postings p JOIN docs d ON d.doc_id = p.doc_id WHERE p.term = ?",
+                        (term,)):
+                    norm = self.k1 * (1 - self.b + self.b * length / average_length)
+                    scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+
+        if allowed is not None:
+            scores = {doc_id: score for doc_id, score in scores.items() if allowed(doc_id)}
+
+        return heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
@@ -2,6 +2,9 @@
 web app chatbot Gemini function calling
 """
 import os
+import time
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import urllib
 import urllib.request
@@ -20,10 +23,14 @@ from vertexai.generative_models import (
     GenerationConfig,
     Tool,
     Part,
+    Content,
     SafetySetting
 )
 
-from tools import search_for_similar_records, search_for_links
+from tools import search_for_similar_records, search_for_links, count_files, result_cache_stats
+from engine import startup_report
+from tracing import span
+from history import HistoryManager, digest
 
 
 #AUTHIENTICATION
@@ -31,8 +38,16 @@ from tools import search_for_similar_records, search_for_links
 load_dotenv()
 st.session_state.PROJECT_ID = os.getenv('PROJECT_ID')
 st.session_state.LOCATION = os.getenv('LOCATION')
-vertexai.init(project=st.session_state.PROJECT_ID , location=st.session_state.LOCATION)
-st.session_state.bq_client = bigquery.Client(project=st.session_state.PROJECT_ID)
+
+
+@st.cache_resource
+def init_clients(project_id, location):
+    # Once per server process instead of on every rerun.
+    vertexai.init(project=project_id, location=location)
+    return bigquery.Client(project=project_id)
+
+
+st.session_state.bq_client = init_clients(st.session_state.PROJECT_ID, st.session_state.LOCATION)
 st.session_state.auth = True
 
 # Functions declaration
@@ -59,8 +74,8 @@ search_for_similar_records_yaml = FunctionDeclaration(
                 "default": "any"
             },
             "file_size": {
-                "type": "integer",
-                "description": "The size of the file in megabytes (MB). If set to 'any', there is no restriction on file size.",
+                "type": "number",
+                "description": "The maximum size of the file in megabytes (MB), e.g. 0.5. If set to 'any', there is no restriction on file size.",
                 "default": "any"
             },
             "nfiles_to_return": {
@@ -78,6 +93,12 @@ search_for_similar_records_yaml = FunctionDeclaration(
                 "description": "The end date to filter the files by creation date, in the format %Y-%m-%d (e.g., 2024-09-29).",
                 "default": "2024-09-29"
             },
+            "sort_by": {
+                "type": "string",
+                "enum": ["relevance", "latest"],
+                "description": "'latest' returns the most recent matching files (e.g. 'the last team meeting'), 'relevance' the best matches with a preference for recent files.",
+                "default": "relevance"
+            },
         },
     }
 )
@@ -98,7 +119,130 @@ search_for_links_yaml = FunctionDeclaration(
     }
 )
 
-query_tools = Tool(function_declarations=[search_for_similar_records_yaml, search_for_links_yaml])
+count_files_yaml = FunctionDeclaration(
+    name="count_files",
+
+    description="Counts the files matching the constraints and sums up their sizes (in kilobytes), optionally grouped by source, file type, creation month or folder, without listing the files. Use it for questions like 'how many PDFs are on Google Drive' or 'which folders have files'.",
+
+    parameters={
+        "type": "object",
+        "properties": {
+            "file_source": {
+                "type": "string",
+                "enum": ["any", "web", "google_drive", "avoma"],
+                "description": "The source of the files to be counted, or 'any' (no restriction).",
+                "default": "any"
+            },
+            "file_extension": {
+                "type": "string",
+                "enum": ["any", "web link", "pdf", "docx", "pptx", "xlsx"],
+                "description": "The file extension type to be counted, or 'any' (no restriction).",
+                "default": "any"
+            },
+            "file_size": {
+                "type": "number",
+                "description": "Only count files up to this size in megabytes (MB), e.g. 0.5. If set to 'any', there is no restriction on file size.",
+                "default": "any"
+            },
+            "start_date": {
+                "type": "string",
+                "description": "Only count files created on or after this date, in the format %Y-%m-%d (e.g., 2024-01-01). Omit for no limit.",
+            },
+            "end_date": {
+                "type": "string",
+                "description": "Only count files created on or before this date, in the format %Y-%m-%d (e.g., 2024-09-29). Omit for no limit.",
+            },
+            "location_prefix": {
+                "type": "string",
+                "description": "Only count files in this folder and its subfolders, e.g. 'products/product_x'. Omit for all folders.",
+            },
+            "group_by": {
+                "type": "string",
+                "enum": ["none", "source", "file_type", "month", "location"],
+                "description": "Returns the counts per source, file type, creation month (YYYY-MM) or folder. 'location' groups by the folders one level below location_prefix.",
+                "default": "none"
+            },
+        },
+    }
+)
+
+query_tools = Tool(function_declarations=[search_for_similar_records_yaml, search_for_links_yaml, count_files_yaml])
+
+TOOL_FUNCTIONS = {
+    "search_for_similar_records": search_for_similar_records,
+    "search_for_links": search_for_links,
+    "count_files": count_files,
+}
+
+
+@st.cache_resource
+def get_tool_executor():
+    # One pool per server process, shared by all sessions and reruns.
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="tool-call")
+
+
+def function_calls_of(response):
+    """
+    Every function call part of the first candidate, a turn can request several at once.
+    """
+
+    function_calls = []
+    for part in response.candidates[0].content.parts:
+        try:
+            if part.function_call.name:
+                function_calls.append(part.function_call)
+        except AttributeError:
+            pass
+    return function_calls
+
+
+def run_function_call(function_call):
+    params = {}
+    for key, value in function_call.args.items():
+        params[key] = value
+
+    started = time.perf_counter()
+    output = None
+    with span("tool." + function_call.name, params=params):
+        if function_call.name in TOOL_FUNCTIONS:
+            output = TOOL_FUNCTIONS[function_call.name](**params)
+    return function_call.name, params, output, time.perf_counter() - started
+
+
+def show_records(result):
+    # The search tools return lists of FileRecords, or an error message.
+    if isinstance(result, list):
+        st.dataframe([record.as_dict() for record in result])
+    else:
+        st.write(result)
+
+
+def timing_breakdown(turn):
+    # Markdown list of the finished spans of a chat turn, indented by nesting depth.
+    details = ""
+    for depth, name, duration_ms in turn.breakdown():
+        details += "   " * depth + "- " + name + ": ```%.1f ms```\n" % duration_ms
+    return details
+
+
+def send_message(message):
+    # The whole history is resent with every message, so older turns are compacted first.
+    chat = st.session_state.chat
+    manager = st.session_state.history_manager
+
+    history, report = manager.compact([content.to_dict() for content in chat.history])
+    if report["tokens_after"] != report["tokens_before"]:
+        chat.history[:] = [Content.from_dict(content) for content in history]
+
+    payload = message if isinstance(message, str) else [part.to_dict() for part in message]
+    with span("gemini.send_message", history_tokens=report["tokens_after"]) as send_span:
+        response = chat.send_message(message)
+
+        usage = getattr(response, "usage_metadata", None)
+        sent = manager.record(history, payload, getattr(usage, "prompt_token_count", None))
+        send_span.set(**sent)
+
+    return response, sent
 
 #WEB App Interface
 st.set_page_config(
@@ -132,6 +276,8 @@ with tile.expander("Sample Prompts", expanded=False):
         - Can you get the product files that are smaller than 1MB from Google Drive?
         - Could you share the link to our home page?
         - Retrieve 2 files on Product X.
+        - How many PDFs are on Google Drive, per month?
+        - Which folders under products have files?
     """
     )
 
@@ -142,39 +288,48 @@ if "messages" not in st.session_state:
 if 'gemini_history' not in st.session_state:
     st.session_state.gemini_history = []
 
-st.session_state.model = GenerativeModel(
-                            model_name="gemini-1.0-pro-002",
-
-                            system_instruction=["You are a Query Search AI Agent designed to facilitate efficient file or link retrieval.", "Your primary tasks is to search for files or links based on queries and constraints, if any!", "Observation date starts at 2024 jaunary and ends in september 2024."
-                            , "Do not respond to questions outside these tasks. Please use the provided tools to give concise and accurate answers.", "Do not hallucinate!"
-                            "DO NOT MAKE UP ANY ANSWERS IF NOT PROVIDED BY THE TOOLS!"],
-                            
-                            generation_config=GenerationConfig(temperature=0,
-                                                                top_p=0.95,
-                                                                top_k=10,
-                                                                candidate_count=1,
-                                                                max_output_tokens=8000,
-                                                                stop_sequences=["STOP!"]
-                            ),
-                            safety_settings=[SafetySetting(
-                                                category=generative_models.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT,
-                                                threshold=generative_models.HarmBlockThreshold.BLOCK_LOW_AND_ABOVE
-                                            ),
-                                            SafetySetting(
-                                                category=generative_models.HarmCategory.HARM_CATEGORY_HATE_SPEECH,
-                                                threshold=generative_models.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE
-                                            ),
-                                            SafetySetting(
-                                                category=generative_models.HarmCategory.HARM_CATEGORY_HARASSMENT,
-                                                threshold=generative_models.HarmBlockThreshold.BLOCK_LOW_AND_ABOVE
-                                            ),
-                                            SafetySetting(
-                                                category=generative_models.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT,
-                                                threshold=generative_models.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE
-                                            ),
-                            ],
-                            tools=[query_tools]
-)
+if 'history_manager' not in st.session_state:
+    st.session_state.history_manager = HistoryManager()
+
+@st.cache_resource
+def get_model():
+    # The model and its tool declarations are built once per server process.
+    return GenerativeModel(
+        model_name="gemini-1.0-pro-002",
+
+        system_instruction=["You are a Query Search AI Agent designed to facilitate efficient file or link retrieval.", "Your primary tasks is to search for files or links based on queries and constraints, if any!", "Observation date starts at 2024 jaunary and ends in september 2024."
+        , "Do not respond to questions outside these tasks. Please use the provided tools to give concise and accurate answers.", "Do not hallucinate!"
+        "DO NOT MAKE UP ANY ANSWERS IF NOT PROVIDED BY THE TOOLS!"],
+
+        generation_config=GenerationConfig(temperature=0,
+                                           top_p=0.95,
+                                           top_k=10,
+                                           candidate_count=1,
+                                           max_output_tokens=8000,
+                                           stop_sequences=["STOP!"]
+        ),
+        safety_settings=[SafetySetting(
+                            category=generative_models.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT,
+                            threshold=generative_models.HarmBlockThreshold.BLOCK_LOW_AND_ABOVE
+                        ),
+                        SafetySetting(
+                            category=generative_models.HarmCategory.HARM_CATEGORY_HATE_SPEECH,
+                            threshold=generative_models.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE
+                        ),
+                        SafetySetting(
+                            category=generative_models.HarmCategory.HARM_CATEGORY_HARASSMENT,
+                            threshold=generative_models.HarmBlockThreshold.BLOCK_LOW_AND_ABOVE
+                        ),
+                        SafetySetting(
+                            category=generative_models.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT,
+                            threshold=generative_models.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE
+                        ),
+        ],
+        tools=[query_tools]
+    )
+
+
+st.session_state.model = get_model()
 
 if 'chat' not in st.session_state:
     st.session_state.chat = st.session_state.model.start_chat(response_validation=True,
@@ -183,9 +338,19 @@ def reset_conversation():
     del st.session_state.gemini_history
     del st.session_state.chat
     del st.session_state.messages
+    del st.session_state.history_manager
 
 st.button(label='Reset', key='reset', on_click=reset_conversation)
 
+with st.sidebar.expander("Startup timings (s)", expanded=False):
+    st.json(startup_report())
+
+with st.sidebar.expander("Result cache", expanded=False):
+    st.json(result_cache_stats())
+
+with st.sidebar.expander("Chat history tokens", expanded=False):
+    st.json(st.session_state.history_manager.info())
+
 for message in st.session_state.messages:
     with st.chat_message(message["role"], avatar='🧑🏻' if message['role']=='user' else '🤖'):
         st.markdown(message["content"])  # noqa: W605
@@ -200,67 +365,82 @@ if prompt := st.chat_input(placeholder="Ask me about file retrieval, searching f
     with st.chat_message("user", avatar='🧑🏻'):
         st.markdown(prompt)
 
-    with st.chat_message("assistant", avatar='🤖'):
+    with st.chat_message("assistant", avatar='🤖'), span("chat_turn") as turn:
 
         message_placeholder = st.empty()
         full_response = "" # pylint: disable=invalid-name
-        response = st.session_state.chat.send_message(prompt)
-        response = response.candidates[0].content.parts[0]
+        response, sent = send_message(prompt)
+        tokens_sent = [sent]
 
         backend_details = "" # pylint: disable=invalid-name
         api_requests_and_responses  = []
 
-        function_calling_in_process = True # pylint: disable=invalid-name
-
         result_info = {}
 
-        while function_calling_in_process:
-            try:
-                params = {}
+        function_calls = function_calls_of(response)
 
-                for key, value in response.function_call.args.items():
-                    params[key] = value
+        while function_calls:
+            # All calls of a turn run concurrently, their responses go back in one message.
+            # Each call runs in a copy of this context, so its spans join the turn's trace.
+            futures = [get_tool_executor().submit(contextvars.copy_context().run, run_function_call, function_call)
+                       for function_call in function_calls]
+            function_responses = []
 
-                print(response.function_call.name)
-                print(params)
+            for future in futures:
+                name, params, output, elapsed = future.result()
 
-                if response.function_call.name == "search_for_similar_records":
-                    result, result_info, api_response = search_for_similar_records(**params)
-                    st.write(result)
+                if name == "search_for_similar_records":
+                    result, result_info, api_response = output
+                    show_records(result)
                     st.markdown("#### response")
                     st.json(result_info) 
-                    api_requests_and_responses.append([response.function_call.name, params, api_response])
                     st.session_state.messages.append(
                         {
                             "role": "assistant",
                             "content": "retrieved_files",
-                            "retrieved_files": result_info,
+                            "retrieved_files": digest(result_info),
                         }
                     )
 
-                if response.function_call.name == "search_for_links":
-                    result, api_response = search_for_links(**params)
-                    st.write(result)
+                elif name == "search_for_links":
+                    result, api_response = output
+                    show_records(result)
                     st.markdown("#### response")
-                    api_requests_and_responses.append([response.function_call.name, params, api_response])
                     st.session_state.messages.append(
                         {
                             "role": "assistant",
                             "content": "retrieved_files",
-                            "retrieved_files": api_response,
+                            "retrieved_files": digest(api_response),
                         }
                     )
 
-                print(api_response)
+                elif name == "count_files":
+                    result, api_response = output
+                    if isinstance(result, dict) and result.get("groups"):
+                        st.dataframe(result["groups"])
+                    st.markdown("#### response")
+                    st.json(api_response)
+                    st.session_state.messages.append(
+                        {
+                            "role": "assistant",
+                            "content": "retrieved_files",
+                            "retrieved_files": digest(api_response),
+                        }
+                    )
 
-                response = st.session_state.chat.send_message(
+                else:
+                    api_response = {"success": False, "exception": "Unknown function " + name}
+
+                api_requests_and_responses.append([name, params, api_response, elapsed])
+
+                function_responses.append(
                     Part.from_function_response(
-                        name=response.function_call.name,
+                        name=name,
                         response={
                             "role": "assistant",
                             "content": api_response,
                         },
-                    ),
+                    )
                 )
 
                 backend_details += "- Function call:\n"
@@ -282,18 +462,33 @@ if prompt := st.chat_input(placeholder="Ask me about file retrieval, searching f
                     + "```"
                 )
                 backend_details += "\n\n"
+                backend_details += (
+                    "   - Duration: ```"
+                    + "%.0f ms" % (api_requests_and_responses[-1][3] * 1000)
+                    + "```"
+                )
+                backend_details += "\n\n"
 
-                with message_placeholder.container():
-                    st.markdown(backend_details)
+            with message_placeholder.container():
+                st.markdown(backend_details)
 
-                response = response.candidates[0].content.parts[0]
-                print(f"function return: {api_response}, model_response: {response}")
-            except AttributeError:
-                function_calling_in_process = False # pylint: disable=invalid-name
+            response, sent = send_message(function_responses)
+            tokens_sent.append(sent)
+            function_calls = function_calls_of(response)
 
         st.session_state.gemini_history = st.session_state.chat.history
         full_response = response.text
 
+        history_tokens = sum(entry["history_tokens"] for entry in tokens_sent)
+        message_tokens = sum(entry["message_tokens"] for entry in tokens_sent)
+        prompt_tokens = [entry["prompt_tokens"] for entry in tokens_sent if entry["prompt_tokens"] is not None]
+        backend_details += "- Tokens sent: ```~%d``` in %d messages (history ```~%d```, reported by the model ```%s```)\n\n" % (
+            history_tokens + message_tokens, len(tokens_sent), history_tokens, sum(prompt_tokens) if prompt_tokens else "n/a")
+
+        breakdown = timing_breakdown(turn)
+        if breakdown:
+            backend_details += "- Timing breakdown:\n" + breakdown + "\n"
+
         with message_placeholder.container():
             # st.json(result_info)  # noqa: W605
             with st.expander("Function calls, parameters, and responses:"):
@@ -303,5 +498,6 @@ if prompt := st.chat_input(placeholder="Ask me about file retrieval, searching f
             {
                 "role": "assistant",
                 "content": full_response,
+                "backend_details": backend_details,
             }
         )
\ No newline at end of file
@@ -0,0 +1,147 @@
+import os
+import json
+import hashlib
+
+# Bump whenever the stored document or metadata layout changes so that every
+# row is re-written on the next ingest.
+MANIFEST_VERSION = 2
+
+ID_COLUMNS = ["source", "file_url"]
+
+# Chunks of a file body (see extract.py) are indexed as <file id>#<n> next to the file's row.
+CHUNK_SEPARATOR = "#"
+
+
+def document_ids(data, seen=None):
+    """
+    Stable document ids derived from the identity columns of each row, so a row
+    keeps its id when the export is reordered. Repeated keys get an occurrence suffix,
+    pass the same seen dict across chunks of one export to keep the suffixes consistent.
+    """
+
+    keys = data[ID_COLUMNS[0]].astype(str)
+    for column in ID_COLUMNS[1:]:
+        keys = keys + "\x1f" + data[column].astype(str)
+
+    ids = []
+    seen = {} if seen is None else seen
+
+    for key in keys.values:
+        doc_id = hashlib.sha1(key.encode("utf-8")).hexdigest()[:20]
+        count = seen.get(doc_id, 0)
+        seen[doc_id] = count + 1
+        ids.append(doc_id if count == 0 else "%s-%d" % (doc_id, count))
+
+    return ids
+
+
+def parent_id(doc_id):
+    """
+    Id of the file a document belongs to, the id itself unless it is a body chunk.
+    """
+
+    return doc_id.split(CHUNK_SEPARATOR, 1)[0]
+
+
+def content_hashes(data):
+    """
+    One hash per row over every column, used to detect changed rows.
+    """
+
+    columns = list(data.columns)
+    content = data[columns[0]].astype(str)
+    for column in columns[1:]:
+        content = content + "\x1f" + data[column].astype(str)
+
+    return [hashlib.sha1(value.encode("utf-8")).hexdigest() for value in content.values]
+
+
+class IngestManifest:
+    """
+    Persisted map of document id -> content hash for everything written to the store.
+    """
+
+    def __init__(self, path, backend="chroma"):
+        self.path = path
+        self.backend = backend
+        self.entries = {}
+        self.generation = 0
+
+    def load(self):
+        """
+        Returns True when a manifest of the current version was found. When it is
+        missing or outdated the store contents are not trusted and must be reconciled.
+        """
+
+        self.entries = {}
+
+        if not os.path.exists(self.path):
+            return False
+
+        with open(self.path) as f:
+            state = json.load(f)
+
+        self.generation = state.get("generation", 0)
+
+        if state.get("version") != MANIFEST_VERSION or state.get("backend", "chroma") != self.backend:
+            return False
+
+        self.entries = state["entries"]
+        return True
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+
+        with open(tmp_path, "w") as f:
+            json.dump({"version": MANIFEST_VERSION,
+                       "backend": self.backend,
+                       "generation": self.generation,
+                       "entries": self.entries}, f)
+
+        os.replace(tmp_path, self.path)
+
+        # Readers only need the generation, which is kept in a tiny side file.
+        with open(tmp_path, "w") as f:
+            f.write(str(self.generation))
+        os.replace(tmp_path, self.path + ".generation")
+
+    def peek_generation(self):
+        """
+        Current generation without loading the entries.
+        """
+
+        if not os.path.exists(self.path + ".generation"):
+            return 0
+
+        with open(self.path + ".generation") as f:
+            return int(f.read().strip() or 0)
+
+    def classify(self, ids, hashes):
+        """
+        Splits row positions into (added, updated, skipped) against the manifest.
+        """
+
+        added, updated, skipped = [], [], []
+
+        for i, (doc_id, digest) in enumerate(zip(ids, hashes)):
+            known = self.entries.get(doc_id)
+            if known is None:
+                added.append(i)
+            elif known != digest:
+                updated.append(i)
+            else:
+                skipped.append(i)
+
+        return added, updated, skipped
+
+    def stale(self, seen_ids):
+        seen_ids = set(seen_ids)
+        return [doc_id for doc_id in self.entries if doc_id not in seen_ids]
+
+    def record(self, ids, hashes):
+        self.entries.update(zip(ids, hashes))
+
+    def forget(self, ids):
+        for doc_id in ids:
+            self.entries.pop(doc_id, None)
@@ -0,0 +1,631 @@
+import os
+import shutil
+import tempfile
+import threading
+
+import numpy as np
+
+from manifest import CHUNK_SEPARATOR
+
+CATEGORICAL_FIELDS = ["source", "file_type", "file_location_at_source"]
+NUMERIC_FIELDS = ["file_size", "file_created_ts", "file_updated_ts"]
+
+# Timestamp columns with a persisted newest-first row order.
+TIME_FIELDS = ["file_created_ts", "file_updated_ts"]
+
+RANGE_OPERATORS = {
+    "$gt": np.greater,
+    "$gte": np.greater_equal,
+    "$lt": np.less,
+    "$lte": np.less_equal
+}
+
+VECTOR_DTYPES = ["float32", "float16", "int8"]
+
+# Fields aggregate() groups by, location groups by folder prefix and month by creation month.
+GROUP_FIELDS = ["source", "file_type", "location", "month"]
+
+# Rows scored per matrix product when scanning everything, bounds the dequantized copy.
+SCAN_BLOCK = 65536
+
+
+class UnsupportedFilter(Exception):
+    pass
+
+
+def location_prefix(location, depth):
+    return "/".join(str(location).split("/")[:depth])
+
+
+def month_of(timestamp):
+    return str(np.datetime64(int(timestamp), "s").astype("datetime64[M]"))
+
+
+def group_label(metadata, group_by, depth=1):
+    """
+    Group of a metadata record, as labelled by ColumnarIndex.aggregate.
+    """
+
+    if group_by is None:
+        return "all"
+    if group_by == "location":
+        return location_prefix(metadata.get("file_location_at_source", ""), depth)
+    if group_by == "month":
+        return month_of(metadata.get("file_created_ts") or 0)
+    return str(metadata.get(group_by, ""))
+
+
+def aggregate_records(metadatas, group_by=None, depth=1):
+    """
+    aggregate() over a list of metadata records, for rows outside the columnar index.
+    """
+
+    groups = {}
+    for metadata in metadatas:
+        size = int(metadata.get("file_size") or 0)
+        label = group_label(metadata, group_by, depth)
+        if label not in groups:
+            groups[label] = {"files": 0, "file_size_sum": 0, "file_size_min": size, "file_size_max": size}
+        group = groups[label]
+        group["files"] += 1
+        group["file_size_sum"] += size
+        group["file_size_min"] = min(group["file_size_min"], size)
+        group["file_size_max"] = max(group["file_size_max"], size)
+    return groups
+
+
+def merge_aggregates(parts):
+    """
+    Adds up the aggregate() groups of disjoint sets of rows.
+    """
+
+    merged = {}
+    for groups in parts:
+        for label, group in groups.items():
+            if label not in merged:
+                merged[label] = dict(group)
+                continue
+            total = merged[label]
+            total["files"] += group["files"]
+            total["file_size_sum"] += group["file_size_sum"]
+            total["file_size_min"] = min(total["file_size_min"], group["file_size_min"])
+            total["file_size_max"] = max(total["file_size_max"], group["file_size_max"])
+    return merged
+
+
+def summarize(groups, limit=20):
+    """
+    Totals over aggregate() groups and the limit largest groups, as answered to the agent.
+    """
+
+    summary = {"files": sum(group["files"] for group in groups.values()),
+               "file_size_sum": sum(group["file_size_sum"] for group in groups.values()),
+               "file_size_min": min((group["file_size_min"] for group in groups.values()), default=None),
+               "file_size_max": max((group["file_size_max"] for group in groups.values()), default=None)}
+
+    if list(groups) != ["all"]:
+        ranked = sorted(groups.items(), key=lambda item: (-item[1]["files"], item[0]))
+        summary["groups"] = [dict(group, value=label) for label, group in ranked[:limit]]
+        summary["more_groups"] = max(len(ranked) - limit, 0)
+
+    return summary
+
+
+def quantize(embeddings, dtype):
+    """
+    Stores normalized float32 rows as dtype. int8 rows get a per row scale, returned
+    alongside (None for the float types).
+    """
+
+    if dtype == "float32":
+        return embeddings, None
+
+    if dtype == "float16":
+        return embeddings.astype(np.float16), None
+
+    scales = np.abs(embeddings).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    return np.round(embeddings / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+
+
+class ColumnarIndex:
+    """
+    NumPy copy of the filterable metadata next to a contiguous matrix of normalized
+    embeddings, one row per document.
+
+    Filters use the same where clause syntax as Chroma, plus {"$prefix": ...} on
+    file_location_at_source. Writes are buffered and applied by compact(), save()
+    persists a new generation and switches to it atomically.
+
+    Vectors are stored as float32, float16 or int8 (dtype) and memory-mapped on load,
+    so processes opening the same generation share one page-cached copy.
+    """
+
+    def __init__(self, path, dtype="float32"):
+        if dtype not in VECTOR_DTYPES:
+            raise ValueError("dtype must be one of %s" % VECTOR_DTYPES)
+
+        self.path = path
+        self.dtype = dtype
+        self._lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        self.generation = None
+        self.ids = np.array([], dtype=str)
+        self.embeddings = None
+        self.scales = None
+        self.vocab = {field: [] for field in CATEGORICAL_FIELDS}
+        self.codes = {field: np.zeros(0, dtype=np.int32) for field in CATEGORICAL_FIELDS}
+        self.numeric = {field: np.zeros(0, dtype=np.int64) for field in NUMERIC_FIELDS}
+        self.positions = {}
+
+        self._pending = []
+        self._removed = set()
+        self._reset_caches()
+
+    def _reset_caches(self):
+        self._bitmaps = {}
+        self._counts = {}
+        self._sorted = {}
+        self._time_order = {}
+        self._group_keys = {}
+        self._file_rows = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def load(self):
+
+        current = os.path.join(self.path, "CURRENT")
+        if not os.path.exists(current):
+            return False
+
+        with open(current) as f:
+            directory = os.path.join(self.path, f.read().strip())
+
+        with self._lock:
+            self.clear()
+            columns = np.load(os.path.join(directory, "columns.npz"))
+
+            self.generation = int(columns["generation"])
+            self.ids = columns["ids"]
+            for field in CATEGORICAL_FIELDS:
+                self.vocab[field] = columns["vocab_" + field].tolist()
+                self.codes[field] = columns["codes_" + field]
+            for field in NUMERIC_FIELDS:
+                self.numeric[field] = columns[field]
+            for field in TIME_FIELDS:
+                if "order_" + field in columns:
+                    self._time_order[field] = columns["order_" + field]
+
+            self.embeddings = np.load(os.path.join(directory, "embeddings.npy"), mmap_mode="r")
+            if os.path.exists(os.path.join(directory, "scales.npy")):
+                self.scales = np.load(os.path.join(directory, "scales.npy"), mmap_mode="r")
+            self.positions = {doc_id: i for i, doc_id in enumerate(self.ids.tolist())}
+
+            if str(columns["dtype"]) != self.dtype and len(self.ids):
+                # Stored with another precision, re-quantize in memory, the next save persists it.
+                self.embeddings, self.scales = quantize(self.vectors(np.arange(len(self.ids))), self.dtype)
+
+        return True
+
+    def save(self, generation):
+
+        with self._lock:
+            self.compact()
+            os.makedirs(self.path, exist_ok=True)
+            directory = tempfile.mkdtemp(prefix="gen-%d-" % generation, dir=self.path)
+
+            columns = {"generation": generation, "dtype": self.dtype, "ids": self.ids.astype(str)}
+            for field in CATEGORICAL_FIELDS:
+                columns["vocab_" + field] = np.array(self.vocab[field], dtype=str)
+                columns["codes_" + field] = self.codes[field]
+            for field in NUMERIC_FIELDS:
+                columns[field] = self.numeric[field]
+            for field in TIME_FIELDS:
+                columns["order_" + field] = self.time_order(field)
+
+            np.savez(os.path.join(directory, "columns.npz"), **columns)
+            np.save(os.path.join(directory, "embeddings.npy"), self._matrix())
+            if self.scales is not None:
+                np.save(os.path.join(directory, "scales.npy"), self.scales)
+
+            tmp_path = os.path.join(self.path, "CURRENT.tmp")
+            with open(tmp_path, "w") as f:
+                f.write(os.path.basename(directory))
+            os.replace(tmp_path, os.path.join(self.path, "CURRENT"))
+
+            for name in os.listdir(self.path):
+                if name.startswith("gen-") and name != os.path.basename(directory):
+                    shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+
+            self.generation = generation
+
+    def _matrix(self):
+        if self.embeddings is None:
+            return np.zeros((0, 0), dtype=np.float32)
+        return self.embeddings
+
+    def vectors(self, rows):
+        """
+        Dequantized float32 vectors for the given row positions.
+        """
+
+        vectors = np.asarray(self.embeddings[rows], dtype=np.float32)
+        if self.scales is not None:
+            vectors *= np.asarray(self.scales[rows])[:, None]
+        return vectors
+
+    def nbytes(self):
+        total = sum(codes.nbytes for codes in self.codes.values()) + sum(values.nbytes for values in self.numeric.values())
+        total += self.ids.nbytes
+        if self.embeddings is not None:
+            total += self.embeddings.nbytes
+        if self.scales is not None:
+            total += self.scales.nbytes
+        return total
+
+    def upsert(self, ids, embeddings, metadatas):
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        embeddings, scales = quantize(embeddings / np.where(norms == 0, 1, norms), self.dtype)
+
+        with self._lock:
+            self._pending.append((list(ids), embeddings, scales, list(metadatas)))
+            self._removed.difference_update(ids)
+
+    def delete(self, ids):
+        with self._lock:
+            self._removed.update(ids)
+
+    def compact(self):
+        """
+        Applies buffered upserts and deletes, later writes win.
+        """
+
+        with self._lock:
+            if not self._pending and not self._removed:
+                return
+
+            taken = set()
+            rows = []
+            for ids, embeddings, scales, metadatas in reversed(self._pending):
+                for i, doc_id in enumerate(ids):
+                    if doc_id not in taken and doc_id not in self._removed:
+                        taken.add(doc_id)
+                        rows.append((doc_id, embeddings[i], metadatas[i], None if scales is None else scales[i]))
+            rows.reverse()
+
+            dropped = taken | self._removed
+            keep = np.fromiter((doc_id not in dropped for doc_id in self.ids.tolist()), dtype=bool, count=len(self.ids))
+
+            new_ids = np.array([row[0] for row in rows], dtype=str)
+            self.ids = np.concatenate([self.ids[keep].astype(str), new_ids]) if len(new_ids) else self.ids[keep]
+
+            for field in CATEGORICAL_FIELDS:
+                lookup = {value: code for code, value in enumerate(self.vocab[field])}
+                new_codes = []
+                for row in rows:
+                    value = str(row[2].get(field, ""))
+                    if value not in lookup:
+                        lookup[value] = len(self.vocab[field])
+                        self.vocab[field].append(value)
+                    new_codes.append(lookup[value])
+                self.codes[field] = np.concatenate([self.codes[field][keep], np.array(new_codes, dtype=np.int32)])
+
+            for field in NUMERIC_FIELDS:
+                new_values = np.array([int(row[2].get(field) or 0) for row in rows], dtype=np.int64)
+                self.numeric[field] = np.concatenate([self.numeric[field][keep], new_values])
+
+            if rows:
+                new_embeddings = np.stack([row[1] for row in rows])
+                new_scales = np.array([row[3] for row in rows], dtype=np.float32) if self.dtype == "int8" else None
+                if self.embeddings is None or len(self.embeddings) == 0:
+                    self.embeddings = new_embeddings
+                    self.scales = new_scales
+                else:
+                    self.embeddings = np.concatenate([self.embeddings[keep], new_embeddings])
+                    if new_scales is not None:
+                        self.scales = np.concatenate([self.scales[keep], new_scales])
+            elif self.embeddings is not None:
+                self.embeddings = np.ascontiguousarray(self.embeddings[keep])
+                if self.scales is not None:
+                    self.scales = np.ascontiguousarray(self.scales[keep])
+
+            self.positions = {doc_id: i for i, doc_id in enumerate(self.ids.tolist())}
+            self._pending = []
+            self._removed = set()
+            self._reset_caches()
+
+    def _codes_for(self, field, condition):
+        vocab = self.vocab[field]
+        lookup = {value: code for code, value in enumerate(vocab)}
+
+        if not isinstance(condition, dict):
+            condition = {"$eq": condition}
+
+        (operator, value), = condition.items()
+
+        if operator in ("$eq", "$ne"):
+            codes = [lookup[value]] if value in lookup else []
+        elif operator in ("$in", "$nin"):
+            codes = [lookup[v] for v in value if v in lookup]
+        elif operator == "$prefix":
+            codes = [code for code, v in enumerate(vocab) if v.startswith(value)]
+        else:
+            raise UnsupportedFilter("%s on %s" % (operator, field))
+
+        return operator in ("$ne", "$nin"), codes
+
+    def _bitmap(self, field, code):
+        key = (field, code)
+        if key not in self._bitmaps:
+            self._bitmaps[key] = self.codes[field] == code
+        return self._bitmaps[key]
+
+    def mask(self, where):
+        """
+        Boolean row mask for a where clause, None means all rows.
+        """
+
+        if not where:
+            return None
+
+        if "$and" in where or "$or" in where:
+            operator = "$and" if "$and" in where else "$or"
+            masks = [self.mask(clause) for clause in where[operator]]
+            masks = [m for m in masks if m is not None]
+            if not masks:
+                return None
+            reduce = np.logical_and if operator == "$and" else np.logical_or
+            return reduce.reduce(masks)
+
+        if len(where) > 1:
+            return self.mask({"$and": [{field: condition} for field, condition in where.items()]})
+
+        (field, condition), = where.items()
+
+        if field in CATEGORICAL_FIELDS:
+            negate, codes = self._codes_for(field, condition)
+            if len(codes) == 1:
+                selected = self._bitmap(field, codes[0])
+            else:
+                selected = np.isin(self.codes[field], codes)
+            return ~selected if negate else selected
+
+        if field in NUMERIC_FIELDS:
+            values = self.numeric[field]
+            if not isinstance(condition, dict):
+                condition = {"$eq": condition}
+            (operator, value), = condition.items()
+
+            if operator in RANGE_OPERATORS:
+                return RANGE_OPERATORS[operator](values, value)
+            if operator == "$eq":
+                return values == value
+            if operator == "$ne":
+                return values != value
+            if operator == "$in":
+                return np.isin(values, value)
+            if operator == "$nin":
+                return ~np.isin(values, value)
+
+        raise UnsupportedFilter(str(where))
+
+    def estimate(self, where):
+        """
+        Estimated number of matching rows from per value counts and sorted columns,
+        assuming independent clauses.
+        """
+
+        return len(self) * self._fraction(where)
+
+    def _fraction(self, where):
+        total = len(self)
+
+        if not where or total == 0:
+            return 1.0
+
+        if "$and" in where:
+            return float(np.prod([self._fraction(clause) for clause in where["$and"]]))
+
+        if "$or" in where:
+            return 1.0 - float(np.prod([1.0 - self._fraction(clause) for clause in where["$or"]]))
+
+        if len(where) > 1:
+            return self._fraction({"$and": [{field: condition} for field, condition in where.items()]})
+
+        (field, condition), = where.items()
+
+        if field in CATEGORICAL_FIELDS:
+            if field not in self._counts:
+                self._counts[field] = np.bincount(self.codes[field], minlength=len(self.vocab[field]))
+            negate, codes = self._codes_for(field, condition)
+            fraction = self._counts[field][codes].sum() / total
+            return 1.0 - fraction if negate else fraction
+
+        if field in NUMERIC_FIELDS:
+            if field not in self._sorted:
+                self._sorted[field] = np.sort(self.numeric[field])
+            values = self._sorted[field]
+            if not isinstance(condition, dict):
+                condition = {"$eq": condition}
+            (operator, value), = condition.items()
+
+            if operator == "$gt":
+                return (total - np.searchsorted(values, value, side="right")) / total
+            if operator == "$gte":
+                return (total - np.searchsorted(values, value, side="left")) / total
+            if operator == "$lt":
+                return np.searchsorted(values, value, side="left") / total
+            if operator == "$lte":
+                return np.searchsorted(values, value, side="right") / total
+            if operator in ("$eq", "$in", "$ne", "$nin"):
+                return self.mask(where).mean()
+
+        raise UnsupportedFilter(str(where))
+
+    def file_rows(self):
+        """
+        Mask of the rows that are files, not chunks of a file body.
+        """
+
+        if self._file_rows is None:
+            self._file_rows = np.char.find(self.ids.astype(str), CHUNK_SEPARATOR) < 0
+        return self._file_rows
+
+    def group_keys(self, group_by, depth=1):
+        """
+        Group code of every row and the label of every code, cached until the next compact().
+        """
+
+        if group_by is None:
+            return np.zeros(len(self), dtype=np.int64), ["all"]
+        if group_by not in GROUP_FIELDS:
+            raise ValueError("group_by must be one of %s" % GROUP_FIELDS)
+
+        key = (group_by, depth)
+        if key not in self._group_keys:
+            if group_by == "month":
+                months = self.numeric["file_created_ts"].astype("datetime64[s]").astype("datetime64[M]")
+                values, codes = np.unique(months, return_inverse=True)
+                labels = [str(value) for value in values]
+            elif group_by == "location":
+                # Folders are grouped by their first depth levels, mapped over the vocabulary only.
+                prefixes = [location_prefix(value, depth) for value in self.vocab["file_location_at_source"]]
+                labels = sorted(set(prefixes))
+                lookup = {label: code for code, label in enumerate(labels)}
+                mapping = np.array([lookup[prefix] for prefix in prefixes], dtype=np.int64)
+                codes = mapping[self.codes["file_location_at_source"]] if len(mapping) else np.zeros(0, dtype=np.int64)
+            else:
+                labels = list(self.vocab[group_by])
+                codes = self.codes[group_by]
+            self._group_keys[key] = (np.asarray(codes, dtype=np.int64).ravel(), labels)
+
+        return self._group_keys[key]
+
+    def aggregate(self, where=None, group_by=None, depth=1):
+        """
+        File counts and file_size sum/min/max of the rows matching where, per group_by
+        value ("all" when None), computed on the columns without touching any record.
+        Body chunks are not counted. Returns {label: {"files", "file_size_sum",
+        "file_size_min", "file_size_max"}} for the non-empty groups.
+        """
+
+        with self._lock:
+            mask = self.mask(where)
+            rows = np.flatnonzero(self.file_rows() if mask is None else mask & self.file_rows())
+            codes, labels = self.group_keys(group_by, depth)
+
+            codes = codes.take(rows)
+            sizes = self.numeric["file_size"].take(rows)
+
+        counts = np.bincount(codes, minlength=len(labels))
+        sums = np.bincount(codes, weights=sizes, minlength=len(labels))
+        minimums = np.full(len(labels), np.iinfo(np.int64).max, dtype=np.int64)
+        maximums = np.full(len(labels), np.iinfo(np.int64).min, dtype=np.int64)
+        np.minimum.at(minimums, codes, sizes)
+        np.maximum.at(maximums, codes, sizes)
+
+        return {labels[code]: {"files": int(counts[code]), "file_size_sum": int(sums[code]),
+                               "file_size_min": int(minimums[code]), "file_size_max": int(maximums[code])}
+                for code in np.flatnonzero(counts)}
+
+    def rewrite(self, where):
+        """
+        Translates $prefix conditions into $in lists that Chroma understands.
+        """
+
+        if not where:
+            return where
+
+        if "$and" in where or "$or" in where:
+            operator = "$and" if "$and" in where else "$or"
+            return {operator: [self.rewrite(clause) for clause in where[operator]]}
+
+        rewritten = {}
+        for field, condition in where.items():
+            if isinstance(condition, dict) and "$prefix" in condition:
+                condition = {"$in": [v for v in self.vocab.get(field, []) if v.startswith(condition["$prefix"])]}
+            rewritten[field] = condition
+
+        return rewritten
+
+    def time_order(self, field="file_created_ts"):
+        """
+        Row positions newest first by a timestamp column, saved with every generation.
+        """
+
+        with self._lock:
+            if field not in self._time_order:
+                self._time_order[field] = np.argsort(-self.numeric[field], kind="stable")
+            return self._time_order[field]
+
+    def latest(self, query_embeddings, mask, n_results, min_score, field="file_created_ts"):
+        """
+        Walks the rows newest first (restricted to mask, None for all rows) and returns
+        the first n_results whose cosine score against any of the queries reaches
+        min_score, as (row positions, scores). Stops as soon as enough rows matched.
+        """
+
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        queries = queries / np.where(norms == 0, 1, norms)
+
+        order = self.time_order(field)
+        found_rows = []
+        found_scores = []
+        block = 1024
+
+        for start in range(0, len(order), block):
+            rows = order[start:start + block]
+            if mask is not None:
+                rows = rows[mask[rows]]
+            if len(rows) == 0:
+                continue
+
+            scores = (self.vectors(rows) @ queries.T).max(axis=1)
+            hits = scores >= min_score
+            found_rows.append(rows[hits])
+            found_scores.append(scores[hits])
+
+            if sum(len(rows) for rows in found_rows) >= n_results:
+                break
+            # Recent rows usually match early, later blocks grow to keep the walk cheap.
+            block = min(block * 2, SCAN_BLOCK)
+
+        if not found_rows:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+        return np.concatenate(found_rows)[:n_results], np.concatenate(found_scores)[:n_results]
+
+    def search(self, query_embeddings, candidates, n_results):
+        """
+        Exact cosine scoring of the candidate rows. Returns (row positions, scores)
+        per query, best first.
+        """
+
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        queries = queries / np.where(norms == 0, 1, norms)
+
+        if candidates is None:
+            candidates = np.arange(len(self))
+
+        scores = np.concatenate(
+            [self.vectors(candidates[start:start + SCAN_BLOCK]) @ queries.T for start in range(0, len(candidates), SCAN_BLOCK)]
+            or [np.zeros((0, len(queries)), dtype=np.float32)]).T
+
+        n_results = min(n_results, len(candidates))
+        results = []
+
+        for row_scores in scores:
+            if n_results == 0:
+                results.append((np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)))
+                continue
+            top = np.argpartition(-row_scores, n_results - 1)[:n_results]
+            top = top[np.argsort(-row_scores[top])]
+            results.append((candidates[top], row_scores[top]))
+
+        return results
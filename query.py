@@ -0,0 +1,81 @@
+import re
+
+CONJUNCTIONS = re.compile(r"\b(?:and|or)\b", re.IGNORECASE)
+
+# Fragments made only of these carry no search intent on their own.
+FILLER_WORDS = {"the", "a", "an", "all", "any", "files", "file", "documents", "document", "for", "of", "on", "in"}
+
+RRF_K = 60
+
+
+def decompose_query(query_text):
+    """
+    Splits a query into sub-queries on the standalone words "and"/"or" only, so words
+    like "brand" or "report" stay intact. Empty, filler-only and repeated fragments are dropped.
+    """
+
+    parts = []
+    seen = set()
+
+    for fragment in CONJUNCTIONS.split(query_text):
+        fragment = " ".join(fragment.strip(" ,;").split())
+        words = set(re.findall(r"\w+", fragment.lower()))
+        key = fragment.lower()
+
+        if not words or words <= FILLER_WORDS or key in seen:
+            continue
+
+        seen.add(key)
+        parts.append(fragment)
+
+    return parts or [query_text.strip()]
+
+
+def reciprocal_rank_fusion(rankings, k=RRF_K, limit=None):
+    """
+    Fuses ranked id lists (best first) into one deduplicated list of (id, score).
+    """
+
+    scores = {}
+
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (k + rank + 1)
+
+    fused = sorted(scores.items(), key=lambda item: -item[1])
+
+    return fused[:limit] if limit is not None else fused
+
+
+def fuse_responses(response, limit=None):
+    """
+    Merges a Chroma style query response with one result list per query text into a
+    single ranked list (still nested once so callers can keep reading [0]). A scores
+    list holds the fused scores, distances keep the best distance seen per document
+    (None for lists without distances, such as lexical hits).
+    """
+
+    fused = reciprocal_rank_fusion(response["ids"], limit=limit)
+
+    first_seen = {}
+    best_distance = {}
+    distances = response.get("distances")
+
+    for q, ids in enumerate(response["ids"]):
+        for j, doc_id in enumerate(ids):
+            first_seen.setdefault(doc_id, (q, j))
+            if distances is not None and distances[q] is not None:
+                distance = distances[q][j]
+                best_distance[doc_id] = min(distance, best_distance.get(doc_id, distance))
+
+    merged = {"ids": [[doc_id for doc_id, score in fused]],
+              "scores": [[score for doc_id, score in fused]]}
+
+    for key in ("metadatas", "documents"):
+        if response.get(key) is not None:
+            merged[key] = [[response[key][first_seen[doc_id][0]][first_seen[doc_id][1]] for doc_id, score in fused]]
+
+    if distances is not None:
+        merged["distances"] = [[best_distance.get(doc_id) for doc_id, score in fused]]
+
+    return merged
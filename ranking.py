@@ -0,0 +1,90 @@
+import os
+
+import numpy as np
+
+from manifest import parent_id
+
+# Share of the final score that comes from recency, 0 ranks on relevance only.
+RECENCY_WEIGHT = float(os.getenv("SEARCH_RECENCY_WEIGHT", "0.3"))
+# Age (in days) at which the recency of a document halves.
+HALF_LIFE_DAYS = float(os.getenv("SEARCH_RECENCY_HALF_LIFE_DAYS", "30"))
+# Timestamp column the recency is measured on: file_created_ts or file_updated_ts.
+RECENCY_FIELD = os.getenv("SEARCH_RECENCY_FIELD", "file_created_ts")
+
+# Candidates reranked per requested result, so recent but slightly less similar hits can surface.
+CANDIDATE_FACTOR = 5
+
+
+def recency(timestamps, reference, half_life_days=HALF_LIFE_DAYS):
+    """
+    Exponential decay in [0, 1] of the age of each timestamp relative to reference.
+    """
+
+    age_days = np.maximum(reference - np.asarray(timestamps, dtype=np.float64), 0) / 86400.0
+    return np.power(0.5, age_days / half_life_days)
+
+
+def rerank(vb, response, recency_weight=RECENCY_WEIGHT, half_life_days=HALF_LIFE_DAYS, field=RECENCY_FIELD, reference=None):
+    """
+    Reorders a fused send_query response by
+
+        (1 - recency_weight) * relevance + recency_weight * recency
+
+    in one vectorized pass. Relevance is the fused score scaled by the best one and the
+    recency decays with the age of field relative to reference (by default the newest
+    document in the index). The scores of the response are replaced by the combined ones.
+    """
+
+    ids = response["ids"][0]
+    if len(ids) == 0 or recency_weight == 0:
+        return response
+
+    relevance = np.asarray(response["scores"][0], dtype=np.float64)
+    relevance = relevance / relevance.max() if relevance.max() > 0 else relevance
+
+    timestamps, newest = vb.timestamps(ids, field)
+    reference = newest if reference is None else reference
+
+    combined = (1 - recency_weight) * relevance + recency_weight * recency(timestamps, reference, half_life_days)
+    order = np.argsort(-combined, kind="stable")
+
+    reranked = {}
+    for key, values in response.items():
+        if values is None or values[0] is None:
+            reranked[key] = values
+        else:
+            reranked[key] = [[values[0][i] for i in order]]
+    reranked["scores"] = [combined[order].tolist()]
+
+    return reranked
+
+
+def top(response, n_results):
+    """
+    The first n_results hits of a single query response.
+    """
+
+    return {key: values if values is None or values[0] is None else [values[0][:n_results]]
+            for key, values in response.items()}
+
+
+def collapse(response):
+    """
+    One hit per file: body chunk hits are replaced by their file id and only the best
+    ranked hit of each file is kept.
+    """
+
+    ids = response["ids"][0]
+    keep, files = [], set()
+
+    for i, doc_id in enumerate(ids):
+        file_id = parent_id(doc_id)
+        if file_id not in files:
+            files.add(file_id)
+            keep.append(i)
+
+    collapsed = {key: values if values is None or values[0] is None else [[values[0][i] for i in keep]]
+                 for key, values in response.items()}
+    collapsed["ids"] = [[parent_id(ids[i]) for i in keep]]
+
+    return collapsed
@@ -0,0 +1,84 @@
+import time
+import threading
+
+from collections import OrderedDict
+
+
+class ResultCache:
+    """
+    LRU cache of search results bounded by entry count and approximate bytes, with a
+    TTL. Every entry belongs to an index generation; seeing a new generation drops
+    the whole cache.
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=64 * 1024 * 1024, ttl_seconds=300):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+
+        self.generation = None
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "invalidations": 0}
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+
+    def _check_generation(self, generation):
+        if generation != self.generation:
+            if self._entries:
+                self.stats["invalidations"] += 1
+            self._entries.clear()
+            self._bytes = 0
+            self.generation = generation
+
+    def get(self, key, generation):
+
+        with self._lock:
+            self._check_generation(generation)
+            entry = self._entries.get(key)
+
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+
+            expires_at, size, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self._bytes -= size
+                self.stats["expirations"] += 1
+                self.stats["misses"] += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return value
+
+    def put(self, key, generation, value, size):
+
+        with self._lock:
+            self._check_generation(generation)
+            if size > self.max_bytes:
+                return
+
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, size, value)
+            self._bytes += size
+
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                evicted_key, (expires_at, evicted_size, evicted) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.stats["evictions"] += 1
+
+    def info(self):
+        with self._lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return dict(self.stats,
+                        entries=len(self._entries),
+                        bytes=self._bytes,
+                        max_entries=self.max_entries,
+                        max_bytes=self.max_bytes,
+                        ttl_seconds=self.ttl_seconds,
+                        generation=self.generation,
+                        hit_rate=round(self.stats["hits"] / lookups, 4) if lookups else None)
@@ -0,0 +1,64 @@
+import sys
+
+from dedup import matches
+
+FIELDS = ("author", "source", "file_title", "file_size", "file_type", "file_location_at_source",
+          "file_created_at", "file_last_updated_at", "file_url", "file_created_ts", "file_updated_ts")
+
+
+class FileRecord:
+    """
+    One search hit: document id, fused score and the metadata fields, kept in slots
+    instead of a dict per hit. duplicates holds the FileRecords of the near-duplicate
+    files grouped under this one.
+    """
+
+    __slots__ = ("doc_id", "score") + FIELDS + ("duplicates",)
+
+    def __init__(self, doc_id, score, metadata, duplicates=()):
+        self.doc_id = doc_id
+        self.score = score
+        for field in FIELDS:
+            setattr(self, field, metadata.get(field))
+        self.duplicates = list(duplicates)
+
+    def as_dict(self):
+        record = {field: getattr(self, field) for field in self.__slots__}
+        record["duplicates"] = [duplicate.file_url for duplicate in self.duplicates]
+        return record
+
+    def nbytes(self):
+        return (sys.getsizeof(self) + sum(sys.getsizeof(getattr(self, field)) for field in self.__slots__)
+                + sum(duplicate.nbytes() for duplicate in self.duplicates))
+
+    def __repr__(self):
+        return "FileRecord(%r, %r)" % (self.file_title, self.file_url)
+
+
+def iter_records(vb, response, page_size=100, constraint=None):
+    """
+    Yields the hits of a send_query(..., include=()) response as lists of FileRecords,
+    best first, looking up the metadata of one page of page_size ids at a time. Hits
+    standing for a group of near-duplicates get the group's files matching constraint;
+    when the representative itself does not match, its first matching member stands in.
+    """
+
+    ids = response["ids"][0]
+    scores = response["scores"][0]
+
+    for start in range(0, len(ids), page_size):
+        page = ids[start:start + page_size]
+        metadatas = vb.records(page)["metadatas"]
+        members = vb.members(page)
+
+        records = []
+        for doc_id, score in zip(page, scores[start:start + page_size]):
+            if doc_id not in metadatas:
+                continue
+            files = [(doc_id, metadatas[doc_id])] + members.get(doc_id, [])
+            files = [(file_id, metadata) for file_id, metadata in files if matches(metadata, constraint)]
+            if files:
+                (file_id, metadata), duplicates = files[0], files[1:]
+                records.append(FileRecord(file_id, score, metadata,
+                                          [FileRecord(member_id, score, member) for member_id, member in duplicates]))
+        yield records
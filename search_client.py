@@ -0,0 +1,97 @@
+import json
+import socket
+import http.client
+
+from urllib.parse import urlparse
+
+import numpy as np
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, socket_path, timeout=60):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class SearchClient:
+    """
+    Thin client of a search service (python service.py), with the methods of VectorDB
+    that tools.py uses. url is http://host:port or unix:///path/to/socket. The model and
+    index live in the service, so many sessions share one copy and one embedding queue.
+    """
+
+    # No model in this process, see the service /stats for its load time.
+    model = None
+
+    def __init__(self, url, timeout=60):
+        self.url = url
+        self.timeout = timeout
+        self.open_seconds = 0.0
+
+        parsed = urlparse(url)
+        if parsed.scheme == "unix":
+            self.connection = lambda: UnixHTTPConnection(parsed.path, timeout)
+        elif parsed.scheme == "http":
+            self.connection = lambda: http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=timeout)
+        else:
+            raise ValueError("search service url must start with http:// or unix://, got %s" % url)
+
+    def request(self, method, path, payload=None):
+        connection = self.connection()
+        try:
+            body = None if payload is None else json.dumps(payload)
+            connection.request(method, path, body, {"Content-Type": "application/json"})
+            response = connection.getresponse()
+            result = json.loads(response.read())
+        finally:
+            connection.close()
+
+        if response.status != 200:
+            raise RuntimeError("search service %s %s failed: %s" % (method, path, result.get("error")))
+        return result
+
+    def open_db(self):
+        return self
+
+    def refresh(self):
+        generation = self.request("GET", "/refresh")["generation"]
+        # Sharded services report a list of (shard, generation) pairs, cache keys need it hashable.
+        if isinstance(generation, list):
+            generation = tuple(tuple(item) for item in generation)
+        return generation
+
+    def count(self):
+        return self.request("GET", "/count")["count"]
+
+    def stats(self):
+        return self.request("GET", "/stats")
+
+    def send_query(self, query_text, constraint=None, n_results=10, include=("metadatas", "documents")):
+        return self.request("POST", "/search", {"query_text": query_text, "constraint": constraint,
+                                                "n_results": n_results, "include": list(include)})
+
+    def latest(self, query_text, constraint=None, n_results=1, field="file_created_ts", margin=0.1, include=("metadatas",)):
+        return self.request("POST", "/latest", {"query_text": query_text, "constraint": constraint, "n_results": n_results,
+                                                "field": field, "margin": margin, "include": list(include)})["response"]
+
+    def records(self, ids, include=("metadatas",)):
+        return self.request("POST", "/records", {"ids": list(ids), "include": list(include)})
+
+    def members(self, ids):
+        return self.request("POST", "/members", {"ids": list(ids)})
+
+    def aggregate(self, constraint=None, group_by=None, depth=1, limit=20):
+        return self.request("POST", "/aggregate", {"constraint": constraint, "group_by": group_by, "depth": depth, "limit": limit})
+
+    def timestamps(self, ids, field="file_created_ts"):
+        result = self.request("POST", "/timestamps", {"ids": list(ids), "field": field})
+        return np.asarray(result["values"], dtype=np.int64), result["newest"]
+
+    def cache_info(self):
+        return self.stats()["embedding_cache"]
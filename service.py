@@ -0,0 +1,222 @@
+import os
+import json
+import time
+import queue
+import argparse
+import threading
+import socketserver
+
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from tracing import span
+
+MAX_BATCH_SIZE = int(os.getenv("SEARCH_MAX_BATCH_SIZE", "32"))
+MAX_WAIT_MS = float(os.getenv("SEARCH_MAX_WAIT_MS", "5"))
+
+
+def bucket(value):
+    # Power of two histogram bucket label: 0, 1, 2, 4, 8, ...
+    return str(0 if value <= 0 else 1 << (int(value) - 1).bit_length())
+
+
+class EmbeddingBatcher:
+    """
+    Coalesces embedding calls from concurrent requests into single model calls. The
+    first waiting call opens a batch which closes after max_wait_ms or once it holds
+    max_batch_size texts, identical texts are embedded once.
+    """
+
+    def __init__(self, embedding_function, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS):
+        self.embedding_function = embedding_function
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+
+        self.stats = {"requests": 0, "texts": 0, "batches": 0, "model_texts": 0, "max_queue_depth": 0}
+        self.batch_sizes = {}
+        self.queue_depths = {}
+
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+        self._worker.start()
+
+    def embed(self, texts):
+        future = Future()
+        depth = self._queue.qsize()
+        self._queue.put((list(texts), future))
+
+        with self._lock:
+            self.stats["max_queue_depth"] = max(self.stats["max_queue_depth"], depth)
+            self.queue_depths[bucket(depth)] = self.queue_depths.get(bucket(depth), 0) + 1
+
+        return future.result()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            size = len(batch[0][0])
+            deadline = time.monotonic() + self.max_wait
+
+            while size < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+                size += len(batch[-1][0])
+
+            self._embed(batch)
+
+    def _embed(self, batch):
+        unique = {}
+        for texts, future in batch:
+            for text in texts:
+                unique.setdefault(text, len(unique))
+
+        with self._lock:
+            self.stats["requests"] += len(batch)
+            self.stats["texts"] += sum(len(texts) for texts, future in batch)
+            self.stats["batches"] += 1
+            self.stats["model_texts"] += len(unique)
+            self.batch_sizes[bucket(len(unique))] = self.batch_sizes.get(bucket(len(unique)), 0) + 1
+
+        try:
+            with span("embed_batch", texts=len(unique), requests=len(batch)):
+                vectors = self.embedding_function(list(unique))
+        except Exception as e:
+            for texts, future in batch:
+                future.set_exception(e)
+            return
+
+        for texts, future in batch:
+            future.set_result([vectors[unique[text]] for text in texts])
+
+    def info(self):
+        with self._lock:
+            return dict(self.stats,
+                        queue_depth=self._queue.qsize(),
+                        max_batch_size=self.max_batch_size,
+                        max_wait_ms=self.max_wait * 1000,
+                        batch_size_histogram=dict(sorted(self.batch_sizes.items(), key=lambda item: int(item[0]))),
+                        queue_depth_histogram=dict(sorted(self.queue_depths.items(), key=lambda item: int(item[0]))))
+
+
+def to_json(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, tuple):
+        return list(value)
+    raise TypeError("%r is not JSON serializable" % type(value))
+
+
+class SearchHandler(BaseHTTPRequestHandler):
+    """
+    JSON over HTTP: GET /count, /refresh, /stats and POST /search, /latest, /records,
+    /members, /aggregate, /timestamps with the keyword arguments of the engine method
+    of the same name.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        engine, batcher = self.server.engine, self.server.batcher
+
+        if self.path == "/count":
+            self.reply({"count": engine.count()})
+        elif self.path == "/refresh":
+            self.reply({"generation": engine.refresh()})
+        elif self.path == "/stats":
+            from engine import startup_report
+            self.reply({"batcher": batcher.info(), "embedder": engine.model.info(), "embedding_cache": engine.cache_info(),
+                        "startup": startup_report()})
+        else:
+            self.reply({"error": "unknown path " + self.path}, 404)
+
+    def do_POST(self):
+        engine = self.server.engine
+        params = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+
+        try:
+            if self.path == "/search":
+                params["include"] = tuple(params.get("include", ("metadatas", "documents")))
+                self.reply(engine.send_query(**params))
+            elif self.path == "/latest":
+                params["include"] = tuple(params.get("include", ("metadatas",)))
+                self.reply({"response": engine.latest(**params)})
+            elif self.path == "/records":
+                self.reply(engine.records(params["ids"], tuple(params.get("include", ("metadatas",)))))
+            elif self.path == "/members":
+                self.reply(engine.members(params["ids"]))
+            elif self.path == "/aggregate":
+                self.reply(engine.aggregate(**params))
+            elif self.path == "/timestamps":
+                values, newest = engine.timestamps(params["ids"], params.get("field", "file_created_ts"))
+                self.reply({"values": values, "newest": newest})
+            else:
+                self.reply({"error": "unknown path " + self.path}, 404)
+        except Exception as e:
+            self.reply({"error": "%s: %s" % (type(e).__name__, e)}, 500)
+
+    def reply(self, payload, status=200):
+        body = json.dumps(payload, default=to_json).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class UnixSearchServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, address = super().get_request()
+        # BaseHTTPRequestHandler expects a (host, port) style client address.
+        return request, ("unix", 0)
+
+
+def make_server(engine, host="127.0.0.1", port=8765, unix_socket=None, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS):
+    """
+    A server sharing one engine (model, index and store) between all clients, with its
+    model calls going through an EmbeddingBatcher.
+    """
+
+    if unix_socket:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = UnixSearchServer(unix_socket, SearchHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), SearchHandler)
+        server.daemon_threads = True
+
+    server.engine = engine
+    server.batcher = EmbeddingBatcher(lambda texts: engine.model.load()(texts), max_batch_size, max_wait_ms)
+    engine.model.batcher = server.batcher
+
+    return server
+
+
+if __name__ == "__main__":
+    from engine import get_engine
+
+    parser = argparse.ArgumentParser(description="Local search service owning the model and index, see search_client.SearchClient.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--socket", default=None, help="listen on this Unix socket instead of TCP")
+    parser.add_argument("--max-batch-size", type=int, default=MAX_BATCH_SIZE)
+    parser.add_argument("--max-wait-ms", type=float, default=MAX_WAIT_MS)
+    args = parser.parse_args()
+
+    server = make_server(get_engine(), args.host, args.port, args.socket, args.max_batch_size, args.max_wait_ms)
+    print("Serving", args.socket or "http://%s:%d" % (args.host, args.port))
+    server.serve_forever()
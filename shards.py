@@ -0,0 +1,465 @@
+import os
+import re
+import json
+import time
+import queue
+import threading
+import contextvars
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from db import VectorDB, LazyEmbeddingFunction
+from embedding_cache import EmbeddingCache, CachedEmbeddingFunction
+from embedder import MODEL_NAME, model_id
+from ingest import ingest, read_chunks
+from query import fuse_responses
+from metadata_index import merge_aggregates, summarize
+from tracing import span
+
+PARTITIONS = [["source"], ["source", "file_type"]]
+
+REGISTRY_VERSION = 1
+
+# End the chunks handed to a shard's ingest thread, _FAILED when reading the CSV failed.
+_DONE = object()
+_FAILED = object()
+
+
+def slug(value):
+    return re.sub(r"[^a-z0-9]+", "_", str(value).lower()).strip("_") or "none"
+
+
+def constraint_values(constraint, field):
+    """
+    Values field is restricted to by an equality or $in, at the top level of the
+    constraint or inside its $and. None when the field is unrestricted.
+    """
+
+    if not constraint:
+        return None
+
+    clauses = constraint["$and"] if "$and" in constraint else [constraint]
+    values = None
+
+    for clause in clauses:
+        if field not in clause:
+            continue
+
+        condition = clause[field]
+        if not isinstance(condition, dict):
+            allowed = {condition}
+        elif "$eq" in condition:
+            allowed = {condition["$eq"]}
+        elif "$in" in condition:
+            allowed = set(condition["$in"])
+        else:
+            continue
+
+        values = allowed if values is None else values & allowed
+
+    return values
+
+
+def merge_rankings(responses, n_results, include=("metadatas", "documents")):
+    """
+    Merges the unfused rankings of several shards into one response for fuse_responses.
+    Every shard list stays a ranking of its own, so fusion compares ranks and never the
+    scores themselves: BM25 scores depend on each shard's statistics, and exact and ANN
+    (Chroma) shards report distances on different scales. Title matches in any shard
+    win, as they do in a single store, merged newest first into one list.
+    """
+
+    titles = [response for response in responses if response["kinds"] == ["title"]]
+
+    if titles:
+        hits = [(created, response["ids"][0][i], [response[field][0][i] for field in include])
+                for response in titles for i, created in enumerate(response["timestamps"][0])]
+        hits = sorted(hits, key=lambda hit: -hit[0])[:n_results]
+
+        response = {"ids": [[hit[1] for hit in hits]], "distances": [None], "kinds": ["title"],
+                    "timestamps": [[hit[0] for hit in hits]]}
+        for f, field in enumerate(include):
+            response[field] = [[hit[2][f] for hit in hits]]
+        return response
+
+    response = {"ids": [], "distances": [], "kinds": []}
+    for field in include:
+        response[field] = []
+
+    for shard in responses:
+        for j, kind in enumerate(shard["kinds"]):
+            response["ids"].append(shard["ids"][j])
+            response["distances"].append(shard["distances"][j] if kind == "vector" else None)
+            response["kinds"].append(kind)
+            for field in include:
+                response[field].append(shard[field][j])
+
+    return response
+
+
+class ShardedVectorDB:
+    """
+    One VectorDB per source (optionally per source and file_type) under path/shards,
+    sharing the embedding model and cache. Queries constrained to a source only touch
+    its shard, others fan out to every shard in parallel. Each shard keeps its own
+    manifest and generation, so one can be re-ingested while the others keep serving.
+    """
+
+    def __init__(self, path="my_vectordb", partition=None, collection_name="my_collection3", model_name=MODEL_NAME,
+                 exact_threshold=20000, backend="chroma", vector_dtype="float32", max_workers=8, read_only_cache=False,
+                 model=None):
+        self.path = path
+        self.collection_name = collection_name
+        self.model_name = model_name
+        self.exact_threshold = exact_threshold
+        self.backend_name = backend
+        self.vector_dtype = vector_dtype
+        self.max_workers = max_workers
+
+        self.registry_path = os.path.join(path, "shards.json")
+        self.registry_mtime = None
+        self.partition = None
+        self.keys = {}
+        self.load_registry()
+
+        if partition is not None:
+            partition = list(partition)
+            if partition not in PARTITIONS:
+                raise ValueError("partition must be one of %s" % PARTITIONS)
+            if self.partition is not None and self.partition != partition:
+                raise ValueError("%s is sharded by %s, ingest into a new path to shard by %s" % (path, self.partition, partition))
+            self.partition = partition
+
+        self.partition = self.partition or PARTITIONS[0]
+
+        self.embedding_cache = EmbeddingCache(os.path.join(path, "embedding_cache"), model_id(model_name),
+                                              read_only=read_only_cache)
+        self.model = model or LazyEmbeddingFunction(model_name)
+        self.embedding_function = CachedEmbeddingFunction(self.model, self.embedding_cache)
+
+        self.shards = {}
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def load_registry(self):
+        if not os.path.exists(self.registry_path):
+            return
+
+        self.registry_mtime = os.path.getmtime(self.registry_path)
+        with open(self.registry_path) as f:
+            state = json.load(f)
+
+        self.partition = state["partition"]
+        self.keys = state["shards"]
+
+    def save_registry(self):
+        os.makedirs(self.path, exist_ok=True)
+        tmp_path = self.registry_path + ".tmp"
+
+        with open(tmp_path, "w") as f:
+            json.dump({"version": REGISTRY_VERSION, "partition": self.partition, "shards": self.keys}, f, indent=2)
+
+        os.replace(tmp_path, self.registry_path)
+        self.registry_mtime = os.path.getmtime(self.registry_path)
+
+    def shard(self, name):
+        with self._lock:
+            if name not in self.shards:
+                self.shards[name] = VectorDB(None,
+                                             path=os.path.join(self.path, "shards", name),
+                                             collection_name="%s_%s" % (self.collection_name, name),
+                                             model_name=self.model_name,
+                                             exact_threshold=self.exact_threshold,
+                                             backend=self.backend_name,
+                                             vector_dtype=self.vector_dtype,
+                                             embedding_cache=self.embedding_cache,
+                                             model=self.model)
+            return self.shards[name]
+
+    def open_db(self):
+        started = time.perf_counter()
+
+        for name in self.keys:
+            self.shard(name).open_db()
+
+        self.open_seconds = time.perf_counter() - started
+        return self
+
+    def executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="shard")
+        return self._executor
+
+    def refresh(self):
+        """
+        Picks up shards registered and generations saved by separate ingest runs.
+        Returns the generations of all shards, which change whenever any shard changes.
+        """
+
+        if os.path.exists(self.registry_path) and os.path.getmtime(self.registry_path) != self.registry_mtime:
+            self.load_registry()
+            self.open_db()
+
+        return tuple(sorted((name, self.shard(name).refresh()) for name in self.keys))
+
+    def route(self, constraint):
+        """
+        Names of the shards that can hold rows matching the constraint.
+        """
+
+        allowed = [constraint_values(constraint, field) for field in self.partition]
+        names = []
+
+        for name, key in sorted(self.keys.items()):
+            if all(values is None or key[field] in values for field, values in zip(self.partition, allowed)):
+                names.append(name)
+
+        return names
+
+    def embed_once(self):
+        """
+        An embed(query_texts) for the shards answering one query: the first call embeds,
+        the others reuse its vectors.
+        """
+
+        lock = threading.Lock()
+        embedded = {}
+
+        def embed(query_texts):
+            with lock:
+                if "embeddings" not in embedded:
+                    embedded["embeddings"] = self.embedding_function(query_texts)
+            return embedded["embeddings"]
+
+        return embed
+
+    def fan_out(self, names, method, *args):
+        """
+        Results of calling method of each named shard with args, in parallel on the
+        shard executor when there is more than one.
+        """
+
+        if len(names) == 1:
+            return [getattr(self.shard(names[0]), method)(*args)]
+
+        futures = [self.executor().submit(contextvars.copy_context().run, getattr(self.shard(name), method), *args)
+                   for name in names]
+        return [future.result() for future in futures]
+
+    def send_query(self, query_text, constraint=None, n_results=10, include=("metadatas", "documents")):
+        """
+        VectorDB.send_query over the shards the constraint routes to. The query is embedded
+        once for all of them. Every shard ranking stays a list of its own and all of them
+        are fused by rank (see merge_rankings), as the lists of one store are.
+        """
+
+        names = self.route(constraint)
+
+        with span("send_query", n_results=n_results, shards=len(names)):
+            responses = self.fan_out(names, "rankings", query_text, constraint, n_results, self.embed_once(), include)
+
+            with span("fuse"):
+                if not responses:
+                    return dict({field: [[]] for field in include}, ids=[[]], scores=[[]], distances=[[]])
+                return fuse_responses(merge_rankings(responses, n_results, include), limit=n_results)
+
+    def latest(self, query_text, constraint=None, n_results=1, field="file_created_ts", margin=0.1, include=("metadatas",)):
+        """
+        VectorDB.latest over the shards the constraint routes to, queried in parallel with
+        the query embedded once. Hits are the exact title matches of all shards when there
+        are any, otherwise those within margin of the best hit of all shards; the newest of
+        them win. None when a shard cannot evaluate the constraint.
+        """
+
+        names = self.route(constraint)
+        embed = self.embed_once()
+
+        best = [score for score in self.fan_out(names, "best_score", query_text, constraint, embed) if score is not None]
+        threshold = max(best) - margin if best else float("inf")
+
+        responses = self.fan_out(names, "latest", query_text, constraint, n_results, field, margin, include, embed,
+                                 threshold)
+        if any(response is None for response in responses):
+            return None
+
+        # Exact title matches of any shard are the answer, as in VectorDB.latest.
+        titles = [response for response in responses if response.get("kinds") == ["title"]]
+        responses = titles or responses
+
+        hits = sorted(((response["timestamps"][0][i], j, i) for j, response in enumerate(responses)
+                       for i in range(len(response["ids"][0]))), reverse=True)[:n_results]
+
+        merged = {}
+        for key in ["ids", "scores", "timestamps"] + list(include):
+            merged[key] = [[responses[j][key][0][i] for timestamp, j, i in hits]]
+        merged["distances"] = [None]
+        if titles:
+            merged["kinds"] = ["title"]
+
+        return merged
+
+    def timestamps(self, ids, field="file_created_ts"):
+        values = np.zeros(len(ids), dtype=np.int64)
+        newest = 0
+
+        for name in sorted(self.keys):
+            shard = self.shard(name)
+            found = np.array([doc_id in shard.index.positions for doc_id in ids], dtype=bool)
+            shard_values, shard_newest = shard.timestamps(ids, field)
+            values[found] = shard_values[found]
+            newest = max(newest, shard_newest)
+
+        return values, newest
+
+    def records(self, ids, include=("metadatas",)):
+        """
+        VectorDB.records over all shards, each id is found in one of them.
+        """
+
+        records = {field: {} for field in include}
+        for name in sorted(self.keys):
+            for field, values in self.shard(name).records(ids, include).items():
+                records[field].update(values)
+
+        return records
+
+    def members(self, ids):
+        members = {}
+        for name in sorted(self.keys):
+            members.update(self.shard(name).members(ids))
+        return members
+
+    def shard_names(self, chunk):
+        """
+        Shard name of every row of a DataFrame chunk.
+        """
+
+        names = None
+        for field in self.partition:
+            column = chunk[field].astype(str)
+            slugs = column.map({value: slug(value) for value in column.unique()})
+            names = slugs if names is None else names + "__" + slugs
+        return names
+
+    def create_db_from_csv(self, csv_path, chunksize=10000, batch_size=256, shards=None, rebuild=False, content_dir=None, workers=None,
+                           dedup=None):
+        """
+        Syncs the shards with the CSV, or only the named ones, in a single pass over it:
+        every chunk is split between the shards, each ingested on its own thread into its
+        own store, so the others keep serving untouched. Registered shards without rows in
+        the CSV are emptied. Returns a report per shard.
+        content_dir and dedup apply to every shard as in VectorDB.create_db_from_csv.
+        """
+
+        wanted = None if shards is None else set(shards)
+        queues = {}
+        threads = []
+        reports = {}
+        failures = []
+
+        def run(name, vb, batches):
+            state = {"done": False}
+
+            def chunks():
+                while True:
+                    chunk = batches.get()
+                    if chunk is _DONE:
+                        state["done"] = True
+                        return
+                    if chunk is _FAILED:
+                        # Stops before ingest deletes the rows it has not seen.
+                        raise RuntimeError("reading %s failed, shard %s not synced" % (csv_path, name))
+                    yield chunk
+
+            try:
+                shard_chunks = chunks()
+                if content_dir:
+                    from extract import with_content
+                    shard_chunks = with_content(shard_chunks, content_dir, os.path.join(vb.path, "extracted"), workers)
+                reports[name] = ingest(vb, shard_chunks, batch_size=batch_size, rebuild=rebuild, dedup=dedup)
+            except Exception as e:
+                failures.append(e)
+                # Keeps taking chunks, so the reader never blocks on a failed shard.
+                while not state["done"]:
+                    state["done"] = batches.get() is _DONE
+
+        def start(name):
+            vb = self.shard(name)
+            vb.open_db()
+            print("Ingesting shard", name)
+            queues[name] = queue.Queue(maxsize=2)
+            thread = threading.Thread(target=run, args=(name, vb, queues[name]), name="ingest-" + name, daemon=True)
+            thread.start()
+            threads.append(thread)
+
+        try:
+            for name in sorted(self.keys):
+                if wanted is None or name in wanted:
+                    start(name)
+
+            for chunk in read_chunks(csv_path, chunksize):
+                names = self.shard_names(chunk).values
+
+                for name in sorted(set(names)):
+                    rows = chunk[names == name]
+                    if name not in self.keys:
+                        self.keys[name] = {field: str(rows[field].iloc[0]) for field in self.partition}
+                    if name not in queues and (wanted is None or name in wanted):
+                        start(name)
+                    if name in queues:
+                        queues[name].put(rows)
+        except BaseException:
+            for batches in queues.values():
+                batches.put(_FAILED)
+            raise
+        finally:
+            for batches in queues.values():
+                batches.put(_DONE)
+            for thread in threads:
+                thread.join()
+
+        self.save_registry()
+
+        if failures:
+            raise failures[0]
+
+        unknown = sorted(wanted - set(self.keys)) if wanted is not None else []
+        if unknown:
+            raise ValueError("unknown shards %s, shards are %s" % (unknown, sorted(self.keys)))
+
+        return {name: reports[name] for name in sorted(reports)}
+
+    def count(self):
+        return sum(self.shard(name).count() for name in self.keys)
+
+    def aggregate(self, constraint=None, group_by=None, depth=1, limit=20):
+        """
+        VectorDB.aggregate over the shards the constraint routes to.
+        """
+
+        with span("aggregate", group_by=group_by):
+            return summarize(merge_aggregates(self.shard(name).aggregate_groups(constraint, group_by, depth)
+                                              for name in self.route(constraint)), limit)
+
+    def cache_info(self):
+        return self.embedding_cache.info()
+
+    def backend_report(self, query_texts, k=10, constraint=None):
+        return [dict(report, shard=name)
+                for name in self.route(constraint)
+                for report in self.shard(name).backend_report(query_texts, k, constraint)]
+
+    def get_all(self, contraint):
+        results = {"ids": [], "metadatas": []}
+
+        for name in self.route(contraint):
+            shard_results = self.shard(name).get_all(contraint)
+            results["ids"] += list(shard_results["ids"])
+            results["metadatas"] += list(shard_results["metadatas"])
+
+        return results
@@ -0,0 +1,444 @@
+import os
+import gzip
+import json
+import time
+import shutil
+import sqlite3
+import hashlib
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from db import VectorDB, METADATA_COLUMNS, TIMESTAMP_COLUMNS
+from shards import ShardedVectorDB
+from backends import ChromaBackend, make_backend
+from metadata_index import ColumnarIndex
+from manifest import IngestManifest
+from embedder import MODEL_NAME, model_id
+from ingest import WRITE_BATCH_SIZE
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    # Without pyarrow the records are written as gzipped JSON lines.
+    pa = pq = None
+
+SNAPSHOT_VERSION = 1
+
+# Columns of the records file, one row per document in the row order of vectors.npy.
+RECORD_COLUMNS = ["doc_id", "document"] + METADATA_COLUMNS + list(TIMESTAMP_COLUMNS)
+INTEGER_COLUMNS = ["file_size"] + list(TIMESTAMP_COLUMNS)
+
+HASH_BLOCK = 1 << 20
+
+
+def stored_backend(path):
+    """
+    Backend recorded in the manifest of the store at path (of its first shard if
+    sharded), "chroma" when there is none.
+    """
+
+    if os.path.exists(os.path.join(path, "shards.json")):
+        shards_dir = os.path.join(path, "shards")
+        names = sorted(os.listdir(shards_dir)) if os.path.isdir(shards_dir) else []
+        return stored_backend(os.path.join(shards_dir, names[0])) if names else "chroma"
+
+    manifest_path = os.path.join(path, "manifest.json")
+    if not os.path.exists(manifest_path):
+        return "chroma"
+    with open(manifest_path) as f:
+        return json.load(f).get("backend", "chroma")
+
+
+def stored_dtype(path):
+    """
+    Vector dtype of the columnar index of the store at path (of its first shard if
+    sharded), "float32" when there is none.
+    """
+
+    if os.path.exists(os.path.join(path, "shards.json")):
+        shards_dir = os.path.join(path, "shards")
+        names = sorted(os.listdir(shards_dir)) if os.path.isdir(shards_dir) else []
+        return stored_dtype(os.path.join(shards_dir, names[0])) if names else "float32"
+
+    current = os.path.join(path, "columnar_index", "CURRENT")
+    if not os.path.exists(current):
+        return "float32"
+    with open(current) as f:
+        directory = os.path.join(path, "columnar_index", f.read().strip())
+    return str(np.load(os.path.join(directory, "columns.npz"))["dtype"])
+
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def copy_sqlite(conn, lock, path):
+    """
+    Consistent copy of an open sqlite database, taken with the online backup API.
+    """
+
+    target = sqlite3.connect(path)
+    try:
+        with lock:
+            conn.backup(target)
+    finally:
+        target.close()
+
+
+def record_frame(ids, records):
+    frame = pd.DataFrame([dict(records["metadatas"][doc_id], doc_id=doc_id, document=records["documents"][doc_id])
+                          for doc_id in ids], columns=RECORD_COLUMNS)
+    for column in RECORD_COLUMNS:
+        if column in INTEGER_COLUMNS:
+            frame[column] = pd.to_numeric(frame[column], errors="coerce").fillna(0).astype("int64")
+        else:
+            frame[column] = frame[column].map(lambda value: None if value is None or value != value else str(value))
+    return frame
+
+
+def write_records(vb, ids, directory, page_size=WRITE_BATCH_SIZE):
+    """
+    Writes the documents and metadata of ids, in that order, to records.parquet (or
+    records.jsonl.gz without pyarrow) one page at a time. Returns the file name.
+    """
+
+    if pq is not None:
+        name = "records.parquet"
+        schema = pa.schema([(column, pa.int64() if column in INTEGER_COLUMNS else pa.string()) for column in RECORD_COLUMNS])
+        writer = pq.ParquetWriter(os.path.join(directory, name), schema)
+    else:
+        name = "records.jsonl.gz"
+        writer = gzip.open(os.path.join(directory, name), "wt", encoding="utf-8")
+
+    try:
+        for start in range(0, len(ids), page_size):
+            page = ids[start:start + page_size]
+            records = vb.records(page, include=("documents", "metadatas"))
+            missing = [doc_id for doc_id in page if doc_id not in records["metadatas"]]
+            if missing:
+                raise ValueError("%d indexed documents are missing from the backend, e.g. %s" % (len(missing), missing[0]))
+
+            frame = record_frame(page, records)
+            if pq is not None:
+                writer.write_table(pa.Table.from_pandas(frame, schema=schema, preserve_index=False))
+            else:
+                writer.write(frame.to_json(orient="records", lines=True, force_ascii=False))
+    finally:
+        writer.close()
+
+    return name
+
+
+def read_records(path, page_size=WRITE_BATCH_SIZE):
+    """
+    Yields (ids, documents, metadatas) pages of a records file.
+    """
+
+    if path.endswith(".parquet"):
+        if pq is None:
+            raise RuntimeError("pyarrow is needed to read %s" % path)
+        batches = (batch.to_pylist() for batch in pq.ParquetFile(path).iter_batches(batch_size=page_size))
+    else:
+        def batches():
+            rows = []
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                for line in f:
+                    rows.append(json.loads(line))
+                    if len(rows) == page_size:
+                        yield rows
+                        rows = []
+            if rows:
+                yield rows
+        batches = batches()
+
+    for rows in batches:
+        yield ([row["doc_id"] for row in rows],
+               [row["document"] for row in rows],
+               # Stores reject None metadata values, missing fields are left out as at ingest.
+               [{column: row[column] for column in RECORD_COLUMNS[2:] if row.get(column) is not None} for row in rows])
+
+
+def export_store(vb, directory):
+    """
+    Snapshot of one store into the empty directory: records, the columnar index
+    (vectors.npy and scales.npy as stored, columns.npz), the lexical and dedup sqlite
+    files and the manifest. Returns the snapshot description, written as SNAPSHOT.json
+    with the size and sha256 of every file.
+    """
+
+    vb.open_db()
+    vb.refresh()
+
+    if not vb.index.load() or vb.index.generation != vb.manifest.generation or vb.lexical.generation != vb.manifest.generation:
+        raise ValueError("%s has stale indexes, run ingest before exporting it" % vb.path)
+
+    with open(os.path.join(vb.index.path, "CURRENT")) as f:
+        generation_dir = os.path.join(vb.index.path, f.read().strip())
+
+    shutil.copyfile(os.path.join(generation_dir, "columns.npz"), os.path.join(directory, "columns.npz"))
+    shutil.copyfile(os.path.join(generation_dir, "embeddings.npy"), os.path.join(directory, "vectors.npy"))
+    if os.path.exists(os.path.join(generation_dir, "scales.npy")):
+        shutil.copyfile(os.path.join(generation_dir, "scales.npy"), os.path.join(directory, "scales.npy"))
+    if vb.backend.name == "ivf" and os.path.exists(vb.backend.path):
+        shutil.copyfile(vb.backend.path, os.path.join(directory, "ivf.npz"))
+
+    records = write_records(vb, vb.index.ids.tolist(), directory)
+
+    copy_sqlite(vb.lexical.connect(), vb.lexical._lock, os.path.join(directory, "lexical.sqlite"))
+    if vb.dedup.enabled:
+        copy_sqlite(vb.dedup.connect(), vb.dedup._lock, os.path.join(directory, "dedup.sqlite"))
+    shutil.copyfile(vb.manifest.path, os.path.join(directory, "manifest.json"))
+
+    vectors = np.load(os.path.join(directory, "vectors.npy"), mmap_mode="r")
+    columns = np.load(os.path.join(directory, "columns.npz"))
+    description = {"version": SNAPSHOT_VERSION,
+                   "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                   "generation": vb.manifest.generation,
+                   "backend": vb.backend.name,
+                   "model": model_id(vb.model_name),
+                   "vector_dtype": str(columns["dtype"]),
+                   "rows": len(vb.index),
+                   "dimensions": int(vectors.shape[1]) if vectors.ndim == 2 else 0,
+                   "records": records,
+                   "files": {}}
+
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        description["files"][name] = {"bytes": os.path.getsize(path), "sha256": sha256_file(path)}
+
+    with open(os.path.join(directory, "SNAPSHOT.json"), "w") as f:
+        json.dump(description, f, indent=2)
+
+    return description
+
+
+def export_snapshot(vb, directory):
+    """
+    Exports a VectorDB, or every shard of a ShardedVectorDB (under shards/<name> with
+    the shard registry), to a new snapshot directory. The snapshot is written next to
+    it and renamed into place once complete.
+    """
+
+    if os.path.exists(directory):
+        raise ValueError("%s already exists" % directory)
+
+    parent = os.path.dirname(os.path.abspath(directory))
+    os.makedirs(parent, exist_ok=True)
+    staging = tempfile.mkdtemp(prefix=os.path.basename(directory) + ".exporting-", dir=parent)
+
+    try:
+        if isinstance(vb, ShardedVectorDB):
+            vb.refresh()
+            for name in sorted(vb.keys):
+                os.makedirs(os.path.join(staging, "shards", name))
+                export_store(vb.shard(name), os.path.join(staging, "shards", name))
+            shutil.copyfile(vb.registry_path, os.path.join(staging, "shards.json"))
+
+            description = {"version": SNAPSHOT_VERSION,
+                           "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                           "model": model_id(vb.model_name),
+                           "shards": sorted(vb.keys),
+                           "files": {"shards.json": {"bytes": os.path.getsize(os.path.join(staging, "shards.json")),
+                                                     "sha256": sha256_file(os.path.join(staging, "shards.json"))}}}
+            with open(os.path.join(staging, "SNAPSHOT.json"), "w") as f:
+                json.dump(description, f, indent=2)
+        else:
+            description = export_store(vb, staging)
+
+        os.rename(staging, directory)
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+
+    return description
+
+
+def verify_snapshot(directory):
+    """
+    Checks the version, size and sha256 of every file of a snapshot (and of its shards).
+    Returns the snapshot description, raises ValueError on the first mismatch.
+    """
+
+    path = os.path.join(directory, "SNAPSHOT.json")
+    if not os.path.exists(path):
+        raise ValueError("%s is not a snapshot, SNAPSHOT.json is missing" % directory)
+
+    with open(path) as f:
+        description = json.load(f)
+
+    if description.get("version") != SNAPSHOT_VERSION:
+        raise ValueError("%s has snapshot version %s, this version reads %d" % (directory, description.get("version"), SNAPSHOT_VERSION))
+
+    for name, expected in description["files"].items():
+        file_path = os.path.join(directory, name)
+        if not os.path.exists(file_path):
+            raise ValueError("%s is missing from %s" % (name, directory))
+        if os.path.getsize(file_path) != expected["bytes"] or sha256_file(file_path) != expected["sha256"]:
+            raise ValueError("%s in %s does not match its checksum" % (name, directory))
+
+    if "shards" in description:
+        for name in description["shards"]:
+            shard = verify_snapshot(os.path.join(directory, "shards", name))
+            if shard["model"] != description["model"]:
+                raise ValueError("shard %s was embedded with %s, not %s" % (name, shard["model"], description["model"]))
+    else:
+        vectors = np.load(os.path.join(directory, "vectors.npy"), mmap_mode="r")
+        if len(vectors) != description["rows"]:
+            raise ValueError("vectors.npy of %s has %d rows, expected %d" % (directory, len(vectors), description["rows"]))
+
+    return description
+
+
+def load_store(directory, description, path, backend, collection_name, page_size=WRITE_BATCH_SIZE):
+    """
+    Builds a store of the given backend in the empty directory path from a verified
+    snapshot, without embedding anything.
+    """
+
+    generation = description["generation"]
+
+    index_path = os.path.join(path, "columnar_index")
+    generation_dir = os.path.join(index_path, "gen-%d-snapshot" % generation)
+    os.makedirs(generation_dir)
+    shutil.copyfile(os.path.join(directory, "columns.npz"), os.path.join(generation_dir, "columns.npz"))
+    shutil.copyfile(os.path.join(directory, "vectors.npy"), os.path.join(generation_dir, "embeddings.npy"))
+    if os.path.exists(os.path.join(directory, "scales.npy")):
+        shutil.copyfile(os.path.join(directory, "scales.npy"), os.path.join(generation_dir, "scales.npy"))
+    with open(os.path.join(index_path, "CURRENT"), "w") as f:
+        f.write(os.path.basename(generation_dir))
+
+    shutil.copyfile(os.path.join(directory, "lexical.sqlite"), os.path.join(path, "lexical.sqlite"))
+    if os.path.exists(os.path.join(directory, "dedup.sqlite")):
+        shutil.copyfile(os.path.join(directory, "dedup.sqlite"), os.path.join(path, "dedup.sqlite"))
+
+    index = ColumnarIndex(index_path, dtype=description["vector_dtype"])
+    index.load()
+    records = os.path.join(directory, description["records"])
+
+    if backend == "chroma":
+        store = ChromaBackend(path, collection_name).open()
+        for ids, documents, metadatas in read_records(records, page_size):
+            rows = np.array([index.positions[doc_id] for doc_id in ids], dtype=np.int64)
+            store.upsert(ids, index.vectors(rows).tolist(), documents, metadatas)
+    else:
+        store = make_backend(backend, path, collection_name, index)
+        for ids, documents, metadatas in read_records(records, page_size):
+            store.records.upsert(ids, documents, metadatas)
+        if backend == "ivf":
+            if description["backend"] == "ivf" and os.path.exists(os.path.join(directory, "ivf.npz")):
+                shutil.copyfile(os.path.join(directory, "ivf.npz"), store.path)
+            else:
+                store.save(generation)
+
+    # The manifest lets later ingest runs into this store stay incremental.
+    with open(os.path.join(directory, "manifest.json")) as f:
+        entries = json.load(f)["entries"]
+    manifest = IngestManifest(os.path.join(path, "manifest.json"), backend)
+    manifest.entries = entries
+    manifest.generation = generation
+    manifest.save()
+
+
+def load_snapshot(directory, path, backend=None, collection_name="my_collection3", model_name=MODEL_NAME, verify=True):
+    """
+    Replaces the store at path with a snapshot: the new store is built next to path
+    and swapped in with two renames, the old one is only removed once the new one is
+    in place. Between the renames path does not exist, so a process opening the store
+    just then fails and has to retry; processes that opened it before keep the old
+    files. backend defaults to the snapshot's. Queries are embedded with model_name,
+    which must be the model the snapshot was embedded with.
+    """
+
+    if verify:
+        description = verify_snapshot(directory)
+    else:
+        with open(os.path.join(directory, "SNAPSHOT.json")) as f:
+            description = json.load(f)
+
+    if description["model"] != model_id(model_name):
+        raise ValueError("the snapshot was embedded with %s, queries would be embedded with %s" % (description["model"], model_id(model_name)))
+
+    parent = os.path.dirname(os.path.abspath(path))
+    os.makedirs(parent, exist_ok=True)
+    staging = tempfile.mkdtemp(prefix=os.path.basename(path) + ".loading-", dir=parent)
+    started = time.perf_counter()
+
+    rows = None
+
+    try:
+        if "shards" in description:
+            for name in description["shards"]:
+                shard_dir = os.path.join(directory, "shards", name)
+                with open(os.path.join(shard_dir, "SNAPSHOT.json")) as f:
+                    shard = json.load(f)
+                os.makedirs(os.path.join(staging, "shards", name))
+                load_store(shard_dir, shard, os.path.join(staging, "shards", name), backend or shard["backend"],
+                           "%s_%s" % (collection_name, name))
+                rows = (rows or 0) + shard["rows"]
+            shutil.copyfile(os.path.join(directory, "shards.json"), os.path.join(staging, "shards.json"))
+        else:
+            load_store(directory, description, staging, backend or description["backend"], collection_name)
+            rows = description["rows"]
+
+        previous = None
+        if os.path.exists(path):
+            previous = tempfile.mkdtemp(prefix=os.path.basename(path) + ".previous-", dir=parent)
+            os.rename(path, os.path.join(previous, "store"))
+        os.rename(staging, path)
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+
+    if previous is not None:
+        shutil.rmtree(previous, ignore_errors=True)
+
+    report = {"path": path, "rows": rows, "shards": description.get("shards"),
+              "seconds": round(time.perf_counter() - started, 3)}
+    print("Snapshot load report", report)
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Export, verify and load index snapshots.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = commands.add_parser("export", help="write a snapshot of the store at --path")
+    export_parser.add_argument("snapshot")
+    export_parser.add_argument("--path", default="my_vectordb")
+    export_parser.add_argument("--backend", default=None, help="defaults to the backend in the store's manifest")
+    export_parser.add_argument("--vector-dtype", default=None, help="defaults to the dtype the store's vectors are kept in")
+
+    verify_parser = commands.add_parser("verify", help="check the checksums of a snapshot")
+    verify_parser.add_argument("snapshot")
+
+    load_parser = commands.add_parser("load", help="replace the store at --path with a snapshot")
+    load_parser.add_argument("snapshot")
+    load_parser.add_argument("--path", default="my_vectordb")
+    load_parser.add_argument("--backend", default=None, help="defaults to the backend the snapshot was exported from")
+    load_parser.add_argument("--no-verify", dest="verify", action="store_false", help="skip the checksums")
+
+    args = parser.parse_args()
+
+    if args.command == "export":
+        args.backend = args.backend or stored_backend(args.path)
+        args.vector_dtype = args.vector_dtype or stored_dtype(args.path)
+        if os.path.exists(os.path.join(args.path, "shards.json")):
+            vb = ShardedVectorDB(args.path, backend=args.backend, vector_dtype=args.vector_dtype)
+        else:
+            vb = VectorDB(None, path=args.path, backend=args.backend, vector_dtype=args.vector_dtype)
+        description = export_snapshot(vb, args.snapshot)
+        print("Exported", args.snapshot, {key: value for key, value in description.items() if key != "files"})
+    elif args.command == "verify":
+        description = verify_snapshot(args.snapshot)
+        print("Verified", args.snapshot, {key: value for key, value in description.items() if key != "files"})
+    else:
+        load_snapshot(args.snapshot, args.path, backend=args.backend, verify=args.verify)
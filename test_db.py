@@ -0,0 +1,121 @@
+import os
+import hashlib
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from db import VectorDB
+from results import iter_records
+
+CSV_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "file_info_1.csv")
+
+
+class HashEmbedding:
+    """
+    Bag of hashed words, stands in for the sentence embedding model.
+    """
+
+    def __init__(self):
+        self.texts = 0
+
+    def __call__(self, input):
+        self.texts += len(input)
+        vectors = np.zeros((len(input), 64), dtype=np.float32)
+        for i, text in enumerate(input):
+            for word in str(text).lower().split():
+                vectors[i, int(hashlib.md5(word.encode()).hexdigest(), 16) % 64] += 1
+        return list(vectors)
+
+    def info(self):
+        return None
+
+
+@pytest.fixture
+def data():
+    return pd.read_csv(CSV_PATH).head(300).reset_index(drop=True)
+
+
+def open_store(path, data=None):
+    vb = VectorDB(data, path=str(path), backend="numpy", model=HashEmbedding())
+    vb.open_db()
+    return vb
+
+
+def test_unchanged_rows_are_not_embedded_again(tmp_path, data):
+    report = open_store(tmp_path, data).create_db()
+    assert report["added"] == len(data)
+
+    vb = open_store(tmp_path, data)
+    report = vb.create_db()
+    assert (report["added"], report["updated"], report["skipped"], report["deleted"]) == (0, 0, len(data), 0)
+    assert vb.model.texts == 0
+
+    changed = data.drop(index=0).copy()
+    changed.loc[1, "generated_insights"] = "A rewritten summary of the quarterly budget"
+    vb = open_store(tmp_path, changed)
+    report = vb.create_db()
+    assert (report["added"], report["updated"], report["deleted"]) == (0, 1, 1)
+    assert vb.model.texts == 1
+    assert vb.count() == len(data) - 1
+
+
+def test_title_hits_are_the_newest(tmp_path):
+    data = pd.read_csv(CSV_PATH)
+    vb = open_store(tmp_path, data)
+    vb.create_db()
+
+    response = vb.rankings("Annual Review", n_results=5)
+
+    created = pd.to_datetime(data.loc[data["file_title"] == "Annual Review", "file_created_at"])
+    newest = sorted(created, reverse=True)[:5]
+    assert response["kinds"] == ["title"]
+    assert [pd.Timestamp(metadata["file_created_at"]) for metadata in response["metadatas"][0]] == newest
+
+
+def test_latest_answers_exact_titles_first(tmp_path):
+    data = pd.read_csv(CSV_PATH)
+    vb = open_store(tmp_path, data)
+    vb.create_db()
+
+    response = vb.latest("Annual Review", n_results=5)
+
+    titles = data.loc[data["file_title"] == "Annual Review"]
+    newest = sorted(pd.to_datetime(titles["file_created_at"]), reverse=True)[:5]
+    assert response["kinds"] == ["title"]
+    assert [pd.Timestamp(metadata["file_created_at"]) for metadata in response["metadatas"][0]] == newest
+
+    source = titles["source"].iloc[0]
+    response = vb.latest("Annual Review", {"source": source}, n_results=50)
+    assert {metadata["source"] for metadata in response["metadatas"][0]} == {source}
+    assert len(response["ids"][0]) == (titles["source"] == source).sum()
+
+
+@pytest.mark.parametrize("exact_threshold", [20000, 0])
+def test_grouped_files_are_counted_and_found_alike(tmp_path, data, exact_threshold):
+    copies = data.head(10).copy()
+    copies["file_url"] = copies["file_url"] + "?copy"
+    resized = data.iloc[10:15].copy()
+    resized["file_url"] = resized["file_url"] + "?small"
+    resized["file_size"] = 1
+    files = pd.concat([data, copies, resized])
+    csv_path = str(tmp_path / "files.csv")
+    files.to_csv(csv_path, index=False)
+
+    vb = open_store(tmp_path / "db")
+    vb.exact_threshold = exact_threshold
+    report = vb.create_db_from_csv(csv_path, dedup=3)
+    assert report["grouped"] == len(copies) + len(resized)
+
+    assert vb.aggregate()["files"] == len(files)
+    assert vb.aggregate()["file_size_sum"] == int(pd.to_numeric(files["file_size"]).sum())
+
+    # The resized files only match as members, their representatives are larger.
+    constraint = {"file_size": {"$lte": 1}}
+    response = vb.send_query(data["generated_insights"][12], constraint, n_results=50, include=())
+    records = [record for page in iter_records(vb, response, constraint=constraint) for record in page]
+    found = [file.file_url for record in records for file in [record] + record.duplicates]
+    expected = files.loc[files["file_size"] <= 1, "file_url"]
+    assert sorted(found) == sorted(expected)
+    assert set(resized["file_url"]) <= set(found)
+    assert vb.aggregate(constraint)["files"] == len(expected)
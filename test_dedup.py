@@ -0,0 +1,63 @@
+from dedup import DedupIndex, simhash, distance, group_key, matches
+
+
+def metadata(**fields):
+    record = {"source": "web", "file_type": "pdf", "file_location_at_source": "reports/weekly",
+              "file_size": 120, "file_created_ts": 1717200000, "file_updated_ts": 1717300000}
+    record.update(fields)
+    return record
+
+
+def test_simhash_ignores_numbers():
+    a = simhash("Weekly sales report for week 12, revenue 1200 units across 4 regions")
+    b = simhash("Weekly sales report for week 13, revenue 1350 units across 5 regions")
+    c = simhash("Hiring plan and onboarding checklist for the new support team")
+
+    assert distance(a, b) == 0
+    assert distance(a, c) > 3
+
+
+def test_group_key_is_source_type_and_folder():
+    key = group_key(metadata())
+
+    for field, value in [("file_title", "Copy"), ("file_size", 5), ("file_created_ts", 1717286400)]:
+        assert group_key(metadata(**{field: value})) == key
+    for field, value in [("source", "avoma"), ("file_type", "docx"), ("file_location_at_source", "reports/daily")]:
+        assert group_key(metadata(**{field: value})) != key
+
+
+def test_matches_where_clause():
+    record = metadata()
+
+    assert matches(record, None)
+    assert matches(record, {"$and": [{"source": "web"}, {"file_size": {"$lte": 1000}}]})
+    assert matches(record, {"file_location_at_source": {"$prefix": "reports/"}})
+    assert not matches(record, {"$or": [{"source": "avoma"}, {"file_type": {"$in": ["docx"]}}]})
+
+
+def test_members_are_matched_on_their_own_metadata(tmp_path):
+    index = DedupIndex(str(tmp_path / "dedup.sqlite"))
+    index.configure(3)
+    text = "Quarterly review of marketing spend and campaign results"
+
+    group_ids = index.assign(["a", "b", "c", "d"], [text] * 4,
+                             [metadata(), metadata(file_size=1), metadata(file_created_ts=1717286400), metadata(source="avoma")])
+
+    assert group_ids == ["a", "a", "a", "d"]
+    assert list(index.matching(None)) == ["a"]
+    assert index.matching({"file_size": {"$lte": 10}}) == {"a": [("b", metadata(file_size=1))]}
+    assert index.matching({"source": "avoma"}) == {}
+    assert not index.outdated
+
+
+def test_removed_representative_is_taken_over(tmp_path):
+    index = DedupIndex(str(tmp_path / "dedup.sqlite"))
+    index.configure(3)
+    text = "Customer survey results for the spring product launch"
+    index.assign(["a", "b", "c"], [text] * 3, [metadata(), metadata(), metadata()])
+
+    promoted = index.remove(["a"])
+
+    assert [doc_id for doc_id, document, record in promoted] == ["b"]
+    assert index.is_group("b") and not index.is_group("a")
+    assert index.members(["b"]) == {"b": [("c", metadata())]}
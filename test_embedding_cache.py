@@ -0,0 +1,35 @@
+import numpy as np
+
+from embedding_cache import EmbeddingCache, INITIAL_SLOTS
+
+
+def vectors(texts):
+    return [np.full(4, len(text), dtype=np.float32) for text in texts]
+
+
+def test_files_grow_on_demand(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), "model", capacity=100000, hot_size=0)
+
+    cache.put_many(["first"], vectors(["first"]))
+    assert cache.info()["slots"] == INITIAL_SLOTS
+
+    texts = ["text %d" % i for i in range(INITIAL_SLOTS + 10)]
+    cache.put_many(texts, vectors(texts))
+    assert cache.info()["slots"] == 2 * INITIAL_SLOTS
+
+    reader = EmbeddingCache(str(tmp_path), "model", capacity=100000, hot_size=0, read_only=True)
+    assert all(vector is not None for vector in reader.get_many(texts + ["first"]))
+
+
+def test_read_only_hits_count_for_eviction(tmp_path):
+    writer = EmbeddingCache(str(tmp_path), "model", capacity=4, hot_size=0)
+    writer.put_many(["a", "b", "c", "d"], vectors(["a", "b", "c", "d"]))
+
+    reader = EmbeddingCache(str(tmp_path), "model", capacity=4, hot_size=0, read_only=True)
+    assert reader.get_many(["a"])[0] is not None
+
+    writer.put_many(["e"], vectors(["e"]))
+
+    found = reader.get_many(["a", "b", "c", "d", "e"])
+    assert [vector is not None for vector in found] == [True, False, True, True, True]
+    assert reader.info()["entries"] == 4
@@ -0,0 +1,59 @@
+import numpy as np
+
+from manifest import CHUNK_SEPARATOR
+from metadata_index import ColumnarIndex, UnsupportedFilter, aggregate_records, merge_aggregates
+
+
+def rows():
+    ids = ["a", "b", "c", "a" + CHUNK_SEPARATOR + "1"]
+    metadatas = [{"source": "web", "file_type": "pdf", "file_location_at_source": "reports/q1", "file_size": 100, "file_created_ts": 1704067200},
+                 {"source": "web", "file_type": "docx", "file_location_at_source": "reports/q2", "file_size": 300, "file_created_ts": 1709251200},
+                 {"source": "avoma", "file_type": "pdf", "file_location_at_source": "calls", "file_size": 50, "file_created_ts": 1709251200},
+                 {"source": "web", "file_type": "pdf", "file_location_at_source": "reports/q1", "file_size": 100, "file_created_ts": 1704067200}]
+    return ids, np.eye(4, dtype=np.float32), metadatas
+
+
+def test_aggregate_skips_body_chunks(tmp_path):
+    index = ColumnarIndex(str(tmp_path / "index"))
+    index.upsert(*rows())
+    index.compact()
+
+    groups = index.aggregate(None, "source")
+
+    assert groups == {"web": {"files": 2, "file_size_sum": 400, "file_size_min": 100, "file_size_max": 300},
+                      "avoma": {"files": 1, "file_size_sum": 50, "file_size_min": 50, "file_size_max": 50}}
+    assert index.aggregate({"file_location_at_source": {"$prefix": "reports/"}}, "location", 2)["reports/q1"]["files"] == 1
+
+
+def test_aggregate_after_save_and_load(tmp_path):
+    index = ColumnarIndex(str(tmp_path / "index"))
+    index.upsert(*rows())
+    index.save(1)
+
+    loaded = ColumnarIndex(str(tmp_path / "index"))
+    assert loaded.load()
+    assert loaded.aggregate(None, "month") == index.aggregate(None, "month")
+    assert loaded.aggregate({"file_type": "docx"})["all"]["files"] == 1
+
+
+def test_record_aggregates_match_the_index(tmp_path):
+    index = ColumnarIndex(str(tmp_path / "index"))
+    index.upsert(*rows())
+    index.compact()
+    ids, embeddings, metadatas = rows()
+    files = [metadata for doc_id, metadata in zip(ids, metadatas) if CHUNK_SEPARATOR not in doc_id]
+
+    parts = [aggregate_records(files[:1], "source"), aggregate_records(files[1:], "source")]
+
+    assert merge_aggregates(parts) == index.aggregate(None, "source")
+
+
+def test_unsupported_filter(tmp_path):
+    index = ColumnarIndex(str(tmp_path / "index"))
+    index.upsert(*rows())
+
+    try:
+        index.aggregate({"author": "someone"})
+    except UnsupportedFilter:
+        return
+    raise AssertionError("author is not a column of the index")
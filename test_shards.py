@@ -0,0 +1,83 @@
+import pandas as pd
+import pytest
+
+from query import fuse_responses
+from shards import ShardedVectorDB, merge_rankings, constraint_values
+from test_db import CSV_PATH, HashEmbedding, open_store
+
+
+def ranking(kinds, ids, distances=None, scores=None, timestamps=None):
+    response = {"ids": ids, "kinds": kinds,
+                "distances": distances or [None] * len(ids),
+                "metadatas": [[{"id": doc_id} for doc_id in list_ids] for list_ids in ids]}
+    if scores is not None:
+        response["scores"] = scores
+    if timestamps is not None:
+        response["timestamps"] = timestamps
+    return response
+
+
+def fused_ids(responses, n_results):
+    return fuse_responses(merge_rankings(responses, n_results, ("metadatas",)), limit=n_results)["ids"][0]
+
+
+def test_shards_are_fused_by_rank_not_distance():
+    # An exact shard reports 1 - cosine, a Chroma shard l2 distances about twice as large.
+    exact = ranking(["vector"], [["e1", "e2", "e3"]], [[0.10, 0.20, 0.30]])
+    chroma = ranking(["vector"], [["c1", "c2", "c3"]], [[0.25, 0.45, 0.65]])
+
+    top = fused_ids([exact, chroma], 4)
+
+    assert sorted(top) == ["c1", "c2", "e1", "e2"]
+
+
+def test_shard_bm25_scores_are_not_compared():
+    small = ranking(["vector", "lexical"], [["a1"], ["a1", "a2"]], [[0.3], None], [None, [25.0, 20.0]])
+    large = ranking(["vector", "lexical"], [["b1"], ["b1", "b2"]], [[0.3], None], [None, [3.0, 2.0]])
+
+    top = fused_ids([small, large], 4)
+
+    assert set(top[:2]) == {"a1", "b1"}
+    assert set(top[2:]) == {"a2", "b2"}
+
+
+def test_title_hits_merged_newest_first_across_shards():
+    first = ranking(["title"], [["a_old", "a_mid"]], timestamps=[[100, 200]])
+    second = ranking(["title"], [["b_new", "b_older"]], timestamps=[[300, 50]])
+    vectors = ranking(["vector"], [["v1"]], [[0.1]])
+
+    merged = merge_rankings([first, vectors, second], 3, ("metadatas",))
+
+    assert merged["kinds"] == ["title"]
+    assert merged["ids"] == [["b_new", "a_mid", "a_old"]]
+    assert merged["metadatas"][0][0] == {"id": "b_new"}
+
+
+def test_constraint_values():
+    constraint = {"$and": [{"source": {"$in": ["web", "avoma"]}}, {"file_size": {"$lte": 1000}}]}
+
+    assert sorted(constraint_values(constraint, "source")) == ["avoma", "web"]
+    assert constraint_values({"file_type": "pdf"}, "source") is None
+
+
+def test_sharded_ingest_and_latest_match_one_store(tmp_path):
+    data = pd.read_csv(CSV_PATH).head(400)
+    data.to_csv(tmp_path / "files.csv", index=False)
+
+    sharded = ShardedVectorDB(str(tmp_path / "sharded"), partition=["source"], backend="numpy", model=HashEmbedding())
+    reports = sharded.create_db_from_csv(str(tmp_path / "files.csv"), chunksize=100)
+    assert sum(report["added"] for report in reports.values()) == len(data)
+    assert sorted(reports) == sorted(data["source"].unique())
+
+    reports = sharded.create_db_from_csv(str(tmp_path / "files.csv"), chunksize=100)
+    assert sum(report["skipped"] for report in reports.values()) == len(data)
+
+    with pytest.raises(ValueError):
+        sharded.create_db_from_csv(str(tmp_path / "files.csv"), shards=["nope"])
+
+    single = open_store(tmp_path / "single", data)
+    single.create_db()
+
+    for query_text in ["customer survey", "Annual Review"]:
+        expected = single.latest(query_text, n_results=5)
+        assert sharded.latest(query_text, n_results=5)["ids"] == expected["ids"]
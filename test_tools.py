@@ -0,0 +1,28 @@
+import datetime
+
+from tools import build_constraint, cache_key, date_to_timestamp, KB_PER_MB
+
+
+def test_file_size_megabytes_become_kilobytes():
+    assert build_constraint(file_size=1) == {"file_size": {"$lte": KB_PER_MB}}
+    assert build_constraint(file_size="2.5") == {"file_size": {"$lte": 2.5 * KB_PER_MB}}
+    assert build_constraint() is None
+
+
+def test_dates_are_inclusive_day_ranges():
+    start = datetime.date(2024, 3, 1)
+    end = datetime.date(2024, 3, 31)
+
+    constraint = build_constraint("web", "pdf", "any", start, end)
+
+    assert constraint == {"$and": [{"file_created_ts": {"$gte": date_to_timestamp(start)}},
+                                   {"file_created_ts": {"$lt": date_to_timestamp(datetime.date(2024, 4, 1))}},
+                                   {"source": "web"},
+                                   {"file_type": "pdf"}]}
+
+
+def test_cache_key_shares_size_spellings():
+    day = datetime.date(2024, 1, 1)
+
+    assert cache_key("Annual  Review", "Web", "pdf", "1", day, day, 10) == cache_key("annual review", "web", "PDF", 1.0, day, day, 10)
+    assert cache_key("annual review", "web", "pdf", 1, day, day, 10) != cache_key("annual review", "web", "pdf", 2, day, day, 10)
@@ -1,27 +1,142 @@
 import datetime
+import calendar
 
-import pandas as pd
-import numpy as np
+from engine import get_engine
+from result_cache import ResultCache
+from results import iter_records
+from ranking import rerank, top, collapse, CANDIDATE_FACTOR, RECENCY_FIELD
+from tracing import span
 
-from db import VectorDB
+# Results of search_for_similar_records, dropped whenever ingestion saves a new generation.
+result_cache = ResultCache()
+
+# The tools take sizes in megabytes, the index stores file_size in kilobytes.
+KB_PER_MB = 1000
+
+
+def date_to_timestamp(date):
+    return calendar.timegm(date.timetuple())
+
+
+def build_constraint(file_source="any", file_extension="any", file_size="any", start_date=None, end_date=None):
+    """
+    Builds a single Chroma where clause for all constraints. Dates are datetime.date
+    objects and are matched against the numeric file_created_ts metadata, end_date inclusive.
+    file_size is a maximum in megabytes, matched against file_size in kilobytes.
+    """
+
+    const = []
+
+    if start_date is not None:
+        const.append({"file_created_ts": {"$gte": date_to_timestamp(start_date)}})
+
+    if end_date is not None:
+        const.append({"file_created_ts": {"$lt": date_to_timestamp(end_date + datetime.timedelta(days=1))}})
+
+    if file_source != "any":
+        const.append({"source": file_source})
+
+    if file_extension != "any":
+        const.append({"file_type": file_extension})
+
+    if file_size != "any":
+        const.append({"file_size": {"$lte": float(file_size) * KB_PER_MB}})
+
+    if len(const) == 0:
+        return None
+
+    if len(const) == 1:
+        return const[0]
+
+    return {"$and": const}
+
+
+def query_with_overfetch(query, constraint, nfiles_to_return, max_results=None):
+    """
+    Queries with the constraint pushed down, doubling n_results until nfiles_to_return
+    files are found or the store has no more matches. Hits on body chunks count for their
+    file. Returns the ranked ids and scores only, records are looked up by the caller.
+    """
+
+    vb = get_engine()
+    max_results = vb.count() if max_results is None else max_results
+    n_results = max(min(nfiles_to_return, max_results), 1)
+
+    while True:
+        results = vb.send_query(query, constraint, n_results, include=())
+        hits = len(results["ids"][0])
+        results = collapse(results)
+
+        if len(results["ids"][0]) >= nfiles_to_return or hits < n_results or n_results >= max_results:
+            return results
+
+        n_results = min(n_results * 2, max_results)
+
+
+def most_relevant(query, constraint, nfiles_to_return):
+    """
+    Reranks a pool of CANDIDATE_FACTOR times more candidates than requested by relevance
+    and recency, then keeps the best nfiles_to_return.
+    """
+
+    vb = get_engine()
+    ranked = query_with_overfetch(query, constraint, nfiles_to_return * CANDIDATE_FACTOR)
+    return top(rerank(vb, ranked), nfiles_to_return)
+
+
+def latest_matching(query, constraint, nfiles_to_return):
+    """
+    The newest nfiles_to_return matches, walked newest first on the time-sorted index
+    (only the exact title matches when there are any). When the index cannot evaluate
+    the constraint, the newest of a relevance ranked pool.
+    """
+
+    vb = get_engine()
+    # Chunks of a file share its timestamps, so a few extra hits leave room for collapsing them.
+    latest = vb.latest(query, constraint, nfiles_to_return * CANDIDATE_FACTOR, field=RECENCY_FIELD, include=())
+
+    if latest is not None:
+        latest = collapse(latest)
+    else:
+        ranked = query_with_overfetch(query, constraint, nfiles_to_return * CANDIDATE_FACTOR)
+        latest = rerank(vb, ranked, recency_weight=1.0)
+
+    return top(latest, nfiles_to_return)
+
+
+def cache_key(query, file_source, file_extension, file_size, start_date, end_date, nfiles_to_return, sort_by="relevance"):
+    """
+    Canonical form of a request, so spelling variants of the same search share an entry.
+    """
+
+    return (" ".join(query.lower().split()),
+            str(file_source).strip().lower(),
+            str(file_extension).strip().lower(),
+            "any" if file_size == "any" else float(file_size) * KB_PER_MB,
+            start_date.isoformat(),
+            end_date.isoformat(),
+            nfiles_to_return,
+            sort_by)
+
+
+def result_cache_stats():
+    return result_cache.info()
 
-data  = pd.read_csv("data/file_info_1.csv")
-vb = VectorDB(data)
-vb.create_db()
 
 def search_for_links(query):
 
     try:
-        results = vb.send_query(query, constraint={"$and" : [{"source": 'web'}, {"file_type": "web link"}]})
-        results = pd.DataFrame(results["metadatas"][0])
-        results = results.tail(1)
+        constraint = {"$and" : [{"source": 'web'}, {"file_type": "web link"}]}
+        latest = latest_matching(query, constraint, 1)
+        results = [record for page in iter_records(get_engine(), latest, constraint=constraint) for record in page]
 
         return results, {"link retrieved" : True, 'message': None}
 
     except Exception as e:
         return None, {"link retrieved" : False, 'message': str(e)}
 
-def search_for_similar_records(query, file_source="any", file_extension="any", file_size="any", nfiles_to_return=10, start_date="2024-01-01", end_date="2024-09-29"):
+def search_for_similar_records(query, file_source="any", file_extension="any", file_size="any", nfiles_to_return=10, start_date="2024-01-01", end_date="2024-09-29",
+                               sort_by="relevance"):
     """
     Function to search for similar records based on query and constraints.
 
@@ -29,12 +144,13 @@ def search_for_similar_records(query, file_source="any", file_extension="any", f
     query (str): The search query.
     file_source (str, optional): The file source location. Default is "any".
     file_extension (str, optional): The file extension type. Default is "any".
-    file_size (str, optional): The size of the file. Default is "any".
+    file_size (str, optional): The maximum size of the file in megabytes (MB). Default is "any".
     start_date (str, optional): Start date for filtering results. Format 'YYYY-MM-DD'. Default is '2024-01-01'.
     end_date (str, optional): End date for filtering results. Format 'YYYY-MM-DD'. Default is '2024-09-29'.
+    sort_by (str, optional): "relevance" ranks by similarity blended with recency, "latest" returns the newest matching files. Default is "relevance".
 
     Returns:
-    tuple: Contains a DataFrame with results, a dictionary of result information, and a dictionary indicating success or failure.
+    tuple: Contains a list of FileRecords sorted by creation time, a dictionary of result information, and a dictionary indicating success or failure.
     """
 
     result_info = {
@@ -47,59 +163,89 @@ def search_for_similar_records(query, file_source="any", file_extension="any", f
     try:
         start_date = datetime.datetime.strptime(start_date, '%Y-%m-%d').date()
         end_date = datetime.datetime.strptime(end_date, '%Y-%m-%d').date()
+        nfiles_to_return = int(nfiles_to_return)
 
-        const = []
+        if sort_by not in ("relevance", "latest"):
+            raise ValueError("sort_by must be 'relevance' or 'latest'")
 
-        if file_source != "any":
-            constraint = {"source": file_source}
-            const.append(constraint)
+        key = cache_key(query, file_source, file_extension, file_size, start_date, end_date, nfiles_to_return, sort_by)
 
-        if file_extension != "any":
-            constraint = {"file_type": file_extension}
-            const.append(constraint)
+        with span("result_cache") as cache_span:
+            generation = get_engine().refresh()
+            cached = result_cache.get(key, generation)
+            cache_span.set(hit=cached is not None)
 
-        if file_size != "any":
-            constraint = {"file_size": {"$lte": int(file_size)}}
-            const.append(constraint)
+        if cached is not None:
+            results, result_info = cached
+            return list(results), dict(result_info, query_passed=query), {"success": True, "cached": True}
 
-        if len(const) > 0:
+        constraint = build_constraint(file_source, file_extension, file_size, start_date, end_date)
 
-            if len(const) == 2:
-                constraint = {"$and": const}
+        with span("retrieve", sort_by=sort_by):
+            if sort_by == "latest":
+                ranked = latest_matching(query, constraint, nfiles_to_return)
             else:
-                constraint = const[0]
+                ranked = most_relevant(query, constraint, nfiles_to_return)
+
+        with span("postprocess", rows=len(ranked["ids"][0])) as postprocess:
+            results = [record for page in iter_records(get_engine(), ranked, constraint=constraint) for record in page]
+            postprocess.set(files=len(results))
+
+            if len(results) > 0:
+                # Ranking already picked the files, they are listed oldest to newest.
+                results.sort(key=lambda record: record.file_created_ts)
 
-            results = vb.send_query(query, constraint)
-        else:
-            results = vb.send_query(query)
+                result_info = {
+                    "number_of_matches": len(results),
+                    "query_passed": query,
+                    "document_summary": "/".join(record.file_title for record in results),
+                    "latest_document_created_at": results[-1].file_created_at[:10]
+                }
 
-        results = pd.DataFrame(results["metadatas"][0])
-        print("Meta data\n", results)
+            size = sum(record.nbytes() for record in results) + len(str(result_info))
+            result_cache.put(key, generation, (list(results), result_info), size)
 
-        if results.shape[0] > 0:
-            results['file_created_at'] = pd.to_datetime(results['file_created_at']).dt.date
-            results = results[(results['file_created_at'] >= start_date) & (results['file_created_at'] <= end_date)]
+        return results, result_info, {"success": True}
 
-            if file_source != "any":
-                results = results[results['source'] == file_source]
+    except Exception as e:
+        return "Error faced while processing data",  result_info, {"success": False, "exception": str(e)}
 
-            if file_extension != "any":
-                results = results[results['file_type'] == file_extension]
+def count_files(file_source="any", file_extension="any", file_size="any", start_date=None, end_date=None,
+                location_prefix="", group_by="none", limit=20):
+    """
+    Function to count files and summarize their sizes without retrieving them.
 
-            if file_size != "any":
-                results = results[results['file_size'] >= (file_size * 1000)]
+    Args:
+    file_source (str, optional): The file source location. Default is "any".
+    file_extension (str, optional): The file extension type. Default is "any".
+    file_size (str, optional): The maximum size of the files in megabytes (MB). Default is "any".
+    start_date (str, optional): Start date for filtering by creation date. Format 'YYYY-MM-DD'. Default is no limit.
+    end_date (str, optional): End date for filtering by creation date, inclusive. Format 'YYYY-MM-DD'. Default is no limit.
+    location_prefix (str, optional): Only count files in this folder, e.g. 'products/product_x'. Default is all folders.
+    group_by (str, optional): "none", "source", "file_type", "month" or "location" (the folders one level below location_prefix). Default is "none".
+    limit (int, optional): Number of largest groups to return. Default is 20.
 
-            result_info = {
-                "number_of_matches": results.shape[0],
-                "query_passed": query,
-                "document_summary": "/".join(results["file_title"].values),
-                "latest_document_created_at": results["file_created_at"].max()
-            }
+    Returns:
+    tuple: The aggregate (files, file_size_sum/min/max in kilobytes (KB) and the groups, if any) and a dictionary indicating success or failure.
+    """
+
+    try:
+        start_date = datetime.datetime.strptime(start_date, '%Y-%m-%d').date() if start_date else None
+        end_date = datetime.datetime.strptime(end_date, '%Y-%m-%d').date() if end_date else None
+        group_by = None if group_by in (None, "none") else group_by
+        location_prefix = (location_prefix or "").strip("/")
 
-            results = results.sort_values(by='file_created_at')
-            results = results.tail(int(nfiles_to_return))
+        constraint = build_constraint(file_source, file_extension, file_size, start_date, end_date)
+        if location_prefix:
+            folder = {"file_location_at_source": {"$prefix": location_prefix}}
+            constraint = folder if constraint is None else {"$and": constraint.get("$and", [constraint]) + [folder]}
 
-        return results, result_info, {"success": True}
+        depth = len(location_prefix.split("/")) + 1 if location_prefix else 1
+
+        with span("count_files", group_by=group_by):
+            aggregate = get_engine().aggregate(constraint, group_by, depth, int(limit))
+
+        return aggregate, dict(aggregate, success=True)
 
     except Exception as e:
-        return "Error faced while processing data",  result_info, {"success": False, "exception": str(e)}
+        return "Error faced while counting files", {"success": False, "exception": str(e)}
@@ -0,0 +1,201 @@
+import os
+import json
+import time
+import atexit
+import itertools
+import threading
+import contextvars
+
+# Tracing is off unless SEARCH_TRACE=1, disabled spans are a shared no-op object.
+ENABLED = os.getenv("SEARCH_TRACE", "0") == "1"
+TRACE_DIR = os.getenv("SEARCH_TRACE_DIR", "traces")
+
+_current = contextvars.ContextVar("current_span", default=None)
+_ids = itertools.count(1)
+_lock = threading.Lock()
+_jsonl = None
+
+# Cumulative per stage: [calls, seconds, errors].
+COUNTERS = {}
+
+
+def configure(enabled=True, trace_dir=None):
+    global ENABLED, TRACE_DIR, _jsonl
+
+    with _lock:
+        ENABLED = enabled
+        if trace_dir is not None and trace_dir != TRACE_DIR:
+            TRACE_DIR = trace_dir
+            if _jsonl is not None:
+                _jsonl.close()
+                _jsonl = None
+
+
+class Trace:
+    """
+    The finished spans of one root span (a chat turn or a single search), shared by
+    all its descendants, including those running on other threads.
+    """
+
+    def __init__(self):
+        self.trace_id = "%x-%x" % (int(time.time() * 1000), next(_ids))
+        self.spans = []
+
+
+class Span:
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.span_id = next(_ids)
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        parent = _current.get()
+        self.parent_id = parent.span_id if parent is not None else None
+        self.trace = parent.trace if parent is not None else Trace()
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.started
+        _current.reset(self._token)
+
+        record = {"trace_id": self.trace.trace_id,
+                  "span_id": self.span_id,
+                  "parent_id": self.parent_id,
+                  "name": self.name,
+                  "start": round(self.started_at, 6),
+                  "duration_ms": round(elapsed * 1000, 3),
+                  "thread": threading.current_thread().name}
+        if self.attrs:
+            record["attrs"] = self.attrs
+        if exc is not None:
+            record["error"] = repr(exc)
+
+        self.trace.spans.append(record)
+        _record(record, elapsed, exc is not None)
+
+        if self.parent_id is None:
+            write_metrics()
+
+        return False
+
+    def breakdown(self):
+        """
+        (depth, name, duration_ms) of the finished spans of this trace, children listed
+        under their parent in start order. Usable while this span is still open.
+        """
+
+        records = sorted(self.trace.spans, key=lambda record: record["start"])
+        finished = set(record["span_id"] for record in records)
+
+        children = {}
+        for record in records:
+            parent = record["parent_id"] if record["parent_id"] in finished else None
+            children.setdefault(parent, []).append(record)
+
+        rows = []
+
+        def visit(parent, depth):
+            for record in children.get(parent, []):
+                rows.append((depth, record["name"], record["duration_ms"]))
+                visit(record["span_id"], depth + 1)
+
+        visit(None, 0 if self.span_id in finished else 1)
+        return rows
+
+
+class NoopSpan:
+
+    def set(self, **attrs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def breakdown(self):
+        return []
+
+
+NOOP_SPAN = NoopSpan()
+
+
+def span(name, **attrs):
+    """
+    Context manager timing a stage. Nested spans, also across threads started with
+    contextvars.copy_context().run, belong to the trace of the outermost one.
+    """
+
+    if not ENABLED:
+        return NOOP_SPAN
+    return Span(name, attrs)
+
+
+def _record(record, elapsed, failed):
+    global _jsonl
+
+    line = json.dumps(record, default=str) + "\n"
+
+    with _lock:
+        counters = COUNTERS.setdefault(record["name"], [0, 0.0, 0])
+        counters[0] += 1
+        counters[1] += elapsed
+        counters[2] += failed
+
+        if _jsonl is None:
+            os.makedirs(TRACE_DIR, exist_ok=True)
+            _jsonl = open(os.path.join(TRACE_DIR, "spans.jsonl"), "a")
+        _jsonl.write(line)
+        _jsonl.flush()
+
+
+def _label(value):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def metrics_text():
+    """
+    Cumulative counters per stage in the Prometheus text exposition format.
+    """
+
+    with _lock:
+        counters = sorted(COUNTERS.items())
+
+    lines = []
+    for metric, column, help_text in [("search_stage_calls_total", 0, "Number of times each stage ran."),
+                                      ("search_stage_seconds_total", 1, "Cumulative seconds spent in each stage."),
+                                      ("search_stage_errors_total", 2, "Number of times each stage raised.")]:
+        lines.append("# HELP %s %s" % (metric, help_text))
+        lines.append("# TYPE %s counter" % metric)
+        for name, values in counters:
+            lines.append("%s{stage=\"%s\"} %s" % (metric, _label(name), repr(float(values[column]))))
+
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics():
+    """
+    Rewrites TRACE_DIR/metrics.prom atomically, for the node exporter textfile collector.
+    """
+
+    if not COUNTERS:
+        return
+
+    os.makedirs(TRACE_DIR, exist_ok=True)
+    path = os.path.join(TRACE_DIR, "metrics.prom")
+    tmp_path = "%s.%d.tmp" % (path, threading.get_ident())
+
+    with open(tmp_path, "w") as f:
+        f.write(metrics_text())
+    os.replace(tmp_path, path)
+
+
+atexit.register(write_metrics)